@@ -0,0 +1,464 @@
+#!/usr/bin/env python2
+"""
+Inventory Benchmark Suite
+
+Generates synthetic inventories (machines, services, products and database groups) at each size, as YAML or JSON
+data files, or as SQLite tables queried with the example specs' SQL, renders the named, apache and haproxy example
+templates from them with templateman.py, and reports wall time, rows/sec, peak RSS and the time of each stage (from
+--profile).  Results can be saved as a baseline, and later runs are compared to it, so each performance change can be
+justified with numbers.
+
+benchmarks/baseline.json is the baseline of the default options, recorded on the machine the suite was written on.
+Wall times depend on the machine, so to check for regressions record your own first, before the change being measured:
+
+  benchmarks/inventory.py --save-baseline
+  (make the change)
+  benchmarks/inventory.py --max-regression=10
+
+Each case runs templateman.py in its own process, so interpreter startup, imports and peak RSS are measured the same
+way as a real run.  Inventories are generated from fixed formulas, so every run renders the same output.
+
+usage: benchmarks/inventory.py [options]
+
+Options:
+  --sizes=[n,n,...]         Machine counts to generate (default: 1000,10000,100000).  1000000 is supported, but slow.
+  --formats=[f,f,...]       Data formats: json, yaml, sqlite (default: json)
+  --baseline=[path]         Baseline results file (default: benchmarks/baseline.json)
+  --save-baseline           Save this run's results as the baseline
+  --max-regression=[pct]    Exit 1 if a case's wall time is this many percent slower than the baseline
+  --keep                    Keep the generated inventories and outputs, and print where they are
+"""
+
+
+import getopt
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+TEMPLATES = os.path.join(ROOT, 'example-templates')
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_FORMATS = ['json']
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+# Inventory shape, per machine count
+SERVICE_COUNT = 30
+LOCATION_COUNT = 4
+PRODUCTS_PER_MACHINE = 0.1
+
+# Example spec SQL for the reverse zone, with the octets of each address
+REVERSE_SQL = ('SELECT name, (INET_ATON(ip_private) & (255 << 16)) >> 16 AS octet2, '
+               '(INET_ATON(ip_private) & (255 << 8)) >> 8 AS octet3, INET_ATON(ip_private) & 255 AS octet4 '
+               'FROM machine WHERE location = 3 ORDER BY id')
+
+# Example spec SQL for the CDN, with each product's studio path
+CDN_SQL = ('SELECT product.*, studio.path AS path FROM product, studio WHERE product.is_launched = 1 '
+           'AND product.studio = studio.id AND product.studio = 1 ORDER BY product.id')
+
+# Stages reported from the --profile spans, by span name.  Time in other spans is counted as "other".
+STAGES = ['parse yaml', 'parse text', 'query', 'commands', 'template', 'write', 'fingerprint']
+
+
+def Machines(count):
+  """Returns list of dicts, machine records with the fields the example templates use."""
+  machines = []
+
+  for index in range(count):
+    address = (10 << 24) + index + 256
+
+    machines.append({
+      'id': index + 1,
+      'name': 'host-%07d' % index,
+      'service': index % SERVICE_COUNT + 1,
+      'location': index % LOCATION_COUNT + 1,
+      'ip_private': '10.%d.%d.%d' % ((address >> 16) & 255, (address >> 8) & 255, address & 255),
+      'ip_address': '10.%d.%d.%d' % ((address >> 16) & 255, (address >> 8) & 255, address & 255),
+      'octet2': (address >> 16) & 255,
+      'octet3': (address >> 8) & 255,
+      'octet4': address & 255,
+      'is_deployed': index % 10 != 0,
+    })
+
+  return machines
+
+
+def Services():
+  """Returns list of dicts, service records."""
+  return [{'id': index + 1, 'name': 'service-%02d' % index, 'port': 8000 + index} for index in range(SERVICE_COUNT)]
+
+
+def Products(count):
+  """Returns list of dicts, product records, about one for every 10 machines."""
+  products = []
+
+  for index in range(max(int(count * PRODUCTS_PER_MACHINE), 1)):
+    products.append({
+      'id': index + 1,
+      'name': 'Product %d' % index,
+      'alias': 'product%d' % index,
+      'alias_short': 'p%d' % index,
+      'studio': index % 3 + 1,
+      'is_product': True,
+      'is_launched': index % 5 != 0,
+    })
+
+  return products
+
+
+def DatabaseGroups(products, machine_count, offset):
+  """Returns list of dicts, the database host of each product (master for offset 0, slave for 1), de-normalized for
+  file data like the example SQL join.
+  """
+  groups = []
+
+  for product in products:
+    groups.append({
+      'id': product['id'],
+      'productname': product['alias'],
+      'location': product['id'] % LOCATION_COUNT + 1,
+      'host': 'host-%07d' % ((product['id'] * 7 + offset) % machine_count),
+    })
+
+  return groups
+
+
+def DatabaseGroupSql(machine_column):
+  """Returns string, the example spec SQL for the database group hosts in machine_column (master or slave)."""
+  return ('SELECT alias AS productname, machine.name AS host FROM product, database_group AS dbg, machine '
+          'WHERE dbg.location = 3 AND product.database_group = dbg.id AND machine.id = dbg.%s '
+          'ORDER BY product.id' % machine_column)
+
+
+def WriteSqlite(path, machines, products, machine_count):
+  """Write the inventory as the normalized tables of the example specs' SQL to a SQLite file."""
+  conn = sqlite3.connect(path)
+
+  def Table(name, columns, records):
+    conn.execute('CREATE TABLE %s (%s)' % (name, ', '.join(columns)))
+    conn.executemany('INSERT INTO %s VALUES (%s)' % (name, ', '.join(['?'] * len(columns))),
+                     [[record[column] for column in columns] for record in records])
+
+  Table('machine', ['id', 'name', 'service', 'location', 'ip_private', 'ip_address', 'is_deployed'], machines)
+  Table('service', ['id', 'name', 'port'], Services())
+  Table('product', ['id', 'name', 'alias', 'alias_short', 'studio', 'is_product', 'is_launched', 'database_group'],
+        [dict(product, database_group=product['id']) for product in products])
+  Table('studio', ['id', 'path'], [{'id': index + 1, 'path': '/studio%d' % (index + 1)} for index in range(3)])
+
+  # The same hosts as DatabaseGroups(), by machine id
+  Table('database_group', ['id', 'location', 'machine_master', 'machine_slave'],
+        [{'id': product['id'], 'location': product['id'] % LOCATION_COUNT + 1,
+          'machine_master': (product['id'] * 7) % machine_count + 1,
+          'machine_slave': (product['id'] * 7 + 1) % machine_count + 1} for product in products])
+
+  # Indexed like a snapshot would be (see util/snapshot.py)
+  for (table, column) in (('machine', 'id'), ('machine', 'location'), ('product', 'database_group'),
+                          ('product', 'studio'), ('database_group', 'id'), ('studio', 'id')):
+    conn.execute('CREATE INDEX %s_%s ON %s (%s)' % (table, column, table, column))
+
+  conn.commit()
+  conn.close()
+
+
+def WriteData(path, records, file_format):
+  """Write records as a JSON or YAML data file."""
+  fp = open(path, 'w')
+  try:
+    if file_format == 'json':
+      json.dump(records, fp)
+    else:
+      yaml.safe_dump(records, fp, default_flow_style=False)
+  finally:
+    fp.close()
+
+
+def WriteSpec(path, spec_data):
+  """Write a spec file."""
+  fp = open(path, 'w')
+  try:
+    yaml.safe_dump(spec_data, fp, default_flow_style=False)
+  finally:
+    fp.close()
+
+
+def WriteInventory(work_dir, size, file_format):
+  """Generate the inventory data files, datasources and specs in work_dir.
+
+  Returns: dict, case name -> list of spec paths rendered for that case
+  """
+  machines = Machines(size)
+  products = Products(size)
+
+  data = {
+    'machines': machines,
+    'services': Services(),
+    'products': products,
+    'database_group_masters': DatabaseGroups(products, size, 0),
+    'database_group_slaves': DatabaseGroups(products, size, 1),
+  }
+
+  datasources = {}
+
+  # A SQL database, queried with the example specs' SQL
+  if file_format == 'sqlite':
+    path = os.path.join(work_dir, 'inventory.sqlite')
+    WriteSqlite(path, machines, products, size)
+    datasources['ops'] = {'type': 'sqlite', 'path': path}
+
+  else:
+    for (name, records) in data.items():
+      path = os.path.join(work_dir, '%s.%s' % (name, file_format))
+      WriteData(path, records, file_format)
+      datasources[name] = {'type': file_format, 'path': path}
+
+    # Machines get their service's fields, as service.name and service.port
+    datasources['machines']['relationship'] = {'service': 'services.id'}
+
+  WriteSpec(os.path.join(work_dir, 'datasources.yaml'), datasources)
+
+  spec_dir = os.path.join(work_dir, 'specs')
+  out_dir = os.path.join(work_dir, 'out')
+  os.makedirs(spec_dir)
+
+  def Spec(name, **spec_data):
+    path = os.path.join(spec_dir, '%s.yaml' % name)
+    spec_data['name'] = name
+    WriteSpec(path, spec_data)
+    return path
+
+  def Template(path):
+    return os.path.join(TEMPLATES, path)
+
+  def Data(datasource, filter, sql):
+    """Returns dict, the datasource and filter of a spec: the SQL for the sqlite format, otherwise the file filter."""
+    if file_format == 'sqlite':
+      return {'datasource': 'ops', 'filter': sql}
+    else:
+      return {'datasource': datasource, 'filter': filter}
+
+  header = {'serial': 2015010100}
+
+  forward = Spec('named_forward', path=os.path.join(out_dir, 'prod.zone'),
+                 **{'template wrapper': Template('prod_named_master/zone_forward'), 'specs': {
+    'header': Spec('named_forward_header', template=Template('prod_named_master/zone_forward_header'), data=header),
+    'machine': Spec('named_forward_machine', template=Template('prod_named_master/zone_forward_machine'),
+                    **Data('machines', {'location': 3}, 'SELECT * FROM machine WHERE location = 3 ORDER BY id')),
+    'database_group_master': Spec('named_forward_master',
+                                  template=Template('prod_named_master/zone_forward_database_group_master'),
+                                  **Data('database_group_masters', {'location': 3}, DatabaseGroupSql('machine_master'))),
+    'database_group_slave': Spec('named_forward_slave',
+                                 template=Template('prod_named_master/zone_forward_database_group_slave'),
+                                 **Data('database_group_slaves', {'location': 3}, DatabaseGroupSql('machine_slave'))),
+    'static': Spec('named_forward_static', **{'template wrapper': Template('prod_named_master/zone_forward_static')}),
+  }})
+
+  reverse = Spec('named_reverse', path=os.path.join(out_dir, '10.zone'),
+                 **{'template wrapper': Template('prod_named_master/zone_reverse'), 'specs': {
+    'header': Spec('named_reverse_header', template=Template('prod_named_master/zone_reverse_header'), data=header),
+    'machine': Spec('named_reverse_machine', template=Template('prod_named_master/zone_reverse_machine'),
+                    **Data('machines', {'location': 3}, REVERSE_SQL)),
+    'static': Spec('named_reverse_static', **{'template wrapper': Template('prod_named_master/zone_reverse_static')}),
+  }})
+
+  vhosts = Spec('apache_vhosts', path=os.path.join(out_dir, 'app_vhost_products.conf'),
+                template=Template('prod_app_vhost/app_httpd_vhost_product'),
+                **Data('products', {'is_product': True, 'is_launched': True},
+                       'SELECT * FROM product WHERE is_product = 1 AND is_launched = 1 ORDER BY id'))
+
+  cdn = Spec('apache_cdn', path=os.path.join(out_dir, 'prod_app_vhost_cdn.conf'),
+             template=Template('prod_app_vhost/app_httpd_cdn_item'),
+             **dict(Data('products', {'is_launched': True, 'studio': 1}, CDN_SQL),
+                    **{'template wrapper': Template('prod_app_vhost/app_httpd_cdn_wrapper')}))
+
+  haproxy = Spec('haproxy', path=os.path.join(out_dir, 'haproxy.cfg'), template=Template('haproxy/config'), specs={
+    'header': Spec('haproxy_header', template=Template('haproxy/header')),
+    'app_http': Spec('haproxy_app_http', template=Template('haproxy/app_http'),
+                     **Data('machines', {'location': 1}, 'SELECT * FROM machine WHERE location = 1 ORDER BY id')),
+    'app_https': Spec('haproxy_app_https', template=Template('haproxy/app_https'),
+                      **Data('machines', {'location': 1}, 'SELECT * FROM machine WHERE location = 1 ORDER BY id')),
+  })
+
+  return {'named': [forward, reverse], 'apache': [vhosts, cdn], 'haproxy': [haproxy]}
+
+
+def StageSeconds(spans, stages):
+  """Add the own (excluding children) seconds of each span to stages, by span name."""
+  for span in spans:
+    own_seconds = span['seconds'] - sum([child['seconds'] for child in span['children']])
+
+    if span['name'] in STAGES:
+      stage = span['name']
+    else:
+      stage = 'other'
+
+    stages[stage] = stages.get(stage, 0.0) + max(own_seconds, 0.0)
+
+    StageSeconds(span['children'], stages)
+
+
+def QueryRows(spans):
+  """Returns int, the rows returned by all the query spans."""
+  rows = 0
+
+  for span in spans:
+    if span['name'] == 'query':
+      rows += span['counts'].get('rows', 0)
+
+    rows += QueryRows(span['children'])
+
+  return rows
+
+
+def RunCase(work_dir, spec_paths):
+  """Render the specs with templateman.py in a new process.
+
+  Returns: dict of results: wall_seconds, rows, rows_per_second, peak_rss_kb, stages (dict, stage -> seconds)
+  """
+  profile_path = os.path.join(work_dir, 'profile.json')
+
+  args = [sys.executable, os.path.join(ROOT, 'templateman.py'), '--no-cache', '--profile',
+          '--profile-json=%s' % profile_path, '--datasources=%s' % os.path.join(work_dir, 'datasources.yaml'),
+          '--commands=%s' % os.path.join(ROOT, 'conf', 'commands.yaml')] + spec_paths
+
+  log_fp = open(os.path.join(work_dir, 'templateman.log'), 'w')
+
+  started = time.time()
+  process = subprocess.Popen(args, cwd=ROOT, stdout=log_fp, stderr=subprocess.STDOUT)
+  (pid, status, usage) = os.wait4(process.pid, 0)
+  wall_seconds = time.time() - started
+
+  log_fp.close()
+
+  if status != 0:
+    raise Exception('templateman.py failed (exit %s), see: %s' % (status, os.path.join(work_dir, 'templateman.log')))
+
+  spans = json.load(open(profile_path))
+
+  stages = {}
+  StageSeconds(spans, stages)
+
+  rows = QueryRows(spans)
+
+  return {
+    'wall_seconds': wall_seconds,
+    'rows': rows,
+    'rows_per_second': rows / max(wall_seconds, 1e-9),
+    # Linux reports kilobytes
+    'peak_rss_kb': usage.ru_maxrss,
+    'stages': stages,
+  }
+
+
+def Change(value, baseline_value):
+  """Returns string, the percent change from the baseline value."""
+  if not baseline_value:
+    return ''
+
+  return '%+.1f%%' % ((value - baseline_value) * 100.0 / baseline_value)
+
+
+def Main(args):
+  sizes = DEFAULT_SIZES
+  formats = DEFAULT_FORMATS
+  baseline_path = DEFAULT_BASELINE
+  save_baseline = False
+  max_regression = None
+  keep = False
+
+  (options, args) = getopt.getopt(args, 'h', ['help', 'sizes=', 'formats=', 'baseline=', 'save-baseline',
+                                              'max-regression=', 'keep'])
+
+  for (option, value) in options:
+    if option in ('-h', '--help'):
+      print __doc__
+      sys.exit(0)
+    elif option == '--sizes':
+      sizes = [int(size) for size in value.split(',')]
+    elif option == '--formats':
+      formats = value.split(',')
+    elif option == '--baseline':
+      baseline_path = value
+    elif option == '--save-baseline':
+      save_baseline = True
+    elif option == '--max-regression':
+      max_regression = float(value)
+    elif option == '--keep':
+      keep = True
+
+  baseline = {}
+  if os.path.isfile(baseline_path) and not save_baseline:
+    baseline = json.load(open(baseline_path))
+
+  elif not save_baseline:
+    print 'No baseline: %s  (changes are not reported, record one with --save-baseline)' % baseline_path
+    print
+
+  results = {}
+  regressions = []
+
+  print '%-22s %9s %10s %12s %10s  %-8s  %s' % ('Case', 'Wall', 'Rows', 'Rows/s', 'Peak RSS', 'Change', 'Stages')
+
+  for file_format in formats:
+    for size in sizes:
+      work_dir = tempfile.mkdtemp(prefix='templateman_inventory_')
+
+      try:
+        cases = WriteInventory(work_dir, size, file_format)
+
+        for (case_name, spec_paths) in sorted(cases.items()):
+          key = '%s/%s/%s' % (case_name, file_format, size)
+          result = RunCase(work_dir, spec_paths)
+          results[key] = result
+
+          # Cases without a baseline can not regress, but are reported as failures when checking for regressions
+          change = ''
+          if key not in baseline:
+            if max_regression != None:
+              regressions.append('%s: no baseline' % key)
+
+          else:
+            change = Change(result['wall_seconds'], baseline[key]['wall_seconds'])
+
+            if max_regression != None and result['wall_seconds'] > baseline[key]['wall_seconds'] * (1 + max_regression / 100.0):
+              regressions.append('%s: %s' % (key, change))
+
+          stages = ' '.join(['%s=%.3f' % (stage.replace(' ', '_'), seconds)
+                             for (stage, seconds) in sorted(result['stages'].items())])
+
+          print '%-22s %8.3fs %10d %12.0f %8.1fMB  %-8s  %s' % (key, result['wall_seconds'], result['rows'],
+                                                                result['rows_per_second'],
+                                                                result['peak_rss_kb'] / 1024.0, change, stages)
+
+      finally:
+        if keep:
+          print '  (kept: %s)' % work_dir
+        else:
+          shutil.rmtree(work_dir)
+
+  if save_baseline:
+    fp = open(baseline_path, 'w')
+    json.dump(results, fp, indent=2, sort_keys=True, separators=(',', ': '))
+    fp.write('\n')
+    fp.close()
+
+    print
+    print 'Saved baseline: %s' % baseline_path
+
+  if regressions:
+    print
+    print 'ERROR: Slower than the baseline by more than %s%%, or not in it:\n  %s' % (max_regression,
+                                                                                  '\n  '.join(regressions))
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  Main(sys.argv[1:])
@@ -0,0 +1,121 @@
+#!/usr/bin/env python2
+"""
+Relationship Join Benchmark
+
+Joins synthetic machines to services (and services to environments, to exercise chained relationships) through the
+file datasource hash join, compares a sample of the result with a nested loop join, and reports timings.
+
+usage: benchmarks/relationship_join.py [machines] [services] [nested_loop_sample]
+"""
+
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from util import file_datasource
+
+
+def WriteJson(path, records):
+  fp = open(path, 'w')
+  json.dump(records, fp)
+  fp.close()
+
+
+def NestedLoopJoin(records, field, targets, target_field):
+  """Reference join: scan every target for every record."""
+  joined = []
+
+  for record in records:
+    record = dict(record)
+
+    for target in targets:
+      if target.get(target_field, None) == record.get(field, None):
+        for (key, value) in target.items():
+          record['%s.%s' % (field, key)] = value
+        break
+
+    joined.append(record)
+
+  return joined
+
+
+def Main(args):
+  machine_count = 100000
+  service_count = 1000
+  sample_count = 2000
+
+  if len(args) > 0:
+    machine_count = int(args[0])
+  if len(args) > 1:
+    service_count = int(args[1])
+  if len(args) > 2:
+    sample_count = int(args[2])
+
+  temp_dir = tempfile.mkdtemp(prefix='templateman_bench_')
+
+  try:
+    environments = [{'id': index, 'name': 'env-%d' % index} for index in range(10)]
+    services = [{'id': index, 'name': 'service-%d' % index, 'port': 8000 + index, 'environment': index % 10}
+                for index in range(service_count)]
+    machines = [{'id': index, 'name': 'machine-%06d' % index, 'service': index % service_count}
+                for index in range(machine_count)]
+
+    WriteJson(os.path.join(temp_dir, 'environments.json'), environments)
+    WriteJson(os.path.join(temp_dir, 'services.json'), services)
+    WriteJson(os.path.join(temp_dir, 'machines.json'), machines)
+
+    datasources = {
+      'environments': {'type': 'json', 'path': os.path.join(temp_dir, 'environments.json')},
+      'services': {'type': 'json', 'path': os.path.join(temp_dir, 'services.json'),
+                   'relationship': {'environment': 'environments.id'}},
+      'machines': {'type': 'json', 'path': os.path.join(temp_dir, 'machines.json'),
+                   'relationship': {'service': 'services.id'}},
+    }
+    for (name, datasource) in datasources.items():
+      datasource['name'] = name
+
+    print 'Machines: %s  Services: %s' % (machine_count, service_count)
+    print
+
+    # Load the files first, so the timings are only the join
+    for datasource in datasources.values():
+      file_datasource.Load(datasource['path'], datasource['type'])
+
+    started = time.time()
+    result = file_datasource.Query(datasources['machines'], None, datasources)
+    join_time = time.time() - started
+    print 'Hash join, first spec (builds indexes):   %8.3fs  %10.0f rows/s' % (join_time, machine_count / join_time)
+
+    started = time.time()
+    file_datasource.Query(datasources['machines'], {'service.environment.name': 'env-3'}, datasources)
+    shared_time = time.time() - started
+    print 'Hash join, later spec (shared, filtered):  %8.3fs' % shared_time
+
+    # The nested loop is too slow for the full set, so compare and time a sample
+    sample = file_datasource.Load(datasources['machines']['path'], 'json')[:sample_count]
+    services_joined = file_datasource.LoadRecords(datasources['services'], datasources)[2]
+
+    started = time.time()
+    expected = NestedLoopJoin(sample, 'service', services_joined, 'id')
+    nested_time = time.time() - started
+    nested_rate = sample_count / nested_time
+    print 'Nested loop join, %6d row sample:      %8.3fs  %10.0f rows/s  (~%.1fs for all rows)' % (
+        sample_count, nested_time, nested_rate, machine_count / nested_rate)
+
+    if expected != result[:sample_count]:
+      print
+      print 'ERROR: Hash join result differs from nested loop join'
+      sys.exit(1)
+
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+  Main(sys.argv[1:])
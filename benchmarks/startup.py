@@ -0,0 +1,158 @@
+#!/usr/bin/env python2
+"""
+Startup Benchmark
+
+Times how long a new templateman.py process takes to render its first output: one spec of a small synthetic inventory
+(see benchmarks/inventory.py), as a cron invocation would.  Each case is run with no precompiled cache, with a cold
+(empty) --precompiled-dir, and with a warm one, and the outputs of every run are verified to be byte-identical.
+
+usage: benchmarks/startup.py [options]
+
+Options:
+  --size=[n]                Machine count of the inventory (default: 1000)
+  --format=[f]              Data file format: json, yaml, sqlite (default: json)
+  --runs=[n]                Runs of each case, the minimum and median are reported (default: 10)
+"""
+
+
+import getopt
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from inventory import ROOT, WriteInventory
+
+
+# Cases, in the order they are reported
+CACHES = ['none', 'cold', 'warm']
+
+DEFAULT_SIZE = 1000
+DEFAULT_FORMAT = 'json'
+DEFAULT_RUNS = 10
+
+
+def RunSpec(work_dir, spec_path, precompiled_dir=None):
+  """Render a spec with templateman.py in a new process.
+
+  Returns: (wall_seconds, outputs), outputs is dict: output file name -> text
+  """
+  out_dir = os.path.join(work_dir, 'out')
+  if os.path.isdir(out_dir):
+    shutil.rmtree(out_dir)
+
+  args = [sys.executable, os.path.join(ROOT, 'templateman.py'), '--no-cache',
+          '--datasources=%s' % os.path.join(work_dir, 'datasources.yaml'),
+          '--commands=%s' % os.path.join(ROOT, 'conf', 'commands.yaml')]
+
+  if precompiled_dir:
+    args.append('--precompiled-dir=%s' % precompiled_dir)
+
+  args.append(spec_path)
+
+  log_fp = open(os.path.join(work_dir, 'templateman.log'), 'w')
+
+  started = time.time()
+  status = subprocess.call(args, cwd=ROOT, stdout=log_fp, stderr=subprocess.STDOUT)
+  wall_seconds = time.time() - started
+
+  log_fp.close()
+
+  if status != 0:
+    raise Exception('templateman.py failed (exit %s), see: %s' % (status, os.path.join(work_dir, 'templateman.log')))
+
+  outputs = {}
+  for filename in os.listdir(out_dir):
+    outputs[filename] = open(os.path.join(out_dir, filename)).read()
+
+  return (wall_seconds, outputs)
+
+
+def Interpreter():
+  """Returns float, seconds to start and exit the Python interpreter, for reference."""
+  started = time.time()
+  subprocess.call([sys.executable, '-c', 'pass'])
+
+  return time.time() - started
+
+
+def Main(args):
+  size = DEFAULT_SIZE
+  file_format = DEFAULT_FORMAT
+  runs = DEFAULT_RUNS
+
+  (options, args) = getopt.getopt(args, 'h', ['help', 'size=', 'format=', 'runs='])
+
+  for (option, value) in options:
+    if option in ('-h', '--help'):
+      print __doc__
+      sys.exit(0)
+    elif option == '--size':
+      size = int(value)
+    elif option == '--format':
+      file_format = value
+    elif option == '--runs':
+      runs = int(value)
+
+  work_dir = tempfile.mkdtemp(prefix='templateman_startup_')
+
+  try:
+    cases = WriteInventory(work_dir, size, file_format)
+
+    print 'Inventory: %s machines, %s  Runs: %s  Interpreter: %.3fs' % (size, file_format, runs,
+                                                                      min([Interpreter() for _ in range(runs)]))
+    print
+    print '%-12s %-6s %9s %9s  %s' % ('Spec', 'Cache', 'Min', 'Median', 'Change')
+
+    for (case_name, spec_paths) in sorted(cases.items()):
+      spec_path = spec_paths[0]
+      precompiled_dir = os.path.join(work_dir, 'precompiled')
+
+      expected = None
+      medians = {}
+
+      for cache in CACHES:
+        timings = []
+
+        for _ in range(runs):
+          # A cold cache is emptied before every run, a warm one is filled by the run before the first
+          if cache == 'cold' or (cache == 'warm' and not timings):
+            if os.path.isdir(precompiled_dir):
+              shutil.rmtree(precompiled_dir)
+
+          if cache == 'warm' and not timings:
+            RunSpec(work_dir, spec_path, precompiled_dir)
+
+          if cache == 'none':
+            (seconds, outputs) = RunSpec(work_dir, spec_path)
+          else:
+            (seconds, outputs) = RunSpec(work_dir, spec_path, precompiled_dir)
+
+          if expected == None:
+            expected = outputs
+          elif outputs != expected:
+            print 'ERROR: Output differs: %s: %s cache' % (case_name, cache)
+            sys.exit(1)
+
+          timings.append(seconds)
+
+        timings.sort()
+        medians[cache] = timings[len(timings) / 2]
+
+        change = ''
+        if cache != 'none':
+          change = '%+.1f%%' % ((medians[cache] - medians['none']) * 100.0 / medians['none'])
+
+        print '%-12s %-6s %8.3fs %8.3fs  %s' % (case_name, cache, timings[0], medians[cache], change)
+
+    print
+    print 'Outputs identical'
+
+  finally:
+    shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+  Main(sys.argv[1:])
@@ -0,0 +1,111 @@
+#!/usr/bin/env python2
+"""
+Substitution Benchmark
+
+Substitutes a spec's static data and sub-spec outputs into synthetic zone file output with the legacy passes (one
+replace() per data key, then a scan for the spec keys), and with templateman.SubstituteChunk(): one pass for the
+wrapper's parts, and the data replaced one key at a time for the chunks of rows.  Reports timings.  The outputs are
+tested in tests/test_substitute.py.
+
+usage: benchmarks/substitution.py [rows]
+"""
+
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import templateman
+from util.template import SLOT_REGEX
+
+
+# Static data of the benchmark spec, as in a zone file header
+DATA = {'serial': 2015010100, 'domain': 'prod.your.domain.com', 'ttl': 300, 'admin': 'hostmaster'}
+
+# Sub-spec outputs of the benchmark spec
+SPEC_OUTPUTS = {
+  'header': '$TTL 300\n@ IN SOA ns1.prod.your.domain.com. hostmaster.prod.your.domain.com. ( 2015010100 )\n',
+  'static': 'ns1\tIN\tA\t10.0.0.1\nns2\tIN\tA\t10.0.0.2\n',
+}
+
+# Rows in each chunk of output, as rendered by CompiledTemplate.IterRenderRows()
+CHUNK_ROWS = 1000
+
+
+def LegacySubstitute(text, data, spec_outputs):
+  """The original data and specs passes, timed for comparison."""
+  for (data_key, data_value) in data.items():
+    key_str = '%%(%s)s' % data_key
+    if key_str in text:
+      text = text.replace(key_str, str(data_value))
+
+  output = ''
+  position = 0
+  for match in SLOT_REGEX.finditer(text):
+    if match.group(1) not in spec_outputs:
+      continue
+
+    output += text[position:match.start()] + spec_outputs[match.group(1)]
+    position = match.end()
+
+  return output + text[position:]
+
+
+def Substitute(text, data, spec_outputs, rows=False):
+  """Returns string, the text substituted by templateman.SubstituteChunk().
+
+  Args:
+    rows: boolean, True if the text is a chunk of rendered rows
+  """
+  spec_data = {'data': data, 'specs': dict([(key, None) for key in spec_outputs])}
+
+  return ''.join(templateman.SubstituteChunk(text, spec_data, dict(spec_outputs), set(), {}, {}, rows=rows))
+
+
+def ZoneChunks(count, row_slot):
+  """Returns list of strings, the chunks of a rendered forward zone: the wrapper's parts around chunks of rows.
+
+  Args:
+    row_slot: boolean, if True each row has a static data slot, otherwise only the wrapper has slots
+  """
+  if row_slot:
+    row_format = 'host-%07d\t%%(ttl)s\tIN\tA\t10.%d.%d.%d\n'
+  else:
+    row_format = 'host-%07d\t300\tIN\tA\t10.%d.%d.%d\n'
+
+  rows = [row_format % (index, (index >> 16) & 255, (index >> 8) & 255, index & 255) for index in range(count)]
+
+  chunks = ['%(header)s\n; serial %(serial)s for %(domain)s\n']
+  for start in range(0, count, CHUNK_ROWS):
+    chunks.append(''.join(rows[start:start + CHUNK_ROWS]))
+  chunks.append('%(static)s\n; %(admin)s\n')
+
+  return chunks
+
+
+def Main(args):
+  if args:
+    count = int(args[0])
+  else:
+    count = 100000
+
+  for row_slot in (False, True):
+    chunks = ZoneChunks(count, row_slot)
+
+    print 'Rows: %s  Data slot in each row: %s  Output: %.1f MB' % (count, row_slot,
+                                                                   sum([len(chunk) for chunk in chunks]) / 1048576.0)
+
+    started = time.time()
+    ''.join([LegacySubstitute(chunk, DATA, SPEC_OUTPUTS) for chunk in chunks])
+    print '  %-12s %.3fs' % ('legacy', time.time() - started)
+
+    # The chunks between the first and last are rows
+    started = time.time()
+    ''.join([Substitute(chunk, DATA, SPEC_OUTPUTS, 0 < index < len(chunks) - 1) for (index, chunk) in enumerate(chunks)])
+    print '  %-12s %.3fs' % ('single pass', time.time() - started)
+
+
+if __name__ == '__main__':
+  Main(sys.argv[1:])
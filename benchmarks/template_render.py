@@ -0,0 +1,122 @@
+#!/usr/bin/env python2
+"""
+Template Rendering Benchmark
+
+Renders the example row templates over synthetic rows with the legacy per-row str.replace() loop, with the compiled
+template over dict rows, and with the compiled template over tuple rows (util/rows.py), verifies the outputs are
+byte-identical, and reports timings.
+
+usage: benchmarks/template_render.py [rows]
+"""
+
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from util.rows import Rows
+from util.template import CompileTemplate
+
+
+# Example templates rendered by the benchmark, relative to the repo root
+TEMPLATE_PATHS = [
+  'example-templates/prod_named_master/zone_forward_machine',
+  'example-templates/prod_named_master/zone_reverse_machine',
+  'example-templates/haproxy/app_http',
+  'example-templates/prod_app_vhost/app_httpd_vhost_product',
+]
+
+
+def LegacyRenderRows(template, data):
+  """The original TemplateFromSpec row loop, kept here as the reference output."""
+  output = ''
+
+  for item in data:
+    item_output = str(template)
+
+    for (key, value) in item.items():
+      key_str = '%%(%s)s' % key
+      if key_str in template:
+        item_output = item_output.replace(key_str, str(value))
+
+    output += item_output
+
+  return output
+
+
+def SyntheticRows(count):
+  """Returns list of dicts, machine/product like rows with the fields the example templates use, plus unused ones."""
+  rows = []
+
+  for index in range(count):
+    rows.append({
+      'id': index,
+      'name': 'app-%06d' % index,
+      'alias': 'product%d' % index,
+      'ip_private': '10.%d.%d.%d' % ((index >> 16) & 255, (index >> 8) & 255, index & 255),
+      'ip_address': '10.%d.%d.%d' % ((index >> 16) & 255, (index >> 8) & 255, index & 255),
+      'octet2': (index >> 16) & 255,
+      'octet3': (index >> 8) & 255,
+      'octet4': index & 255,
+      'service': index % 30,
+      'location': 3,
+      'is_deployed': True,
+    })
+
+  return rows
+
+
+def TupleRows(data):
+  """Returns Rows, the same rows as column names and value tuples."""
+  columns = sorted(data[0].keys())
+
+  return Rows(columns, [tuple([item[column] for column in columns]) for item in data])
+
+
+def Timed(function, *args):
+  """Returns (result, seconds) of calling function."""
+  started = time.time()
+  result = function(*args)
+  return (result, time.time() - started)
+
+
+def Main(args):
+  if args:
+    count = int(args[0])
+  else:
+    count = 50000
+
+  root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+  data = SyntheticRows(count)
+  tuple_data = TupleRows(data)
+
+  failed = False
+
+  print 'Rows: %s' % count
+  print
+  print '%-60s %10s %10s %10s %8s  %s' % ('Template', 'Legacy', 'Compiled', 'Tuples', 'Speedup', 'Identical')
+
+  for path in TEMPLATE_PATHS:
+    template = open(os.path.join(root, path)).read()
+
+    (legacy_output, legacy_time) = Timed(LegacyRenderRows, template, data)
+    (compiled_output, compiled_time) = Timed(lambda: CompileTemplate(template).RenderRows(data))
+    (tuple_output, tuple_time) = Timed(lambda: CompileTemplate(template).RenderRows(tuple_data))
+
+    identical = legacy_output == compiled_output == tuple_output
+    if not identical:
+      failed = True
+
+    print '%-60s %9.3fs %9.3fs %9.3fs %7.1fx  %s' % (path, legacy_time, compiled_time, tuple_time,
+                                                     legacy_time / max(tuple_time, 1e-9), identical)
+
+  if failed:
+    print
+    print 'ERROR: Compiled output differs from legacy output'
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  Main(sys.argv[1:])
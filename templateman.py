@@ -21,23 +21,56 @@ __author__ = 'Geoff Howland <geoff@gmail.com>'
 import sys
 import os
 import getopt
-import yaml
+import hashlib
+import itertools
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import re
+import time
 
 import util
-from util.log import log
+from util.log import log, Brief, FlushLog, SetLogOptions, StartLogCapture, StopLogCapture, WriteLog
+from util.log import DEBUG, INFO, WARNING, ERROR, LEVEL_NAMES
 from util import query
-from util.regex import SanitizeRegex
+from util import cache
+from util import manifest
+from util import watch
+from util import timing
+from util import snapshot
+from util import precompiled
+from util.output import WriteChunks
+from util.template import SLOT_REGEX
+from util.context import RunContext, FileKey
 
 
 # If a directory for a target path is not found, create it and set it's mode to this
 DIRECTORY_MODE = 0755
 
+# Directory of this file, whose conf/ has the default datasources and commands, however templateman is run or imported
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Command line long options, also the option names of the Render() API
+LONG_OPTIONS = ['help', 'verbose', 'stdout', 'no-output-file', 'datasources=', 'commands=', 'jobs=', 'threads=',
+                'manifest=', 'force', 'no-cache', 'cache-dir=', 'watch', 'watch-interval=', 'profile', 'profile-json=',
+                'precompiled-dir=', 'log-level=', 'log-json=']
+
+# Chunks of output with more slots than this, and all chunks of rows, have their static data replaced one key at a time,
+#   instead of in one pass with the sub-specs, as replace() is faster for many slots (see SubstituteChunk())
+SINGLE_PASS_MAX_SLOTS = 64
+
+# State inherited by the worker processes of RenderSpecDataParallel(): (spec_path, spec_data_list, datasources, options)
+WORKER_STATE = None
+
 
 class ConfigurationError(Exception):
   """Failure of syntax or completeness of a spec files configuration."""
 
 
+class ParallelRenderError(Exception):
+  """One or more outputs rendered by parallel jobs failed."""
+
+
 class NoDataSource:
   """No data source was specified for our data.  So it's not an empty data set, its no data requested."""
 
@@ -53,7 +86,7 @@ def GetSpecData(spec_path, options):
 
 
   try:
-    spec_data = yaml.load(open(spec_path))
+    spec_data = options['context'].LoadYaml(spec_path)
     
   except Exception, e:
     Usage('Spec file is not a YAML file or has a formatting error: %s: %s' % (spec_path, e), options=options)
@@ -64,7 +97,7 @@ def GetSpecData(spec_path, options):
 
   # If the Data Source path does not exist
   if not os.path.exists(options['datasources']):
-    Usage('Spec file "%s" does not exist' % options['datasources'], options=options)
+    Usage('Datasource file not found: %s' % options['datasources'], options=options)
 
 
   return spec_data
@@ -82,8 +115,17 @@ def GetData(spec_data, datasources, options):
 
   #log('Source: %s' % datasource)
 
+  # Results of "batch filter" outputs were queried together (see BatchOutputs())
+  batch_results = options.get('batch_results', None)
+  if datasource and batch_results and cache.MakeKey(datasource, spec_data['filter']) in batch_results:
+    data = batch_results[cache.MakeKey(datasource, spec_data['filter'])]
+  
+  # Results already fetched to fingerprint this output are rendered, not queried again (see FingerprintSpec())
+  elif datasource and cache.MakeKey(datasource, spec_data['filter']) in options.get('fetched_results', {}):
+    data = options['fetched_results'][cache.MakeKey(datasource, spec_data['filter'])]
+  
   # Query the datasource for the data, if a data source was specified
-  if datasource:
+  elif datasource:
     data = query.Query(datasource, spec_data)
   
   # Else, no data, raw source templating
@@ -99,58 +141,191 @@ def TemplateFromSpecPath(spec_path, datasources, options):
   spec_data = GetSpecData(spec_path, options)
   
   return TemplateFromSpec(spec_path, spec_data, datasources, options)
+
+
+def IterTemplateFromSpecPath(spec_path, datasources, options):
+  """Template this spec path, after loading it, yielding the output in chunks."""
+  spec_data = GetSpecData(spec_path, options)
+  
+  return IterTemplateFromSpec(spec_path, spec_data, datasources, options)
   
 
-def TemplateFromCommands(template, options, depth=0, path=None):
-  if depth > 50:
-    log('WARNING: Maximum depth execeeded (%s) in TemplateFromCommands: %s' % (depth, path))
-    return template
+def CompileCommands(commands):
+  """Compile the commands (commands.yaml) into one scanner, so a template is searched once for all of them.
+  
+  Each command is one alternative, with its argument as a group.  An argument can contain other commands, so a
+  comment wrapped around an include turns the include off.
   
-  # Find Template commands in our template
-  commands_found = {}
-  for (command, command_data) in options['commands'].items():
-    regex = '%s(.*?)%s' % (SanitizeRegex(command_data['prefix']), SanitizeRegex(command_data['postfix']))
-    regex_result = re.findall(regex, template)
+  Returns: tuple (regex, command_names), command_names[N] is the command whose argument is regex group N+1
+  """
+  command_names = sorted(commands)
+  
+  # Any complete command, allowed inside an argument
+  nested = '|'.join(['%s.*?%s' % (re.escape(commands[name]['prefix']), re.escape(commands[name]['postfix']))
+                     for name in command_names])
+  
+  alternatives = []
+  for name in command_names:
+    alternatives.append('%s((?:%s|.)*?)%s' % (re.escape(commands[name]['prefix']), nested,
+                                              re.escape(commands[name]['postfix'])))
+  
+  return (re.compile('|'.join(alternatives)), command_names)
+
+
+def TokenizeCommands(template, commands_regex):
+  """Returns list, the template split into its text (strings) and the commands (commands.yaml) embedded in it (tuples:
+  command, argument, command text), so it is scanned once.
+  
+  Args:
+    commands_regex: tuple, CompileCommands() of the commands
+  """
+  (regex, command_names) = commands_regex
+  
+  tokens = []
+  position = 0
+  for match in regex.finditer(template):
+    if match.start() > position:
+      tokens.append(template[position:match.start()])
     
-    commands_found[command] = regex_result
+    tokens.append((command_names[match.lastindex - 1], match.group(match.lastindex), match.group(0)))
+    position = match.end()
+  
+  if position < len(template):
+    tokens.append(template[position:])
+  
+  return tokens
 
 
-  # Include other files
-  if 'include' in commands_found:
-    for path in commands_found['include']:
-      # If this is a valid file, load it and include it (with it's own TemplateFromCommands processing)
-      if os.path.isfile(path):
-        # Load the template
-        include_template = open(path).read()
-        
-        # Process any commands embedded in this template
-        include_template = TemplateFromCommands(include_template, options, depth=depth+1, path=path)
-        
-        # Build the replacement string
-        insert_replace = '%s%s%s' % (options['commands']['include']['prefix'], path, options['commands']['include']['postfix'])
-        
-        # Insert into our current template
-        template = template.replace(insert_replace, include_template)
-        
-      else:
-        log('WARNING: INCLUDE path not found: %s' % path)
+def TemplateTokens(path, options):
+  """Returns list, TokenizeCommands() of a template or include file.
+  
+  Files are tokenized once per run, and kept in the precompiled cache (--precompiled-dir) between runs, until they or
+  the commands change.
+  """
+  commands_regex = options['commands_regex']
+  
+  return options['context'].Load(path, 'tokens', lambda text: TokenizeCommands(text, commands_regex),
+                                 salt=commands_regex[0].pattern, precompile=True)
+
+
+def TemplateFromCommands(template, options, include_stack=()):
+  """Process the commands (commands.yaml) embedded in template text.  See TemplateFromTokens().
   
+  Returns: string, the template with its commands processed
+  """
+  return TemplateFromTokens(TokenizeCommands(template, options['commands_regex']), options, include_stack)
+
+
+def TemplateFromTokens(tokens, options, include_stack=()):
+  """Process the commands (commands.yaml) embedded in a template, from its TokenizeCommands() tokens.
+  
+  Includes are replaced with their file's text, after processing its own commands.  Processes are replaced with their
+  spec's rendered output.  Each include file and processed spec is only rendered once per run, and reused until it
+  changes.  Comments are removed.
+  
+  Args:
+    include_stack: tuple, absolute paths of the include files being processed, to detect include cycles
   
-  # Comments -- Wipe them out, they are made to disappear
-  if 'comment' in commands_found:
-    for path in commands_found['comment']:
-      # Build the replacement string
-      insert_replace = '%s%s%s' % (options['commands']['comment']['prefix'], path, options['commands']['comment']['postfix'])
+  Returns: string, the template with its commands processed
+  """
+  def ProcessCommand(command, argument, command_text):
+    # Include other files
+    if command == 'include':
+      # If this is a valid file, load it and include it (with it's own TemplateFromTokens processing)
+      if os.path.isfile(argument):
+        return IncludeTemplate(argument, options, include_stack)
       
-      # Empty out the Comment statement
-      template = template.replace(insert_replace, '')
+      else:
+        log('WARNING: INCLUDE path not found: %s' % argument, level=WARNING)
+    
+    # Comments -- Wipe them out, they are made to disappear
+    elif command == 'comment':
+      return ''
+    
+    # Process TemplateMan spec in-place
+    elif command == 'process':
+      if os.path.isfile(argument):
+        return ProcessTemplate(argument, options)
+      
+      else:
+        log('WARNING: PROCESS spec path not found: %s' % argument, level=WARNING)
+    
+    # Leave anything we cant process in place
+    return command_text
+  
+  with timing.Start('commands'):
+    pieces = []
+    for token in tokens:
+      if isinstance(token, basestring):
+        pieces.append(token)
+      else:
+        pieces.append(ProcessCommand(*token))
+    
+    return ''.join(pieces)
+
+
+def IncludeTemplate(path, options, include_stack=()):
+  """Returns string, the text of an include file with its own commands processed.
+  
+  Processed includes are kept in the run context by path, mtime and size, so each file is only read and processed once
+  per run.
+  """
+  key = FileKey(path)
+  abs_path = key[0]
+  
+  if abs_path in include_stack:
+    raise ConfigurationError('INCLUDE cycle: %s' % ' -> '.join(include_stack + (abs_path,)))
+  
+  includes = options['context'].includes
+  if key not in includes:
+    includes[key] = TemplateFromTokens(TemplateTokens(path, options), options, include_stack + (abs_path,))
+  
+  return includes[key]
 
+
+def ProcessTemplate(spec_path, options):
+  """Returns string, the rendered output of a %%PROCESS%% spec.
+  
+  Specs are rendered once per run, with the datasources already loaded for the spec being processed, and kept in the
+  run context by path, mtime and size.  The specs being processed are carried in options['process_stack'] to detect
+  cycles, as sub-specs may be rendered in other threads.
+  """
+  key = FileKey(spec_path)
+  abs_path = key[0]
+  process_stack = options.get('process_stack', ())
   
-  # Process TemplateMan spec in-place
-  if 'process' in commands_found and commands_found['process']:
-    log('ERROR: Processing commands found, but this is not yet implemented...')
+  if abs_path in process_stack:
+    raise ConfigurationError('PROCESS cycle: %s' % ' -> '.join(process_stack + (abs_path,)))
+  
+  # Not locked, so sub-specs rendered in other threads can process specs too.  At worst a spec is rendered twice.
+  processed = options['context'].processed
+  if key not in processed:
+    process_options = dict(options)
+    process_options['process_stack'] = process_stack + (abs_path,)
+    
+    processed[key] = TemplateFromSpecPath(spec_path, query.DATASOURCES, process_options)
+  
+  return processed[key]
 
-  return template
+
+def SubSpecTemplate(spec_path, datasources, options):
+  """Returns string, the rendered output of a sub-spec.
+  
+  Sub-specs used more than once in the run (see SharedSpecs()) are rendered once, and kept in the run context by path,
+  mtime and size.  Their output does not depend on the spec using them, as sub-specs are rendered from their own spec
+  data.
+  """
+  if os.path.abspath(spec_path) not in options['context'].shared:
+    return TemplateFromSpecPath(spec_path, datasources, options)
+  
+  key = FileKey(spec_path)
+  
+  # Not locked, like ProcessTemplate().  At worst a sub-spec is rendered twice.
+  rendered = options['context'].rendered
+  if key not in rendered:
+    rendered[key] = TemplateFromSpecPath(spec_path, datasources, options)
+  
+  return rendered[key]
 
 
 def TemplateFromSpec(spec_path, spec_data, datasources, options):
@@ -158,174 +333,921 @@ def TemplateFromSpec(spec_path, spec_data, datasources, options):
 
   Returns: string, output of templating operation
   """
+  return ''.join(IterTemplateFromSpec(spec_path, spec_data, datasources, options))
+
+
+def IterTemplateFromSpec(spec_path, spec_data, datasources, options):
+  """Process the templating based on the spec path and options, yielding the output in chunks.
+
+  Rows are rendered in batches as they are pulled from the data, and a sub-spec used once in the template wrapper is
+  streamed in place, so the full output is never held in memory.
+
+  Returns: iterator of strings, chunks of the output of templating operation
+  """
+  span = timing.Start('template', spec_data.get('name', spec_path))
+  
+  return timing.TimedIter(span, IterTemplateChunks(spec_path, spec_data, datasources, options))
+
+
+def IterTemplateChunks(spec_path, spec_data, datasources, options):
+  """Yields strings, the chunks of output for IterTemplateFromSpec()."""
   log('Templating: %s: %s' % (spec_data.get('name', '** "name" value not specified in spec **'), spec_path))
   #log('Sources: %s' % datasources)
 
   # Get our data, from specified source, with specified filter
   data = GetData(spec_data, datasources, options)
 
-  # Create an empty output string to append to
-  output = ''
-
-  # Fetch the template, if it exists, otherwise there is no generated templating
+  # Fetch the template's text and commands, if it exists, otherwise there is no generated templating
   if spec_data.get('template', None):
-    template = open(spec_data['template']).read()
+    template_tokens = TemplateTokens(spec_data['template'], options)
   else:
-    log('WARNING: Using empty template text')
-    template = ''
+    log('WARNING: Using empty template text', level=WARNING)
+    template_tokens = []
 
 
   # Process any template commands that are embedded in this template, to construct a larger/deeper template, before
   #   the spec keys are processed (below)
-  template = TemplateFromCommands(template, options)
+  template = TemplateFromTokens(template_tokens, options)
 
 
   # If we dont have any data source, the template is our output to start working
   if data == NoDataSource:
-    output = template
+    rows = [template]
   
-  # Else, Template each item in data (rows)
+  # Else, Template each item in data (rows), with the template parsed once into its slots for the run
   else:
-    for item in data:
-      item_output = str(template)
-      
-      # Template each key in item (columns)
-      for (key, value) in item.items():
-        key_str = '%%(%s)s' % key
-        if key_str in template:
-          item_output = item_output.replace(key_str, str(value))
-      
-      # Output the item...
-      output += item_output
+    rows = options['context'].CompileTemplate(template).IterRenderRows(data)
 
   
-  # If we have a template wrapper
+  # If we have a template wrapper, the rows are output between the parts around its "%(template)s"
   #NOTE(ghowland): This stage must be second-to-last, as it wraps the generated template results in a pre-formatted template
   if spec_data.get('template wrapper', None):
-    template_wrapper = open(spec_data['template wrapper']).read()
+    template_wrapper = options['context'].ReadFile(spec_data['template wrapper'])
 
     if '%(template)s' not in template_wrapper:
       raise ConfigurationError('Spec data contained "template wrapper" statement, but file does not contain "%(template)s" string.  To use this without templated item generation, make template empty or do not add it, and add "%(template)s" anywhere and it will be empty.')
 
-    # Replace the output with the template wrapper, and output inside it
-    output = template_wrapper.replace('%(template)s', output)
+    wrapper_parts = template_wrapper.split('%(template)s')
+    
+    # Wrapping in more than one place repeats the rows, so they are rendered in full once
+    if len(wrapper_parts) > 2:
+      rows = [''.join(rows)]
+  
+  else:
+    template_wrapper = ''
+    wrapper_parts = ['', '']
 
 
-  # If we are being passed optional data
+  # If we are being passed optional data, update a copy of our current data with it, as spec data is shared for the run
   if 'data' in options:
-    # Update our current data with it, if existing
-    if 'data' in spec_data:
-      spec_data['data'].update(options['data'])
-    # Make a new dict for it, if not existing
-    else:
-      spec_data['data'] = dict(options['data'])
+    spec_data = dict(spec_data)
+    spec_data['data'] = dict(spec_data.get('data', None) or {})
+    spec_data['data'].update(options['data'])
 
 
-  # If we have data to template into this spec template (Static text variables)
-  #NOTE(ghowland): This must be SECOND TO LAST in process order, because it 
-  #   the specs must come after this.
-  if spec_data.get('data', None):
-    # Process each of the static data replacements
-    for (data_key, data_value) in spec_data['data'].items():
-      # Template the results into our template output
-      key_str = '%%(%s)s' % data_key
-      if key_str in output:
-        output = output.replace(key_str, str(data_value))
+  # Sub-spec outputs, rendered when first used
+  spec_outputs = {}
+  stream_keys = set()
+  
+  # Sub-specs used in the wrapper or template, in the order they are first used
+  used_keys = []
+  for spec_key in spec_data.get('specs', None) or {}:
+    key_str = '%%(%s)s' % spec_key
+    if key_str in template_wrapper or key_str in template:
+      used_keys.append(spec_key)
+  
+  used_keys.sort(key=lambda spec_key: SpecKeyPosition(spec_key, template_wrapper, template))
+  
+  # Render sibling sub-specs concurrently, if we have threads for it, so their queries overlap
+  if options['threads'] > 1 and len(used_keys) > 1:
+    spec_outputs = RenderSpecsConcurrently(spec_data, used_keys, datasources, options)
+  
+  # Else, sub-specs used exactly once, in the wrapper and not the template, are streamed in place instead of held in
+  #   memory.  Sub-specs shared with other specs in the run are kept, so they are rendered once.
+  else:
+    for spec_key in used_keys:
+      key_str = '%%(%s)s' % spec_key
+      if (template_wrapper.count(key_str) == 1 and key_str not in template and
+          os.path.abspath(spec_data['specs'][spec_key]) not in options['context'].shared):
+        stream_keys.add(spec_key)
+  
+  
+  # Output the wrapper parts, with the rows between them
+  for (index, wrapper_part) in enumerate(wrapper_parts):
+    if index > 0:
+      for chunk in rows:
+        for output in SubstituteChunk(chunk, spec_data, spec_outputs, set(), datasources, options, rows=True):
+          yield output
+    
+    for output in SubstituteChunk(wrapper_part, spec_data, spec_outputs, stream_keys, datasources, options):
+      yield output
+
 
+def SpecKeyPosition(spec_key, template_wrapper, template):
+  """Returns tuple, sort key placing a spec key by its first use in the wrapper, then the template."""
+  key_str = '%%(%s)s' % spec_key
+  
+  if key_str in template_wrapper:
+    return (0, template_wrapper.index(key_str))
+  else:
+    return (1, template.index(key_str))
 
-  # If we have specs to template into this spec template (Recursion!)
-  #NOTE(ghowland): This must be LAST in process order, because it 
-  #   operates on the finished output, and requires template wrapping
-  if spec_data.get('specs', None):
-    template_specs = {}
+
+def RenderSpecsConcurrently(spec_data, spec_keys, datasources, options):
+  """Render the sub-specs for spec_keys in a pool of options['threads'] threads.
+  
+  Sub-specs do not depend on each other, so their queries can run at the same time over pooled connections.  Each
+  thread's log messages are held and written in spec_keys order, and the first failure in that order is raised after
+  all sub-specs are finished, so the logs and output match rendering them one at a time.
+  
+  Returns: dict, spec key -> output of that sub-spec
+  """
+  pool = ThreadPool(min(options['threads'], len(spec_keys)))
+  
+  # Timings in the threads are inside this thread's current span
+  parent_span = timing.Current()
+  
+  try:
+    results = pool.map(lambda spec_key: RenderSpecJob(spec_data['specs'][spec_key], datasources, options, parent_span),
+                       spec_keys)
+  finally:
+    pool.close()
+    pool.join()
+  
+  spec_outputs = {}
+  error = None
+  
+  for (spec_key, (log_lines, output, exc_info)) in zip(spec_keys, results):
+    WriteLog(log_lines)
     
-    # Process each of the spec template targets
-    for (spec_key, spec_key_path) in spec_data['specs'].items():
-      # Generate the template output for this spec file
-      template_specs[spec_key] = TemplateFromSpecPath(spec_key_path, datasources, options)
-      
-      # Template the results into our template output
-      key_str = '%%(%s)s' % spec_key
-      if key_str in output:
-        output = output.replace(key_str, str(template_specs[spec_key]))
+    if exc_info and not error:
+      error = exc_info
+    
+    spec_outputs[spec_key] = output
+  
+  if error:
+    raise error[0], error[1], error[2]
+  
+  return spec_outputs
 
-  return output
+
+def RenderSpecJob(spec_path, datasources, options, parent_span=None):
+  """Thread job for RenderSpecsConcurrently(), renders one sub-spec path.
+  
+  Returns: tuple (log_lines, output, exc_info), exc_info is None if successful
+  """
+  StartLogCapture()
+  timing.Attach(parent_span)
+  try:
+    output = SubSpecTemplate(spec_path, datasources, options)
+    exc_info = None
+  
+  # Usage() exits on errors, which must still reach the calling thread
+  except (Exception, SystemExit):
+    output = None
+    exc_info = sys.exc_info()
+  
+  finally:
+    timing.Attach(None)
+  
+  return (StopLogCapture(), output, exc_info)
+
+
+def SubstituteChunk(text, spec_data, spec_outputs, stream_keys, datasources, options, rows=False):
+  """Template a chunk of output with the spec's static data and the outputs of its sub-specs, in one pass over its
+  %(key)s slots.  Data takes precedence over sub-specs with the same key.
+
+  Args:
+    spec_outputs: dict, spec key -> output of that sub-spec, filled in as each sub-spec is first rendered
+    stream_keys: set, spec keys to stream in place instead of rendering in full.  Removed once streamed, so any
+        later use renders the sub-spec in full.
+    rows: boolean, True for chunks of rendered rows, which have their data replaced one key at a time
+  
+  Yields: string, chunks of the templated text
+  """
+  specs = spec_data.get('specs', None) or {}
+  data = dict([('%s' % data_key, data_value) for (data_key, data_value) in (spec_data.get('data', None) or {}).items()])
+  
+  # Nothing to substitute.  Most chunks of rows have no slots, and searching stops at the first one.
+  if '%(' not in text or (not specs and not data):
+    if text:
+      yield text
+    return
+  
+  # Chunks of rows are not scanned for their slots, they have a slot in every row or none.  Other chunks only have
+  #   their first slots scanned for, to find if there are many.
+  if rows:
+    matches = None
+  else:
+    matches = list(itertools.islice(SLOT_REGEX.finditer(text), SINGLE_PASS_MAX_SLOTS + 1))
+  
+  # Static data and sub-specs are substituted in one pass over the slots.  The data is replaced first, one key at a
+  #   time, in chunks of rows or if there are many slots, as replace() is faster than handling each slot.  It also is if
+  #   a data value with a "%" in it, or a "%(" in the text that is not a slot, could make a new slot with the text
+  #   around it, so the output is always the same as substituting the data before the specs.
+  if matches == None or len(matches) > SINGLE_PASS_MAX_SLOTS or (data and (len(matches) != text.count('%(') or
+      any(['%' in '%s' % data_value for data_value in data.values()]))):
+    #NOTE(ghowland): Data must be substituted before the specs, so data keys take precedence over spec keys
+    for (data_key, data_value) in data.items():
+      key_str = '%%(%s)s' % data_key
+      if key_str in text:
+        text = text.replace(key_str, str(data_value))
+    
+    data = {}
+    
+    # Data slots are usually all of the slots in a chunk of rows, searching for any left is faster than scanning
+    if not specs or '%(' not in text:
+      if text:
+        yield text
+      return
+    
+    matches = SLOT_REGEX.finditer(text)
+  
+  # Text between the slots and the data values are joined, sub-spec outputs are yielded as they are, not copied
+  pieces = []
+  position = 0
+  for match in matches:
+    key = match.group(1)
+    
+    if key in data:
+      pieces.append(text[position:match.start()])
+      pieces.append(str(data[key]))
+      position = match.end()
+      continue
+    
+    if key not in specs:
+      continue
+    
+    pieces.append(text[position:match.start()])
+    position = match.end()
+    
+    if pieces:
+      chunk = ''.join(pieces)
+      pieces = []
+      if chunk:
+        yield chunk
+    
+    # Generate the template output for this spec file, streaming it if we can
+    if key in stream_keys:
+      stream_keys.remove(key)
+      for chunk in IterTemplateFromSpecPath(specs[key], datasources, options):
+        yield chunk
+    
+    else:
+      if key not in spec_outputs:
+        spec_outputs[key] = SubSpecTemplate(specs[key], datasources, options)
+      
+      yield str(spec_outputs[key])
+  
+  pieces.append(text[position:])
+  chunk = ''.join(pieces)
+  if chunk:
+    yield chunk
 
 
 def ProcessSpec(spec_path, spec_data, options):
   """Process a single specification path.  
 
   This could exit the program by calling Usage() in case of path errors.
+  
+  Returns: string, all output templated, if options['return_output'] is set, otherwise None.  Output is streamed to its
+      path or STDOUT as it is rendered, so it is only held in memory when it is returned.
   """
-  try:
-    datasources = yaml.load(open(options['datasources']))
-  except Exception, e:
-    Usage('Data Sources is not a YAML file or has a formatting error: %s: %s' % (datasources, e), options=options)
+  with timing.Start('spec', spec_path):
+    return ProcessSpecOutputs(spec_path, spec_data, options)
+
+
+def ProcessSpecOutputs(spec_path, spec_data, options):
+  """Process a single specification path, for ProcessSpec()."""
+  results = RenderSpecOutputs(spec_path, spec_data, options)
   
+  if options['return_output']:
+    return ''.join([result['output'] for result in results])
+  else:
+    return None
+
+
+def RenderSpecOutputs(spec_path, spec_data, options):
+  """Render every output of a spec: one, or one for each "outer filter" result.
+  
+  Returns: list of dicts, RenderSpecData() result for each output, in order
+  """
+  datasources = LoadDatasources(options)
+
   # If we are using outer filters, we will process many spec paths and data
   if 'outer filter' in spec_data:
     spec_data_list = []
-    
+  
     # If we found python string formatting in the spec_path, we know this will work
     if '%(' in spec_data['path'] and ')s' in spec_data['path']:
       # Get the data needed for each of the paths to be filtered themselves
-      path_data = query.Query(datasources[spec_data['datasource']], spec_data, 'outer filter')
+      path_data = list(query.Query(datasources[spec_data['datasource']], spec_data, 'outer filter'))
       if not path_data:
         raise Exception('"outer filter" filter did not produce any results: %s' % spec_data['outer filter'])
-      
+    
       # Process the path data: we will be formatting both the path and the filter
       for path_data_item in path_data:
         spec_data_cur = dict(spec_data)
-        
+      
         # Template the filter and path vars
-        spec_data_cur['filter'] = spec_data_cur['filter'] % path_data_item
+        spec_data_cur['filter'] = query.FormatFilter(spec_data_cur['filter'], path_data_item)
         spec_data_cur['path'] = spec_data_cur['path'] % path_data_item
-        
+      
         spec_data_list.append(spec_data_cur)
-    
+      
+      # Query every output's filter at once, instead of once per output
+      if spec_data.get('batch filter', False):
+        options = BatchOutputs(datasources[spec_data['datasource']], spec_data, path_data, spec_data_list, options)
+  
     # Else, report it to the user
     #TODO(g): Cleaner error messages.  Exceptions are not user friendly.
     else:
       raise Exception('Using "outer filter" spec command without putting any Python string formatting into the path value: "%(example_format)s": %s' % spec_data['path'])
-  
+
   # Else, we only have 1 spec path and data to process
   else:
     spec_data_list = [spec_data]
+
+
+  log('Spec Data List: %s', Brief(spec_data_list, 'outputs'), level=DEBUG)
+
+  # Render the outputs in parallel worker processes, if asked to and there is more than one
+  if options['jobs'] > 1 and len(spec_data_list) > 1:
+    results = RenderSpecDataParallel(spec_path, spec_data_list, datasources, options)
+
+  # Else, Process all our spec paths/data in order
+  else:
+    results = []
+    for spec_data in spec_data_list:
+      with timing.Start('output', spec_data.get('path', None)):
+        results.append(RenderSpecData(spec_path, spec_data, datasources, options))
+
+  # Record the fingerprints of the outputs, so they are skipped next time if nothing changes
+  if options['manifest']:
+    for result in results:
+      if result['fingerprint']:
+        manifest.Set(options['manifest'], result['path'], result['fingerprint'])
   
+    manifest.Save(options['manifest'])
+
+  # Record which files actually changed, so reloads only happen when needed
+  for result in results:
+    if result['changed']:
+      options['changed_paths'].append(result['path'])
+
+  return results
+
+
+def LoadDatasources(options):
+  """Returns dict, the datasources by name, loaded from options['datasources']."""
+  try:
+    datasources = options['context'].LoadYaml(options['datasources'])
+  except Exception, e:
+    Usage('Data Sources is not a YAML file or has a formatting error: %s: %s' % (options['datasources'], e), options=options)
+
+  # Name each datasource, so its query results can be cached by name
+  for (name, datasource) in datasources.items():
+    datasource['name'] = name
+
+  # Set module datasources, so relationships can find their target datasources
+  query.DATASOURCES = datasources
   
-  if options['verbose']:
-    log('Spec Data List: %s' % spec_data_list)
+  return datasources
+
+
+def BatchOutputs(datasource, spec_data, path_data, spec_data_list, options):
+  """Query the filter of every "outer filter" output at once, with "batch filter: true" in the spec.
+  
+  The filter's one field is matched against all the outer filter results in one query (up to query.BATCH_SIZE values
+  each), and the rows are grouped by the filtered column for their outputs, so N outputs are not N queries.  See
+  query.BatchField() for the filters that can be batched.  Filters and values that can not be batched are logged, and
+  their outputs are queried one at a time.
   
-  # Total output of all files templated
-  total_output = ''
+  Returns: dict, a copy of options with 'batch_results': cache key of each output's filter -> its rows
+  """
+  # Streamed results are never held in full, so they can not be grouped
+  if datasource.get('stream', False):
+    log('WARNING: "batch filter" is not used for streamed datasource: %s' % datasource['name'], level=WARNING)
+    return options
+  
+  try:
+    batch_results = BatchResults(datasource, spec_data, path_data, spec_data_list)
+  except query.BatchFilterError, e:
+    log('WARNING: "batch filter" is not used, outputs are queried one at a time: %s: %s' % (spec_data.get('name', None), e),
+        level=WARNING)
+    return options
   
-  # Process all our spec paths/data
-  for spec_data in spec_data_list:
-    # Template All The Things: Master loop for Template Manager
-    output = TemplateFromSpec(spec_path, spec_data, datasources, options)
-    total_output += output
+  options = dict(options)
+  options['batch_results'] = batch_results
+  
+  return options
+
+
+def BatchResults(datasource, spec_data, path_data, spec_data_list):
+  """Returns dict, cache key of each output's filter -> its rows, for BatchOutputs().
+  
+  Raises query.BatchFilterError if the filter or its values can not be batched, or the batched rows do not all belong
+  to an output (a column collation that matches more loosely than query.GroupKey()).
+  """
+  (field, column) = query.BatchField(spec_data['filter'])
+  
+  values = query.BatchValues([path_data_item[field] for path_data_item in path_data])
+  
+  groups = {}
+  for start in range(0, len(values), query.BATCH_SIZE):
+    batch_filter = query.BatchFilter(spec_data['filter'], values[start:start + query.BATCH_SIZE])
+    groups.update(query.GroupRows(query.Query(datasource, {'filter': batch_filter}), column))
+  
+  unmatched = set(groups) - set([query.GroupKey(value) for value in values])
+  if unmatched:
+    raise query.BatchFilterError('Rows matched none of the values, by the column\'s collation: %s: %s' %
+                                 (column, ', '.join(sorted([repr(key) for key in unmatched])[:5])))
+  
+  log('Batch Filter: %s outputs, %s queries', len(spec_data_list), (len(values) + query.BATCH_SIZE - 1) / query.BATCH_SIZE,
+      level=DEBUG)
+  
+  batch_results = {}
+  for (path_data_item, spec_data_cur) in zip(path_data, spec_data_list):
+    batch_results[cache.MakeKey(datasource, spec_data_cur['filter'])] = groups.get(query.GroupKey(path_data_item[field]), [])
+  
+  return batch_results
+
+
+def RenderSpecData(spec_path, spec_data, datasources, options):
+  """Template one spec data (one output file), and write it to its path or STDOUT.
+  
+  With a manifest (options['manifest']), an output file whose inputs have the same fingerprint as when it was last
+  written is not rendered or written again.
+  
+  Returns: dict, result for this output:
+      path: string, output path, or None if there is no path
+      output: string, output templated, if options['return_output'] is set, or for API callers if there is no path,
+          otherwise None
+      changed: boolean, True if the output file was written with new content.  False if it was skipped because its
+          inputs did not change, its content was the same, or it was not written to a file.
+      fingerprint: string, fingerprint of the output's inputs, if using a manifest and it does not use streamed rows,
+          otherwise None
+  """
+  result = {'path': spec_data.get('path', None), 'output': None, 'changed': False, 'fingerprint': None}
+  
+  # API callers always get the output of a spec without a path, it has nowhere else to go
+  return_output = options['return_output'] or (options['api'] and not result['path'])
+  
+  # If we are building incrementally, skip outputs whose inputs have not changed
+  if options['manifest'] and result['path'] and not options['no_output_file']:
+    # Rows fetched for the fingerprint are rendered, so a changed output does not query them again
+    options = dict(options)
+    options['fetched_results'] = {}
+    
+    with timing.Start('fingerprint'):
+      result['fingerprint'] = FingerprintSpec(spec_path, spec_data, datasources, options)
+    
+    # Outputs of streamed rows have no fingerprint, and are always rendered.  They are still only written if different.
+    if result['fingerprint'] == None:
+      log('Output Streamed, not fingerprinted: %s', result['path'], level=DEBUG)
     
-    # Save the master path
-    if (spec_data.get('path', None)):
-      # Ensure the path directory exists
-      dir_path = os.path.dirname(spec_data['path'])
-      if not os.path.isdir(dir_path):
+    elif (not options['force'] and os.path.isfile(result['path']) and
+          manifest.Get(options['manifest'], result['path']) == result['fingerprint']):
+      log('Output Unchanged: %s' % result['path'])
+      
+      # The existing file is the output
+      if options['return_output']:
+        result['output'] = open(result['path']).read()
+      
+      return result
+    
+    else:
+      log('Output Changed: %s' % result['path'])
+  
+  # Template All The Things: Master loop for Template Manager
+  output = IterTemplateFromSpec(spec_path, spec_data, datasources, options)
+  
+  # Keep the full output only if the caller asked for it
+  if return_output:
+    result['output'] = ''.join(output)
+    output = [result['output']]
+  
+  # Save the master path
+  if (spec_data.get('path', None)):
+    # Ensure the path directory exists.  Parallel jobs can race to create it.
+    dir_path = os.path.dirname(spec_data['path'])
+    if dir_path and not os.path.isdir(dir_path):
+      try:
         os.makedirs(dir_path, mode=DIRECTORY_MODE)
+      except OSError:
+        if not os.path.isdir(dir_path):
+          raise
+    
+    # If we havent been told to write an output file, stream the output into it.  It is only replaced if different.
+    if not options['no_output_file']:
+      result['changed'] = WriteChunks(spec_data['path'], output)
       
-      # If we havent been told to write an output file, write it
-      if not options['no_output_file']:
-        open(spec_data['path'], 'w').write(output)
-        
+      if result['changed']:
         log('Output Successful: %s' % spec_data['path'])
+      else:
+        log('Output Identical, not written: %s' % spec_data['path'])
+  
+  # Else
+  else:
+    if options['stdout']:
+      for chunk in output:
+        sys.stdout.write(chunk)
+      sys.stdout.write('\n')
+    
+    # Returned output does not need a path
+    elif not return_output:
+      log('ERROR: No path for final output, and option --stdout was not used.', level=ERROR)
+  
+  return result
+
+
+def FingerprintSpec(spec_path, spec_data, datasources, options, process_stack=()):
+  """Returns string, a hash of every input to this spec's output.
+  
+  Inputs are the spec data, the template and wrapper files, the files they include, the results of the spec's query,
+  the static data and commands options, and the fingerprints of its nested and processed specs.  Query results are
+  kept in options['fetched_results'], if it is set, so the render that follows a changed fingerprint does not query
+  again, even without the cache.
+  
+  Specs with a streamed datasource ("stream: true"), or nested or processed specs with one, have no fingerprint, as
+  their rows can only be read once, by the render.
+  
+  Args:
+    process_stack: tuple, absolute paths of the processed specs being fingerprinted, to stop at cycles
+  
+  Returns: string, or None if the spec uses streamed rows
+  """
+  if spec_data.get('datasource', None) and datasources[spec_data['datasource']].get('stream', False):
+    return None
+  
+  fingerprint = hashlib.sha1()
+  
+  fingerprint.update(CanonicalText(spec_data))
+  fingerprint.update(CanonicalText(options.get('data', None)))
+  fingerprint.update(CanonicalText(options['commands']))
+  
+  # Template files, and the files they include
+  for key in ('template', 'template wrapper'):
+    if spec_data.get(key, None):
+      text = options['context'].ReadFile(spec_data[key])
+      fingerprint.update('%s:%s\n' % (key, hashlib.sha1(text).hexdigest()))
+      
+      for (command, command_path) in CommandPaths(TemplateTokens(spec_data[key], options), options):
+        if command == 'include':
+          fingerprint.update('include:%s:%s\n' % (command_path, hashlib.sha1(options['context'].ReadFile(command_path)).hexdigest()))
+        
+        # Cycles fail when rendered, so are left out here
+        elif os.path.abspath(command_path) not in process_stack:
+          process_data = GetSpecData(command_path, options)
+          process_fingerprint = FingerprintSpec(command_path, process_data, datasources, options,
+                                                process_stack + (os.path.abspath(command_path),))
+          if process_fingerprint == None:
+            return None
+          
+          fingerprint.update('process:%s:%s\n' % (command_path, process_fingerprint))
+  
+  # Query results
+  data = GetData(spec_data, datasources, options)
+  if data == NoDataSource:
+    fingerprint.update('data:none\n')
+  else:
+    if options.get('fetched_results', None) != None:
+      options['fetched_results'][cache.MakeKey(datasources[spec_data['datasource']], spec_data['filter'])] = data
+    
+    for item in data:
+      fingerprint.update(repr(sorted(item.items())))
+      fingerprint.update('\n')
+  
+  # Nested specs
+  for (spec_key, spec_key_path) in sorted((spec_data.get('specs', None) or {}).items()):
+    spec_key_data = GetSpecData(spec_key_path, options)
+    spec_key_fingerprint = FingerprintSpec(spec_key_path, spec_key_data, datasources, options, process_stack)
+    if spec_key_fingerprint == None:
+      return None
+    
+    fingerprint.update('spec:%s:%s\n' % (spec_key, spec_key_fingerprint))
+  
+  return fingerprint.hexdigest()
+
+
+def CanonicalText(value):
+  """Returns string, value as JSON with sorted keys, so equal values always give the same text to hash."""
+  return json.dumps(value, sort_keys=True, default=repr) + '\n'
+
+
+def CommandPaths(tokens, options, include_stack=()):
+  """Returns list of (command, path), the existing files included and specs processed by a template, from its
+  TokenizeCommands() tokens, and by the files it includes, in order.
+  """
+  paths = []
+  for token in tokens:
+    if isinstance(token, basestring):
+      continue
+    
+    (command, path) = token[:2]
+    
+    if command not in ('include', 'process') or not os.path.isfile(path):
+      continue
+    
+    if command == 'process':
+      paths.append((command, path))
+    
+    elif os.path.abspath(path) not in include_stack:
+      paths.append((command, path))
+      paths += CommandPaths(TemplateTokens(path, options), options, include_stack + (os.path.abspath(path),))
+  
+  return paths
+
+
+def RenderSpecDataParallel(spec_path, spec_data_list, datasources, options):
+  """Template each spec data with RenderSpecData() in a pool of options['jobs'] worker processes.
+  
+  The outer filter has already been queried, so workers only query their own filter.  Each worker's log messages are
+  held and written in spec data order, and all failures are reported together once every job has finished.
+  
+  Returns: list, RenderSpecData() result for each spec data, in order
+  """
+  global WORKER_STATE
+  
+  # Workers are forked with the spec state, so it is not pickled and sent with every job
+  WORKER_STATE = (spec_path, spec_data_list, datasources, options)
+  
+  pool = multiprocessing.Pool(min(options['jobs'], len(spec_data_list)))
+  
+  try:
+    results = []
+    errors = []
+    
+    # Results come back in spec data order
+    for (index, (log_lines, result, error, accessed, spans)) in enumerate(pool.imap(RenderSpecDataJob,
+                                                                                    range(len(spec_data_list)))):
+      WriteLog(log_lines)
+      results.append(result)
+      timing.Adopt(spans)
+      
+      # Files read by the worker, so --watch watches them too
+      options['context'].accessed.update(accessed)
+      
+      if error:
+        errors.append('%s: %s' % (spec_data_list[index].get('path', spec_path), error))
+    
+    pool.close()
+  
+  except:
+    pool.terminate()
+    raise
+  
+  finally:
+    pool.join()
+    WORKER_STATE = None
+  
+  if errors:
+    raise ParallelRenderError('%s of %s outputs failed:\n  %s' % (len(errors), len(spec_data_list), '\n  '.join(errors)))
+  
+  return results
+
+
+def RenderSpecDataJob(index):
+  """Worker process job for RenderSpecDataParallel(), renders one spec data from WORKER_STATE.
+  
+  Returns: tuple (log_lines, result, error, accessed, spans), result is from RenderSpecData(), error is None if
+      successful, accessed is list of the files the worker has read, spans is list of the job's timing spans
+  """
+  (spec_path, spec_data_list, datasources, options) = WORKER_STATE
+  
+  # Timings are sent back to the parent, to be added to its current span
+  job_span = timing.Span('job')
+  timing.Attach(job_span)
+  
+  StartLogCapture()
+  try:
+    with timing.Start('output', spec_data_list[index].get('path', None)):
+      result = RenderSpecData(spec_path, spec_data_list[index], datasources, options)
+    error = None
+  
+  # Usage() exits on errors, which would kill the worker without returning a result
+  except (Exception, SystemExit), e:
+    result = None
+    error = '%s: %s' % (e.__class__.__name__, e)
+  
+  timing.Attach(None)
+  
+  return (StopLogCapture(), result, error, list(options['context'].accessed), job_span.children)
+
+
+def ProcessSpecPaths(spec_paths, options):
+  """Process each of the spec paths as a separate spec, logging any errors.  Sub-specs they share are rendered once."""
+  ShareSpecs(spec_paths, options)
+  
+  for spec_path in spec_paths:
+    try:
+      ProcessSpecPath(spec_path, options)
+      
+    except (ConfigurationError, ParallelRenderError), e:
+      log('ERROR: %s: %s' % (spec_path, e), level=ERROR)
+    
+    # When watching, keep running through errors, the next change may fix them.  Usage() exits on errors.
+    except (Exception, SystemExit), e:
+      if not options['watch']:
+        raise
+      
+      log('ERROR: %s: %s: %s' % (spec_path, e.__class__.__name__, e), level=ERROR)
+
+
+def SnapshotSpecs(datasource_name, path, spec_paths, options):
+  """Copy the tables that the specs (and their sub-specs and %%PROCESS%% specs) select from a MySQL datasource into a
+  SQLite file, so a "sqlite" datasource can render them with the same SQL, without the database.
+  """
+  datasources = LoadDatasources(options)
+  
+  if datasource_name not in datasources:
+    Usage('Datasource to snapshot not found: %s' % datasource_name, options=options)
+  
+  # The SQL of every spec using the datasource
+  sql_list = []
+  for spec_path in sorted(SpecGraph(spec_paths, options)):
+    spec_data = GetSpecData(spec_path, options)
+    
+    if spec_data.get('datasource', None) == datasource_name:
+      for key in ('filter', 'outer filter'):
+        if isinstance(spec_data.get(key, None), basestring):
+          sql_list.append(spec_data[key])
+  
+  if not sql_list:
+    Usage('No specs select from datasource: %s' % datasource_name, options=options)
+  
+  log('Snapshot: %s: %s queries' % (datasource_name, len(sql_list)))
+  
+  try:
+    copied = snapshot.Snapshot(datasources[datasource_name], sql_list, path)
+  except snapshot.SnapshotError, e:
+    log('ERROR: Snapshot: %s' % e, level=ERROR)
+    return
+  
+  log('Snapshot Successful: %s: %s tables, %s rows' % (path, len(copied), sum(copied.values())))
+
+
+def ShareSpecs(spec_paths, options):
+  """Find the sub-specs used more than once by the spec paths, and everything they use, so they are rendered once and
+  shared for the run (see SubSpecTemplate()).
+  """
+  shared = SharedSpecs(SpecGraph(spec_paths, options))
+  
+  log('Shared Specs: %s', len(shared), level=DEBUG)
+  
+  options['context'].shared = shared
+
+
+def SpecGraph(spec_paths, options):
+  """Returns dict, absolute path of each spec used by the spec paths -> list of absolute paths of the specs it uses, in
+  its "specs" and by %%PROCESS%% commands in its templates.
+  """
+  graph = {}
+  pending = [os.path.abspath(spec_path) for spec_path in spec_paths]
+  
+  while pending:
+    spec_path = pending.pop()
+    if spec_path in graph:
+      continue
     
-    # Else
+    graph[spec_path] = SpecDependencies(spec_path, options)
+    pending += graph[spec_path]
+  
+  return graph
+
+
+def SpecDependencies(spec_path, options):
+  """Returns list of strings, absolute paths of the specs this spec uses, once for each time they are rendered.
+  
+  Specs that cannot be loaded have no dependencies here, their errors are reported when they are rendered.
+  """
+  try:
+    spec_data = options['context'].LoadYaml(spec_path)
+    
+    dependencies = [os.path.abspath(path) for path in (spec_data.get('specs', None) or {}).values()]
+    
+    # Sub-specs of an "outer filter" spec are rendered for each of its outputs
+    if 'outer filter' in spec_data:
+      dependencies += dependencies
+    
+    for key in ('template', 'template wrapper'):
+      if spec_data.get(key, None):
+        for (command, command_path) in CommandPaths(TemplateTokens(spec_data[key], options), options):
+          if command == 'process':
+            dependencies.append(os.path.abspath(command_path))
+  
+  except Exception:
+    return []
+  
+  return dependencies
+
+
+def SharedSpecs(graph):
+  """Returns set of strings, absolute paths of the specs used more than once in the spec graph."""
+  uses = {}
+  for dependencies in graph.values():
+    for spec_path in dependencies:
+      uses[spec_path] = uses.get(spec_path, 0) + 1
+  
+  return set([spec_path for (spec_path, count) in uses.items() if count > 1])
+
+
+def ReportChangedPaths(options):
+  """Report the output files that changed, so anything reloading services from them knows whether it needs to."""
+  log('Changed Outputs: %s' % len(options['changed_paths']))
+  for path in options['changed_paths']:
+    log('Changed Output: %s', path, level=DEBUG)
+
+
+def ReportPrecompiled(options):
+  """Report the precompiled cache counters, if verbose."""
+  if options['precompiled_dir']:
+    log('Precompiled: %s', precompiled.GetStats(), level=DEBUG)
+
+
+def ReportProfile(options):
+  """Report the timings of the specs processed since the last report, if profiling."""
+  if not options['profile']:
+    return
+  
+  roots = timing.TakeRoots()
+  timing.Report(roots)
+  
+  if options['profile_json']:
+    timing.WriteJson(options['profile_json'], roots)
+
+
+def Watch(spec_paths, options):
+  """Process the spec paths, then keep running and process them again whenever a file they read changes, and every
+  options['watch_interval'] seconds to poll the datasources for new data.
+  
+  Parsed files and pooled connections are kept between runs, query results are not, so each run sees the data as it is
+  now.  Every output's fingerprint is checked on each run (see FingerprintSpec()), and only outputs whose inputs
+  changed are rendered and written again.
+  """
+  context = options['context']
+  
+  # Poll the datasources every interval, or never if it is 0
+  timeout = options['watch_interval'] or None
+  
+  while True:
+    # Snapshot the files already known before processing, so edits made during the run are changes for the next one
+    state = watch.Snapshot(WatchPaths(spec_paths, options))
+    
+    # Query results are cached for one run
+    cache.Clear()
+    
+    options['changed_paths'] = []
+    ProcessSpecPaths(spec_paths, options)
+    ReportChangedPaths(options)
+    ReportProfile(options)
+    
+    for path in WatchPaths(spec_paths, options):
+      if path not in state:
+        state[path] = watch.FileState(path)
+    
+    log('Watch: Watching %s files', len(state), level=DEBUG)
+    
+    # Write this run's log lines now, waiting can take a long time
+    FlushLog()
+    
+    try:
+      changed = watch.WaitForChanges(state, timeout=timeout)
+    except KeyboardInterrupt:
+      log('Watch: Stopped')
+      return
+    
+    context.NewRun()
+    
+    if changed:
+      log('Watch: Changed: %s' % ', '.join(changed))
+      
+      if os.path.abspath(options['commands_path']) in changed:
+        LoadCommands(options)
+      
+      # Changed data files can change the results of any datasource related to them, drop them from the on-disk layer
+      if set(changed) & set(DataPaths()):
+        cache.Invalidate()
+    
+    # Results kept on disk (--cache-dir) are dropped when polling, so the next run queries the datasources
     else:
-      if options['stdout']:
-        print output
-      else:
-        log('ERROR: No path for final output, and option --stdout was not used.')
+      log('Watch: Polling datasources')
+      cache.Invalidate()
+
+
+def WatchPaths(spec_paths, options):
+  """Returns set of strings, absolute paths of the spec paths and every file read while processing them."""
+  paths = set(options['context'].accessed)
+  paths.update([os.path.abspath(spec_path) for spec_path in spec_paths])
+  paths.update(DataPaths())
   
-  return total_output
+  return paths
+
+
+def DataPaths():
+  """Returns list of strings, absolute paths of the data files of the loaded file datasources."""
+  return [os.path.abspath(datasource['path']) for datasource in (query.DATASOURCES or {}).values()
+          if datasource.get('path', None)]
 
 
 def ProcessSpecPath(spec_path, options):
@@ -342,6 +1264,99 @@ def ProcessSpecPath(spec_path, options):
   return output
 
 
+def Render(specs, options=None):
+  """Render many specs in one run, for Python callers, sharing the work between them.
+  
+  Files are parsed once, query results are cached for the call, and the sub-specs used by more than one spec (or by every output of
+  an "outer filter") are rendered once (see SharedSpecs()).  Errors in one spec are returned with its result, and the
+  other specs are still rendered.
+  
+  Args:
+    specs: list of strings, spec paths
+    options: dict, command line long option (without "--") -> value, ex: {'datasources': path, 'threads': 4}.  Options
+        without a value are set with True.  "data" is a dict of static data for every spec.
+  
+  Returns: dict of the run:
+      specs: list of dicts, for each spec path, in order:
+          spec_path: string
+          outputs: list of dicts, RenderSpecData() result for each output of the spec: path, output, changed,
+              fingerprint.  output is the templated text with "no-output-file", or if the output has no path,
+              otherwise it is only written to path.
+          seconds: float, time to render the spec
+          error: string, why the spec failed, or None
+      changed_paths: list of strings, output paths written with new content
+      profile: list of dicts, timing spans of the run (see util/timing.py), if "profile" is set, otherwise None
+  """
+  command_options = ProcessOptions(ApiOptions(options or {}), api=True)
+  
+  # Output text is only held when it is not written, or has no path to be written to (see RenderSpecData())
+  command_options['return_output'] = command_options['no_output_file']
+  
+  if options and options.get('data', None):
+    command_options['data'] = options['data']
+  
+  SetModuleOptions(command_options)
+  
+  # Query results are cached for one run, so each call sees the data as it is now
+  cache.Clear()
+  
+  run = {'specs': [], 'changed_paths': command_options['changed_paths'], 'profile': None}
+  
+  try:
+    ShareSpecs(specs, command_options)
+    
+    for spec_path in specs:
+      spec_result = {'spec_path': spec_path, 'outputs': [], 'seconds': None, 'error': None}
+      run['specs'].append(spec_result)
+      
+      started = time.time()
+      try:
+        spec_data = GetSpecData(spec_path, command_options)
+        
+        with timing.Start('spec', spec_path):
+          spec_result['outputs'] = RenderSpecOutputs(spec_path, spec_data, command_options)
+      
+      except Exception, e:
+        spec_result['error'] = '%s: %s' % (e.__class__.__name__, e)
+        log('ERROR: %s: %s' % (spec_path, spec_result['error']), level=ERROR)
+      
+      spec_result['seconds'] = time.time() - started
+  
+  # Close pooled datasource connections, however the run ended
+  finally:
+    query.Shutdown()
+    FlushLog()
+  
+  if command_options['profile']:
+    run['profile'] = [span.ToDict() for span in timing.TakeRoots()]
+  
+  return run
+
+
+def ApiOptions(options):
+  """Returns list of (option, value) tuples, as from getopt.getopt(), for a dict of Render() options."""
+  option_names = dict([(name.rstrip('='), name.endswith('=')) for name in LONG_OPTIONS])
+  
+  getopt_options = []
+  for (name, value) in sorted(options.items()):
+    if name == 'data':
+      continue
+    
+    if name not in option_names or name in ('help', 'watch', 'watch-interval'):
+      raise ConfigurationError('Unknown Render() option: %s' % name)
+    
+    # Options with values
+    if option_names[name]:
+      if value != None:
+        getopt_options.append(('--%s' % name, str(value)))
+    
+    # Flags
+    elif value:
+      getopt_options.append(('--%s' % name, ''))
+  
+  return getopt_options
+
+
 def Usage(error=None, options=None):
   """Print usage information, any errors, and exit.  
   If errors, exit code = 1, otherwise 0.
@@ -349,7 +1364,7 @@ def Usage(error=None, options=None):
   
   # If this was invokved via an API (Python module call), then raise an exception instead of doing sys.exit()
   if options and options.get('api', False):
-    raise Exception(error)
+    raise ConfigurationError(error)
   
   if error:
     print '\nerror: %s' % error
@@ -359,14 +1374,31 @@ def Usage(error=None, options=None):
   
   print
   print 'usage: %s [options] <spec_file_path_1> [spec_file_path_2] [spec_file_path_3] ...' % os.path.basename(sys.argv[0])
+  print '       %s [options] snapshot <mysql_datasource> <sqlite_path> <spec_file_path_1> [spec_file_path_2] ...' % os.path.basename(sys.argv[0])
+  print
+  print 'snapshot copies the tables the specs select from a MySQL datasource into a SQLite file, for a "sqlite" datasource'
   print
   print 'Options:'
   print
   print '  -h, -?, --help             This usage information'
-  print '  -v, --verbose              Verbose output'
+  print '  -v, --verbose              Verbose output (--log-level=debug)'
+  print '  --log-level=[level]        Log messages at this level and above: debug, info (default), warning, error'
+  print '  --log-json=[path]          Also append log messages to this file, as JSON lines'
   print '  -S, --stdout               Print any output without a path to STDOUT'
   print '  -s, --datasources=[path]   Datasources YAML spec'
   print '  -n, --no-output-file       Do not write to an output file (API access)'
+  print '  -c, --commands=[path]      Commands YAML spec'
+  print '  -j, --jobs=[count]         Render the outputs of an "outer filter" in this many parallel processes'
+  print '  -t, --threads=[count]      Render sibling "specs" in this many threads, so their queries overlap'
+  print '  -m, --manifest=[path]      Skip outputs whose inputs are unchanged since they were recorded in this manifest'
+  print '  -f, --force                With --manifest, render and write every output, and record them'
+  print '  --no-cache                 Do not cache query results'
+  print '  --cache-dir=[path]         Also cache query results on disk in this directory, between runs'
+  print '  --precompiled-dir=[path]   Keep parsed specs, datasources, commands and templates in this directory, between runs'
+  print '  --profile                  Log a tree of the time spent in each stage of each spec'
+  print '  --profile-json=[path]      With --profile, also write the timings to this JSON file'
+  print '  --watch                    Keep running, and render again when spec, template or data files change'
+  print '  --watch-interval=[seconds] With --watch, poll the datasources this often for new data (default: 60, 0: never)'
   print
   
   sys.exit(exit_code)
@@ -384,10 +1416,30 @@ def ProcessOptions(options, api=False):
   # Dictionary of command options, with defaults
   command_options = {}
   command_options['verbose'] = False
+  command_options['log_level'] = None
+  command_options['log_json'] = None
   command_options['stdout'] = False
   command_options['no_output_file'] = False
   command_options['datasources'] = None
   command_options['commands_path'] = None
+  command_options['jobs'] = 1
+  command_options['threads'] = 1
+  command_options['manifest'] = None
+  
+  # Paths of output files written with new content during the run, filled in by ProcessSpec()
+  command_options['changed_paths'] = []
+  
+  command_options['force'] = False
+  command_options['no_cache'] = False
+  command_options['cache_dir'] = None
+  command_options['precompiled_dir'] = None
+  command_options['profile'] = False
+  command_options['profile_json'] = None
+  command_options['watch'] = False
+  command_options['watch_interval'] = 60
+  
+  # API callers get the templated text returned, command line runs only stream it to files or STDOUT
+  command_options['return_output'] = api
   
   # Used for preventing sys.exit() on errors, exceptions are thrown instead
   command_options['api'] = api
@@ -397,12 +1449,24 @@ def ProcessOptions(options, api=False):
   for (option, value) in options:
     # Help
     if option in ('-h', '-?', '--help'):
-      Usage(options=options)
+      Usage(options=command_options)
     
     # Verbose output information
     elif option in ('-v', '--verbose'):
       command_options['verbose'] = True
     
+    # Level of log messages, verbose is debug
+    elif option in ('--log-level',):
+      levels = dict([(name.lower(), level) for (level, name) in LEVEL_NAMES.items()])
+      if value.lower() not in levels:
+        Usage('Log level must be one of: %s' % ', '.join(sorted(levels, key=levels.get)), options=command_options)
+      
+      command_options['log_level'] = levels[value.lower()]
+    
+    # Also log to a JSON lines file
+    elif option in ('--log-json',):
+      command_options['log_json'] = value
+    
     # Verbose output information
     elif option in ('-n', '--no-output-file'):
       command_options['no_output_file'] = True
@@ -414,40 +1478,137 @@ def ProcessOptions(options, api=False):
     # Data sources path option
     elif option in ('-s', '--datasources'):
       if not os.path.isfile(value):
-        Usage('Datasource file specified not found: %s' % value, options=options)
+        Usage('Datasource file specified not found: %s' % value, options=command_options)
         
       command_options['datasources'] = value
     
     # Commands path option
     elif option in ('-c', '--commands'):
       if not os.path.isfile(value):
-        Usage('Command file specified not found: %s' % value, options=options)
+        Usage('Command file specified not found: %s' % value, options=command_options)
         
       command_options['commands_path'] = value
+    
+    # Parallel jobs for "outer filter" outputs
+    elif option in ('-j', '--jobs'):
+      try:
+        command_options['jobs'] = int(value)
+      except ValueError:
+        Usage('Jobs must be a number: %s' % value, options=command_options)
+      
+      if command_options['jobs'] < 1:
+        Usage('Jobs must be at least 1: %s' % value, options=command_options)
+    
+    # Threads for sibling sub-specs
+    elif option in ('-t', '--threads'):
+      try:
+        command_options['threads'] = int(value)
+      except ValueError:
+        Usage('Threads must be a number: %s' % value, options=command_options)
+      
+      if command_options['threads'] < 1:
+        Usage('Threads must be at least 1: %s' % value, options=command_options)
+    
+    # Build manifest, for incremental builds
+    elif option in ('-m', '--manifest'):
+      command_options['manifest'] = value
+    
+    # Render everything, even if the manifest shows it is unchanged
+    elif option in ('-f', '--force'):
+      command_options['force'] = True
+    
+    # Do not cache query results
+    elif option in ('--no-cache',):
+      command_options['no_cache'] = True
+    
+    # Directory to cache query results in, between runs
+    elif option in ('--cache-dir',):
+      command_options['cache_dir'] = value
+    
+    # Directory to keep parsed files in, between runs
+    elif option in ('--precompiled-dir',):
+      command_options['precompiled_dir'] = value
+    
+    # Time the stages of each spec
+    elif option in ('--profile',):
+      command_options['profile'] = True
+    
+    # Also write the timings to a JSON file
+    elif option in ('--profile-json',):
+      command_options['profile_json'] = value
+    
+    # Keep running, rendering again on changes
+    elif option in ('--watch',):
+      command_options['watch'] = True
+    
+    # Seconds between datasource polls, when watching
+    elif option in ('--watch-interval',):
+      try:
+        command_options['watch_interval'] = float(value)
+      except ValueError:
+        Usage('Watch interval must be a number: %s' % value, options=command_options)
+      
+      if command_options['watch_interval'] < 0:
+        Usage('Watch interval must be at least 0: %s' % value, options=command_options)
 
 
+  # Verbose runs log debug messages, and a debug log level is verbose
+  if command_options['log_level'] == None:
+    if command_options['verbose']:
+      command_options['log_level'] = DEBUG
+    else:
+      command_options['log_level'] = INFO
+  
+  command_options['verbose'] = command_options['log_level'] <= DEBUG
+  
   # Datasource: Populate default file paths, if not specified
   if command_options['datasources'] == None:
-    command_options['datasources'] = '%s/conf/datasources.yaml' % os.path.dirname(sys.argv[0])
+    command_options['datasources'] = os.path.join(ROOT_DIR, 'conf', 'datasources.yaml')
+    
+    if not os.path.isfile(command_options['datasources']):
+      Usage('Default datasource file not found, specify one with --datasources: %s' % command_options['datasources'],
+            options=command_options)
     
   # Commands: Populate default file path, if not specified
   if command_options['commands_path'] == None:
-    command_options['commands_path'] = '%s/conf/commands.yaml' % os.path.dirname(sys.argv[0])
+    command_options['commands_path'] = os.path.join(ROOT_DIR, 'conf', 'commands.yaml')
     
-  # Load the commands 
-  command_options['commands'] = yaml.load(open(command_options['commands_path']))
+    if not os.path.isfile(command_options['commands_path']):
+      Usage('Default command file not found, specify one with --commands: %s' % command_options['commands_path'],
+            options=command_options)
+    
+  # Files are loaded once for the run, through its context
+  command_options['context'] = RunContext(command_options['precompiled_dir'])
+  
+  LoadCommands(command_options)
+  
+  # Watching keeps output fingerprints in memory between runs, if there is no manifest file for them
+  if command_options['watch'] and not command_options['manifest']:
+    command_options['manifest'] = manifest.IN_MEMORY
   
   return command_options
 
 
+def SetModuleOptions(options):
+  """Set module command options, so we dont have to always pass them in."""
+  query.OPTIONS = options
+  cache.CACHE_DIR = options['cache_dir']
+  timing.ENABLED = options['profile']
+  SetLogOptions(options['log_level'], options['log_json'])
+
+
+def LoadCommands(options):
+  """Load the commands, and compile them for scanning templates."""
+  options['commands'] = options['context'].LoadYaml(options['commands_path'])
+  options['commands_regex'] = CompileCommands(options['commands'])
+
+
 def Main(args=None):
   if not args:
     args = []
   
-  long_options = ['help', 'verbose', 'stdout', 'datasources=']
-  
   try:
-    (options, args) = getopt.getopt(args, '?hvSd:', long_options)
+    (options, args) = getopt.getopt(args, '?hvSns:c:j:t:m:f', LONG_OPTIONS)
   except getopt.GetoptError, e:
     Usage(e, options=options)
   
@@ -456,22 +1617,53 @@ def Main(args=None):
   command_options = ProcessOptions(options)
   
   
-  # Set module command options, so we dont have to always pass them in
-  query.OPTIONS = command_options
+  SetModuleOptions(command_options)
 
 
   # Ensure we at least have a command, it's required
   if len(args) < 1:
     Usage('No Spec file specified.  Spec file should be a YAML formatted ', options=options)
   
+  # Snapshot a datasource for the spec files, instead of processing them
+  if args[0] == 'snapshot':
+    if len(args) < 4:
+      Usage('snapshot needs a datasource, a SQLite path and spec files', options=options)
+    
+    try:
+      SnapshotSpecs(args[1], args[2], args[3:], command_options)
+    finally:
+      query.Shutdown()
+      FlushLog()
+    
+    ReportProfile(command_options)
+    
+    return []
+  
 
-  # Process each of the arguments as a separate spec file
-  for spec_path in args:
+  # Keep running, processing the spec files again as they change
+  if command_options['watch']:
     try:
-      ProcessSpecPath(spec_path, command_options)
-      
-    except ConfigurationError, e:
-      log('ERROR: %s: %s' % (spec_path, e))
+      Watch(args, command_options)
+    finally:
+      query.Shutdown()
+      FlushLog()
+    
+    return command_options['changed_paths']
+  
+  # Process each of the arguments as a separate spec file
+  try:
+    ProcessSpecPaths(args, command_options)
+  
+  # Close pooled datasource connections, however the run ended
+  finally:
+    query.Shutdown()
+    FlushLog()
+  
+  ReportChangedPaths(command_options)
+  ReportPrecompiled(command_options)
+  ReportProfile(command_options)
+  
+  return command_options['changed_paths']
 
 
 if __name__ == '__main__':
@@ -0,0 +1,199 @@
+#!/usr/bin/env python2
+"""
+Batch Filter Tests
+
+Checks the filters and values that "batch filter: true" batches, and renders batched specs from a SQLite file in a
+temporary directory the same as one query per output.
+
+usage: python -m unittest discover tests
+"""
+
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import templateman
+from util import query
+from util.rows import Rows
+
+
+class BatchFieldTest(unittest.TestCase):
+  """query.BatchField() and query.BatchFilter() of SQL and data file filters."""
+
+  def testSqlField(self):
+    """SQL filters group by the column that the batched SQL selects."""
+    self.assertEqual(query.BatchField('SELECT * FROM machine WHERE machine.service = %(id)s'),
+                     ('id', query.BATCH_KEY_COLUMN))
+
+
+  def testSqlFilter(self):
+    """The column is compared with IN, and selected as the batch key."""
+    batch_filter = query.BatchFilter("SELECT * FROM machine WHERE name = '%(name)s' AND ip LIKE '10.%%'", ['a', "b'c"])
+
+    self.assertEqual(batch_filter, "SELECT *, name AS __batch_key FROM machine WHERE name IN ('a', 'b\\'c') "
+                                   "AND ip LIKE '10.%'")
+
+
+  def testDictField(self):
+    """Data file filters group by the key whose value is the field."""
+    self.assertEqual(query.BatchField({'service': '%(id)s', 'location': 'sjc'}), ('id', 'service'))
+    self.assertEqual(query.BatchFilter({'service': '%(id)s', 'location': 'sjc'}, [1, 2]),
+                     {'service': [1, 2], 'location': 'sjc'})
+
+
+  def testUnbatchable(self):
+    """Filters whose rows are not the rows of each value put together can not be batched."""
+    filters = ['SELECT * FROM machine WHERE service = %(id)s LIMIT 2',
+               'SELECT DISTINCT name FROM machine WHERE service = %(id)s',
+               'SELECT service, COUNT(*) FROM machine WHERE service = %(id)s',
+               'SELECT * FROM machine WHERE service = %(id)s OR location = 1',
+               'SELECT * FROM machine WHERE service = %(id)s AND location = %(location)s',
+               'SELECT * FROM machine WHERE id IN (SELECT machine FROM port WHERE service = %(id)s)',
+               'SHOW TABLES LIKE %(id)s',
+               {'service': '%(id)s', 'location': '%(location)s'},
+               {'service': 'service-%(id)s'},
+               ['%(id)s']]
+
+    for filter in filters:
+      self.assertRaises(query.BatchFilterError, query.BatchField, filter)
+
+
+  def testQuotedSql(self):
+    """Keywords and parentheses in quoted strings do not stop batching."""
+    filter = "SELECT * FROM machine WHERE name = %(name)s AND note != 'LIMIT (1 FROM'"
+
+    self.assertEqual(query.BatchField(filter), ('name', query.BATCH_KEY_COLUMN))
+
+
+class GroupTest(unittest.TestCase):
+  """query.GroupKey(), query.BatchValues() and query.GroupRows()."""
+
+  def testGroupKey(self):
+    """Values compare as MySQL's default collations compare them, whatever their type."""
+    self.assertEqual(query.GroupKey(5), query.GroupKey('5'))
+    self.assertEqual(query.GroupKey(5L), query.GroupKey(u'5'))
+    self.assertEqual(query.GroupKey('Web1 '), query.GroupKey('web1'))
+    self.assertEqual(query.GroupKey(u'caf\xe9'), query.GroupKey('cafe'))
+    self.assertEqual(query.GroupKey('caf\xc3\xa9'), query.GroupKey(u'CAF\xc9'))
+    self.assertNotEqual(query.GroupKey(' web1'), query.GroupKey('web1'))
+
+
+  def testBatchValues(self):
+    """Values are batched once each, in order."""
+    self.assertEqual(query.BatchValues([3, 1, 3, '1', 2]), [3, 1, 2])
+    self.assertEqual(query.BatchValues(['web1', 'web2', 'web1']), ['web1', 'web2'])
+
+
+  def testBatchValuesCollide(self):
+    """Values that only differ by the collation can not be batched."""
+    self.assertRaises(query.BatchFilterError, query.BatchValues, ['web1', 'WEB1'])
+    self.assertRaises(query.BatchFilterError, query.BatchValues, [u'cafe', u'caf\xe9'])
+    self.assertRaises(query.BatchFilterError, query.BatchValues, ['web1', 'web1 '])
+
+
+  def testGroupRows(self):
+    """Rows are grouped by the batch key, which is removed from them."""
+    result = Rows(('id', 'name', query.BATCH_KEY_COLUMN), [(1, 'a', 10), (2, 'b', 20), (3, 'c', 10)])
+
+    groups = query.GroupRows(result, query.BATCH_KEY_COLUMN)
+    self.assertEqual(sorted(groups), ['10', '20'])
+    self.assertEqual(groups['10'].columns, ('id', 'name'))
+    self.assertEqual(groups['10'].tuples, [(1, 'a'), (3, 'c')])
+
+    groups = query.GroupRows(list(result), query.BATCH_KEY_COLUMN)
+    self.assertEqual(groups['10'], [{'id': 1, 'name': 'a'}, {'id': 3, 'name': 'c'}])
+
+
+  def testGroupRowsMissingColumn(self):
+    """Results without the column can not be grouped."""
+    self.assertRaises(query.BatchFilterError, query.GroupRows, Rows(('id',), [(1,)]), query.BATCH_KEY_COLUMN)
+    self.assertRaises(query.BatchFilterError, query.GroupRows, [{'id': 1}], 'service')
+
+
+class BatchRenderTest(unittest.TestCase):
+  """Renders "outer filter" specs of a SQLite file of machines and services, batched and one query per output."""
+
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp(prefix='templateman_test_')
+
+    conn = sqlite3.connect(self.Path('ops.sqlite'))
+    conn.execute('CREATE TABLE service (id INTEGER, name TEXT)')
+    conn.execute('CREATE TABLE machine (id INTEGER, name TEXT, service INTEGER)')
+    conn.executemany('INSERT INTO service VALUES (?, ?)', [(1, 'web'), (2, 'db'), (3, 'cache'), (4, 'mail')])
+    conn.executemany('INSERT INTO machine VALUES (?, ?, ?)', [(1, 'db1', 2), (2, 'web1', 1), (3, 'web2', 1),
+                                                             (4, 'cache1', 3)])
+    conn.commit()
+    conn.close()
+
+    self.WriteFile('datasources.yaml', 'ops:\n  type: sqlite\n  path: %s\n' % self.Path('ops.sqlite'))
+    self.WriteFile('row.tmpl', '%(name)s\n')
+
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir)
+
+
+  def Path(self, filename):
+    """Returns string, path of a file in the work directory."""
+    return os.path.join(self.work_dir, filename)
+
+
+  def WriteFile(self, filename, text):
+    """Write a file in the work directory, returns its path."""
+    fp = open(self.Path(filename), 'w')
+    try:
+      fp.write(text)
+    finally:
+      fp.close()
+
+    return self.Path(filename)
+
+
+  def Render(self, filter, batch):
+    """Returns dict, output path -> output, of a spec with an output for each service."""
+    spec_path = self.WriteFile('machines.yaml', 'name: machines\ndatasource: ops\npath: %s\ntemplate: %s\n'
+                               'outer filter: SELECT id FROM service\nfilter: "%s"\nbatch filter: %s\n' %
+                               (self.Path('service-%(id)s.txt'), self.Path('row.tmpl'), filter, batch))
+
+    run = templateman.Render([spec_path], {'datasources': self.Path('datasources.yaml'),
+                                           'commands': os.path.join(ROOT, 'conf', 'commands.yaml'),
+                                           'no-output-file': True})
+
+    self.assertEqual(run['specs'][0]['error'], None)
+
+    return dict([(output['path'], output['output']) for output in run['specs'][0]['outputs']])
+
+
+  def testBatchSameAsPerOutput(self):
+    """Batched outputs have the same rows as one query per output."""
+    filter = 'SELECT id, name FROM machine WHERE service = %(id)s ORDER BY id'
+
+    outputs = self.Render(filter, 'false')
+    self.assertEqual(outputs[self.Path('service-1.txt')], 'web1\nweb2\n')
+    self.assertEqual(outputs[self.Path('service-2.txt')], 'db1\n')
+    self.assertEqual(outputs[self.Path('service-4.txt')], '')
+
+    self.assertEqual(self.Render(filter, 'true'), outputs)
+
+
+  def testBatchJoin(self):
+    """A join selecting two "id" columns groups by the filtered column, not the first "id", which is a machine's id."""
+    filter = ('SELECT * FROM machine, service WHERE machine.service = service.id AND service.id = %(id)s '
+              'ORDER BY machine.id')
+
+    outputs = self.Render(filter, 'false')
+    self.assertEqual(outputs[self.Path('service-1.txt')], 'web1\nweb2\n')
+    self.assertEqual(outputs[self.Path('service-3.txt')], 'cache1\n')
+
+    self.assertEqual(self.Render(filter, 'true'), outputs)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python2
+"""
+Render() API Tests
+
+Renders small specs from JSON data files in a temporary directory.
+
+usage: python -m unittest discover tests
+"""
+
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import templateman
+
+
+class RenderTest(unittest.TestCase):
+  """Renders specs of a "machines" JSON datasource, with the row template: %(name)s %(ip)s"""
+
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp(prefix='templateman_test_')
+
+    self.data_path = self.Path('machines.json')
+    self.WriteData([{'name': 'web1', 'ip': '10.0.0.1'}, {'name': 'web2', 'ip': '10.0.0.2'}])
+
+    self.WriteFile('datasources.yaml', 'machines:\n  type: json\n  path: %s\n' % self.data_path)
+    self.WriteFile('row.tmpl', '%(name)s %(ip)s\n')
+
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir)
+
+
+  def Path(self, filename):
+    """Returns string, path of a file in the work directory."""
+    return os.path.join(self.work_dir, filename)
+
+
+  def WriteFile(self, filename, text):
+    """Write a file in the work directory, returns its path."""
+    fp = open(self.Path(filename), 'w')
+    try:
+      fp.write(text)
+    finally:
+      fp.close()
+
+    return self.Path(filename)
+
+
+  def WriteData(self, records):
+    """Write the records of the machines datasource."""
+    self.WriteFile('machines.json', json.dumps(records))
+
+
+  def WriteSpec(self, filename, path=None):
+    """Write a spec rendering every machine, to path if given, returns its path."""
+    text = 'name: machines\ndatasource: machines\nfilter: {}\ntemplate: %s\n' % self.Path('row.tmpl')
+    if path:
+      text += 'path: %s\n' % path
+
+    return self.WriteFile(filename, text)
+
+
+  def Render(self, spec_path, options=None):
+    """Returns list of dicts, the outputs of rendering one spec with Render(), failing on errors.  The commands are
+    the default conf/commands.yaml.
+    """
+    render_options = {'datasources': self.Path('datasources.yaml')}
+    render_options.update(options or {})
+
+    run = templateman.Render([spec_path], render_options)
+
+    self.assertEqual(run['specs'][0]['error'], None)
+
+    return run['specs'][0]['outputs']
+
+
+  def testRenderAgainSeesChangedData(self):
+    """Query results are only cached for one Render() call."""
+    spec_path = self.WriteSpec('machines.yaml')
+
+    outputs = self.Render(spec_path, {'no-output-file': True})
+    self.assertEqual(outputs[0]['output'], 'web1 10.0.0.1\nweb2 10.0.0.2\n')
+
+    self.WriteData([{'name': 'web1', 'ip': '10.0.0.1'}, {'name': 'web3', 'ip': '10.0.0.3'},
+                    {'name': 'web4', 'ip': '10.0.0.4'}])
+
+    outputs = self.Render(spec_path, {'no-output-file': True})
+    self.assertEqual(outputs[0]['output'], 'web1 10.0.0.1\nweb3 10.0.0.3\nweb4 10.0.0.4\n')
+
+
+  def testCacheDirSeesChangedData(self):
+    """Query results cached on disk are not used once the data file changes."""
+    spec_path = self.WriteSpec('machines.yaml')
+    options = {'no-output-file': True, 'cache-dir': self.Path('cache')}
+
+    outputs = self.Render(spec_path, options)
+    self.assertEqual(outputs[0]['output'], 'web1 10.0.0.1\nweb2 10.0.0.2\n')
+
+    self.WriteData([{'name': 'web3', 'ip': '10.0.0.3'}])
+
+    outputs = self.Render(spec_path, options)
+    self.assertEqual(outputs[0]['output'], 'web3 10.0.0.3\n')
+
+
+  def testOutputWithoutPathIsReturned(self):
+    """A spec without a path has its output returned, with the default options."""
+    spec_path = self.WriteSpec('machines.yaml')
+
+    outputs = self.Render(spec_path)
+    self.assertEqual(outputs[0]['path'], None)
+    self.assertEqual(outputs[0]['output'], 'web1 10.0.0.1\nweb2 10.0.0.2\n')
+
+
+  def testOutputWithPathIsWritten(self):
+    """A spec with a path has its output written, and not returned, with the default options."""
+    spec_path = self.WriteSpec('machines.yaml', self.Path('machines.txt'))
+
+    outputs = self.Render(spec_path)
+    self.assertEqual(outputs[0]['output'], None)
+    self.assertEqual(outputs[0]['changed'], True)
+    self.assertEqual(open(self.Path('machines.txt')).read(), 'web1 10.0.0.1\nweb2 10.0.0.2\n')
+
+
+  def testMissingDatasourcesFile(self):
+    """A datasources file that does not exist is a configuration error naming the file."""
+    spec_path = self.WriteSpec('machines.yaml')
+
+    try:
+      templateman.Render([spec_path], {'datasources': self.Path('missing.yaml')})
+      self.fail('Render() did not raise ConfigurationError')
+    except templateman.ConfigurationError, e:
+      self.assertTrue(self.Path('missing.yaml') in str(e))
+
+
+if __name__ == '__main__':
+  unittest.main()
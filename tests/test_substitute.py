@@ -0,0 +1,99 @@
+#!/usr/bin/env python2
+"""
+Substitution Tests
+
+Substitutes static data and sub-spec outputs with templateman.SubstituteChunk(), for both the wrapper's parts and
+chunks of rows, which must give the same output as replacing the data one key at a time and then the sub-specs.
+
+usage: python -m unittest discover tests
+"""
+
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import templateman
+
+
+class SubstituteTest(unittest.TestCase):
+  """SubstituteChunk() of text with data and sub-spec outputs, which are rendered already."""
+
+  def Substitute(self, text, data, spec_outputs, rows):
+    """Returns string, the text substituted by SubstituteChunk()."""
+    spec_data = {'data': data, 'specs': dict([(key, None) for key in spec_outputs])}
+
+    return ''.join(templateman.SubstituteChunk(text, spec_data, dict(spec_outputs), set(), {}, {}, rows=rows))
+
+
+  def assertSubstitutes(self, text, data, spec_outputs, expected):
+    """Fail unless the text substitutes to the expected output, as wrapper text and as a chunk of rows."""
+    for rows in (False, True):
+      self.assertEqual(self.Substitute(text, data, spec_outputs, rows), expected, 'rows: %s' % rows)
+
+
+  def testNoSlots(self):
+    """Text without slots is unchanged."""
+    self.assertSubstitutes('', {'a': 1}, {'b': 'B'}, '')
+    self.assertSubstitutes('no slots', {'a': 1}, {}, 'no slots')
+    self.assertSubstitutes('100%', {'a': 1}, {'b': 'B'}, '100%')
+
+
+  def testDataAndSpecs(self):
+    """Data and sub-spec outputs are substituted, data first if they have the same key."""
+    self.assertSubstitutes('%(a)s %(b)s', {'a': 1}, {'b': 'B'}, '1 B')
+    self.assertSubstitutes('%(a)s', {'a': 'data'}, {'a': 'spec'}, 'data')
+
+
+  def testUnknownKeys(self):
+    """Slots that are not data or sub-specs are left in the output."""
+    self.assertSubstitutes('%(a)s %(b)s %(c)s', {'a': 1}, {'b': 'B'}, '1 B %(c)s')
+    self.assertSubstitutes('%(c)s %(a)s %(d)s', {'a': 1}, {}, '%(c)s 1 %(d)s')
+
+
+  def testPercentInData(self):
+    """Data values with "%" in them make new slots with the text around them, as the data is replaced first."""
+    self.assertSubstitutes('%(a)s', {'a': '100%'}, {'b': 'B'}, '100%')
+    self.assertSubstitutes('%(a)s', {'a': '%(b)s'}, {'b': 'B'}, 'B')
+    self.assertSubstitutes('%(a)s(b)s', {'a': '%'}, {'b': 'B'}, 'B')
+    self.assertSubstitutes('%(a)s %%(b)s', {'a': 'x'}, {'b': 'B'}, 'x %B')
+
+
+  def testTextMakesSlots(self):
+    """Text around a data slot makes a new slot with its value."""
+    self.assertSubstitutes('%(%(a)s)s', {'a': 'b'}, {'b': 'B'}, 'B')
+    self.assertSubstitutes('%(x)%(a)s', {'a': 's'}, {'x': 'X'}, 'X')
+    self.assertSubstitutes('%(pre%(a)s)s', {'a': 'fix'}, {'prefix': 'P'}, 'P')
+
+
+  def testSlotsInRowValues(self):
+    """Slots rendered into rows from their values are substituted like slots in the template."""
+    rows = 'web1 %(ttl)s\nweb2 %(static)s\nweb3 %(other)s\n'
+
+    self.assertEqual(self.Substitute(rows, {'ttl': 300}, {'static': 'S'}, True), 'web1 300\nweb2 S\nweb3 %(other)s\n')
+
+
+  def testSpecOutputWithSlots(self):
+    """Sub-spec outputs are not substituted again, even with slot text in them."""
+    self.assertSubstitutes('%(b)s', {'a': 1}, {'b': '%(a)s'}, '%(a)s')
+    self.assertSubstitutes('%(b)s %(a)s', {'a': 1}, {'b': '%(a)s %(b)s'}, '%(a)s %(b)s 1')
+
+
+  def testKeysNotStrings(self):
+    """Data keys that are not strings, or have parens, are substituted by their text."""
+    self.assertSubstitutes('%(1)s %(a(b))s', {1: 'one', 'a(b)': 'ab'}, {}, 'one ab')
+
+
+  def testManySlots(self):
+    """More slots than templateman.SINGLE_PASS_MAX_SLOTS have their data replaced one key at a time."""
+    count = templateman.SINGLE_PASS_MAX_SLOTS + 1
+
+    self.assertSubstitutes('%(a)s %(b)s ' * count, {'a': 1}, {'b': 'B'}, '1 B ' * count)
+    self.assertSubstitutes('%(a)s %(c)s ' * count, {'a': '%(b)s'}, {'b': 'B'}, 'B %(c)s ' * count)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,3 +1,12 @@
 import query
 import log
 import regex
+import template
+import output
+import cache
+import manifest
+import context
+import watch
+import timing
+import snapshot
+import precompiled
@@ -0,0 +1,260 @@
+"""
+Query Result Cache
+
+Caches datasource query results, so specs sending the same query during a run do not go back to the datasource.
+
+Results are keyed by datasource name and normalized query, expire after the datasource's "cache ttl", and the least
+recently used are evicted past CACHE_SIZE entries.  Results in memory only last for one run: Clear() is called at the
+start and end of each run (including each --watch run, and each Render() call), so a later run sees changed data.  If
+CACHE_DIR is set, results are also kept on disk between runs, until their "cache ttl" expires, or the data file or
+SQLite file they were read from changes (see query.CachedQuery()).
+
+Cached results are shared by every caller, so they must not be modified.
+"""
+
+
+import cPickle
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+
+from log import log, WARNING
+
+
+# Default seconds a result is cached, datasource "cache ttl" overrides it.  0 disables caching for a datasource.
+DEFAULT_TTL = 300
+
+# Maximum results kept in memory, least recently used are evicted first
+CACHE_SIZE = 256
+
+# Directory for the on-disk layer, None to only cache in memory
+CACHE_DIR = None
+
+# key -> (expires_time, result), in least to most recently used order
+CACHE = OrderedDict()
+CACHE_LOCK = threading.Lock()
+
+STATS = {
+  'hits': 0,
+  'disk_hits': 0,
+  'misses': 0,
+  'expired': 0,
+  'evictions': 0,
+}
+
+# Quoted SQL strings, which must keep their whitespace when the query is normalized
+QUOTED_REGEX = re.compile(r'''('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")''')
+
+
+def NormalizeQuery(query):
+  """Returns string, the query with insignificant differences removed, so equivalent queries share a key.
+
+  SQL has whitespace collapsed outside of quoted strings and any trailing semicolon removed.  Other filters (dicts
+  for file datasources) are normalized by sorting their keys.
+  """
+  if isinstance(query, basestring):
+    parts = QUOTED_REGEX.split(query)
+
+    # Even parts are outside quotes
+    for index in range(0, len(parts), 2):
+      parts[index] = ' '.join(parts[index].split())
+
+    return ''.join(parts).strip().rstrip(';').rstrip()
+
+  elif isinstance(query, dict):
+    return repr(sorted((key, NormalizeQuery(value)) for (key, value) in query.items()))
+
+  elif isinstance(query, (list, tuple)):
+    return repr([NormalizeQuery(value) for value in query])
+
+  else:
+    return repr(query)
+
+
+def MakeKey(datasource, query):
+  """Returns string, the cache key for this query on this datasource."""
+  # Datasources are named when loaded, fall back on their contents for datasources passed in directly
+  if datasource.get('name', None):
+    datasource_key = datasource['name']
+  else:
+    datasource_key = repr(sorted(datasource.items()))
+
+  return '%s:%s' % (datasource_key, NormalizeQuery(query))
+
+
+def Get(key):
+  """Returns (found, result).  found is False if the key is not cached or has expired."""
+  now = time.time()
+
+  CACHE_LOCK.acquire()
+  try:
+    if key in CACHE:
+      (expires, result) = CACHE.pop(key)
+
+      if expires > now:
+        # Move to the most recently used end
+        CACHE[key] = (expires, result)
+        STATS['hits'] += 1
+        return (True, result)
+
+      STATS['expired'] += 1
+
+  finally:
+    CACHE_LOCK.release()
+
+  # Try the on-disk layer
+  if CACHE_DIR:
+    entry = ReadDisk(key)
+
+    if entry and entry[0] > now:
+      CACHE_LOCK.acquire()
+      try:
+        CacheEntry(key, entry)
+        STATS['disk_hits'] += 1
+      finally:
+        CACHE_LOCK.release()
+
+      return (True, entry[1])
+
+  CACHE_LOCK.acquire()
+  STATS['misses'] += 1
+  CACHE_LOCK.release()
+
+  return (False, None)
+
+
+def Set(key, result, ttl=DEFAULT_TTL):
+  """Cache the result for ttl seconds."""
+  entry = (time.time() + ttl, result)
+
+  CACHE_LOCK.acquire()
+  try:
+    CacheEntry(key, entry)
+  finally:
+    CACHE_LOCK.release()
+
+  if CACHE_DIR:
+    WriteDisk(key, entry)
+
+
+def CacheEntry(key, entry):
+  """Store an entry in memory, evicting the least recently used past CACHE_SIZE.  Must hold CACHE_LOCK."""
+  CACHE.pop(key, None)
+  CACHE[key] = entry
+
+  while len(CACHE) > CACHE_SIZE:
+    CACHE.popitem(last=False)
+    STATS['evictions'] += 1
+
+
+def Clear():
+  """Drop the results cached in memory, and reset the counters, for a new run.  The on-disk layer is kept."""
+  CACHE_LOCK.acquire()
+  try:
+    CACHE.clear()
+
+    for key in STATS:
+      STATS[key] = 0
+
+  finally:
+    CACHE_LOCK.release()
+
+
+def Invalidate(datasource_name=None):
+  """Drop cached results for a datasource, or all results if no datasource is given.  Includes the on-disk layer."""
+  prefix = '%s:' % datasource_name
+
+  CACHE_LOCK.acquire()
+  try:
+    for key in CACHE.keys():
+      if datasource_name == None or key.startswith(prefix):
+        del CACHE[key]
+  finally:
+    CACHE_LOCK.release()
+
+  if CACHE_DIR and os.path.isdir(CACHE_DIR):
+    for filename in os.listdir(CACHE_DIR):
+      if not filename.endswith('.query'):
+        continue
+
+      path = os.path.join(CACHE_DIR, filename)
+      if datasource_name != None:
+        entry_key = ReadDiskKey(path)
+        if entry_key == None or not entry_key.startswith(prefix):
+          continue
+
+      try:
+        os.unlink(path)
+      except OSError:
+        pass
+
+
+def DiskPath(key):
+  """Returns string, path of the on-disk entry for this key."""
+  return os.path.join(CACHE_DIR, '%s.query' % hashlib.sha1(key).hexdigest())
+
+
+def ReadDisk(key):
+  """Returns (expires_time, result) from the on-disk layer, or None if not there or unreadable."""
+  try:
+    fp = open(DiskPath(key), 'rb')
+    try:
+      (entry_key, entry) = cPickle.load(fp)
+    finally:
+      fp.close()
+
+  except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+    return None
+
+  # Guard against hash collisions
+  if entry_key != key:
+    return None
+
+  return entry
+
+
+def ReadDiskKey(path):
+  """Returns string, the key stored in an on-disk entry, or None if unreadable."""
+  try:
+    fp = open(path, 'rb')
+    try:
+      return cPickle.load(fp)[0]
+    finally:
+      fp.close()
+
+  except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+    return None
+
+
+def WriteDisk(key, entry):
+  """Write an entry to the on-disk layer.  Failures are logged, the in-memory cache still works without it."""
+  try:
+    if not os.path.isdir(CACHE_DIR):
+      os.makedirs(CACHE_DIR)
+
+    (fd, temp_path) = tempfile.mkstemp(suffix='.tmp', dir=CACHE_DIR)
+    fp = os.fdopen(fd, 'wb')
+    try:
+      cPickle.dump((key, entry), fp, cPickle.HIGHEST_PROTOCOL)
+    finally:
+      fp.close()
+
+    os.rename(temp_path, DiskPath(key))
+
+  except (IOError, OSError, cPickle.PicklingError), e:
+    log('WARNING: Could not write query cache entry: %s: %s' % (CACHE_DIR, e), level=WARNING)
+
+
+def GetStats():
+  """Returns dict, copy of the cache counters."""
+  CACHE_LOCK.acquire()
+  stats = dict(STATS)
+  stats['size'] = len(CACHE)
+  CACHE_LOCK.release()
+
+  return stats
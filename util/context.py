@@ -0,0 +1,180 @@
+"""
+Run Context
+
+Holds the files read during a run: datasources, commands, specs, templates and includes.  Each file is read and parsed
+once, and served from memory after that, so many specs (and outer filter outputs) sharing the same files do not parse
+them again.  Entries are keyed by path, mtime and size, so a file changed during the run is read again.
+
+Parsed files can also be kept on disk between runs (see util/precompiled.py).
+
+YAML is parsed with libyaml's CSafeLoader when it is available.  PyYAML is imported on first use, so a run that loads
+every YAML file from the precompiled cache does not import it.
+
+Loaded values are shared by every caller, so they must not be modified.
+"""
+
+
+import os
+import threading
+
+import precompiled
+import timing
+from template import CompiledTemplate
+
+
+# PyYAML and its loader, imported by ImportYaml()
+yaml = None
+SafeLoader = None
+
+
+def FileKey(path):
+  """Returns (absolute path, mtime, size), which changes whenever the file does."""
+  abs_path = os.path.abspath(path)
+  stat = os.stat(abs_path)
+
+  return (abs_path, stat.st_mtime, stat.st_size)
+
+
+def ImportYaml():
+  """Import PyYAML, and its fastest safe loader."""
+  global yaml, SafeLoader
+
+  import yaml
+
+  try:
+    from yaml import CSafeLoader as SafeLoader
+  except ImportError:
+    from yaml import SafeLoader
+
+
+def ParseYaml(text):
+  """Returns the data in a YAML document."""
+  if yaml == None:
+    ImportYaml()
+
+  return yaml.load(text, Loader=SafeLoader)
+
+
+class RunContext(object):
+  """Files loaded for one run, and the templates built from them."""
+
+  def __init__(self, precompiled_dir=None):
+    # (kind, file key, salt) -> value, kind is "text", "yaml" or "tokens"
+    self.files = {}
+
+    # Directory of the precompiled cache, None to parse files every run
+    self.precompiled_dir = precompiled_dir
+
+    # Processed include files: file key -> text
+    self.includes = {}
+
+    # Rendered %%PROCESS%% specs: file key -> text
+    self.processed = {}
+    
+    # Absolute paths of the sub-specs used more than once in the run, and their rendered output: file key -> text
+    self.shared = set()
+    self.rendered = {}
+
+    # Compiled templates, shared by every output and sub-spec using them: template text -> CompiledTemplate
+    self.templates = {}
+
+    # Absolute paths of the files read, cleared by the caller to find the files one spec reads (--watch)
+    self.accessed = set()
+
+    self.lock = threading.Lock()
+
+
+  def NewRun(self):
+    """Start another run (--watch) with this context.  Parsed files are kept until they change, but processed
+    includes and specs, and shared sub-specs, are rendered again, as they have data in them.  Compiled templates are
+    dropped with them, so templates with the last run's data are not kept.
+    """
+    self.lock.acquire()
+    try:
+      for key in self.files.keys():
+        try:
+          if FileKey(key[1][0]) != key[1]:
+            del self.files[key]
+        except OSError:
+          del self.files[key]
+
+      self.includes = {}
+      self.processed = {}
+      self.rendered = {}
+      self.templates = {}
+
+    finally:
+      self.lock.release()
+
+
+  def Load(self, path, kind, parse, salt='', precompile=False):
+    """Returns the parsed file, parsing it only the first time.  Parsing is not locked, at worst a file is parsed twice.
+
+    Args:
+      salt: string, anything else the parse depends on
+      precompile: boolean, if True the parsed file is also kept in the precompiled cache, if there is one.  The
+          parsed value must be made of builtin types.
+    """
+    key = (kind, FileKey(path), salt)
+    self.accessed.add(key[1][0])
+
+    self.lock.acquire()
+    try:
+      if key in self.files:
+        return self.files[key]
+    finally:
+      self.lock.release()
+
+    found = False
+    if precompile and self.precompiled_dir:
+      with timing.Start('precompiled %s' % kind, path):
+        (found, value) = precompiled.Get(self.precompiled_dir, kind, key[1], salt)
+
+    if not found:
+      with timing.Start('parse %s' % kind, path):
+        fp = open(path)
+        try:
+          text = fp.read()
+        finally:
+          fp.close()
+
+        value = parse(text)
+
+      if precompile and self.precompiled_dir:
+        precompiled.Set(self.precompiled_dir, kind, key[1], text, value, salt)
+
+    self.lock.acquire()
+    try:
+      return self.files.setdefault(key, value)
+    finally:
+      self.lock.release()
+
+
+  def CompileTemplate(self, text):
+    """Returns CompiledTemplate for the template text, compiling it only the first time.  Not locked while compiling,
+    at worst a template is compiled twice.
+    """
+    self.lock.acquire()
+    try:
+      if text in self.templates:
+        return self.templates[text]
+    finally:
+      self.lock.release()
+
+    template = CompiledTemplate(text)
+
+    self.lock.acquire()
+    try:
+      return self.templates.setdefault(text, template)
+    finally:
+      self.lock.release()
+
+
+  def ReadFile(self, path):
+    """Returns string, the text of the file."""
+    return self.Load(path, 'text', str)
+
+
+  def LoadYaml(self, path):
+    """Returns the data in the YAML (or JSON) file."""
+    return self.Load(path, 'yaml', ParseYaml, precompile=True)
@@ -0,0 +1,299 @@
+"""
+File Datasource Handler
+
+YAML and JSON data files, treated as Python lists of dicts, so records/rows of fields (key/value).  A file with a dict
+of records at the top level has its records taken in order of their keys.
+
+Files are loaded once per process, and only reloaded when their mtime or size changes.  Filters are dicts of
+field: value, matched with hash indexes that are built the first time a field is filtered on, so specs do not scan
+every record of a large inventory.
+
+Datasources with a "relationship" have the fields of their related records embedded, under the field name
+"relation_field.target_field".  Each relationship is a hash join: the target datasource is indexed on its target field
+once, and each record probes that index.  Joined records and join indexes are kept for the run and shared by every
+spec, until one of the files involved changes.
+"""
+
+
+import json
+import os
+import threading
+
+from context import ParseYaml
+
+
+# path -> (mtime, size, records)
+FILES = {}
+
+# (records key, field) -> (signature, index), index is dict: field value -> list of record positions, in order
+INDEXES = {}
+
+# datasource name -> (signature, records), the records with their relationships joined in
+JOINED = {}
+
+# (datasource name, target field) -> (signature, index), index is dict: field value -> first record with that value
+JOIN_INDEXES = {}
+
+LOCK = threading.RLock()
+
+
+class FileDatasourceError(Exception):
+  """Failure to load or filter a data file."""
+
+
+def Query(datasource, filter, datasources=None):
+  """Wrap LoadRecords and Filter with datasource/filter interface.
+
+  Args:
+    datasources: dict of all datasources by name, to find the targets of relationships
+
+  Returns: list of dicts, the matching records in file order.  They are shared with the loaded file, so must not be
+      modified.
+  """
+  (key, signature, records) = LoadRecords(datasource, datasources)
+
+  return Filter(key, signature, records, filter)
+
+
+def LoadRecords(datasource, datasources=None, chain=()):
+  """Returns (key, signature, records) for a datasource, with any relationships joined into the records.
+
+  key identifies the records for indexing, and signature changes whenever any file they were built from changes.
+  """
+  records = Load(datasource['path'], datasource['type'])
+  signature = (FileSignature(datasource['path']),)
+
+  relationships = datasource.get('relationship', None)
+  if not relationships:
+    return (datasource['path'], signature, records)
+
+  name = datasource.get('name', datasource['path'])
+  if name in chain:
+    raise FileDatasourceError('Relationship cycle: %s' % ' -> '.join(chain + (name,)))
+
+  if not datasources:
+    raise FileDatasourceError('Relationships need all datasources to find their targets: %s' % name)
+
+  # Load the targets first, so their own relationships are joined in (chained relationships), and so the signature
+  #   covers every file in the join
+  targets = []
+  for (field, target) in sorted(relationships.items()):
+    try:
+      (target_name, target_field) = target.split('.', 1)
+      target_datasource = datasources[target_name]
+    except (ValueError, KeyError):
+      raise FileDatasourceError('Relationship target must be "datasource.field" of a known datasource: %s: %s: %s' % (name, field, target))
+
+    (target_key, target_signature, target_records) = LoadRecords(target_datasource, datasources, chain + (name,))
+    signature += target_signature
+
+    targets.append((field, target_name, target_field, target_signature, target_records))
+
+  LOCK.acquire()
+  try:
+    if name in JOINED and JOINED[name][0] == signature:
+      return (('joined', name), signature, JOINED[name][1])
+
+    joined = Join(records, targets)
+    JOINED[name] = (signature, joined)
+
+    return (('joined', name), signature, joined)
+
+  finally:
+    LOCK.release()
+
+
+def Join(records, targets):
+  """Returns list of dicts, copies of records with the fields of their related target records embedded.
+
+  Records without a related record keep only their own fields, so missing data in a target does not drop records
+  from the output.
+  """
+  joined = []
+
+  for record in records:
+    joined.append(dict(record))
+
+  for (field, target_name, target_field, target_signature, target_records) in targets:
+    index = GetJoinIndex(target_name, target_field, target_signature, target_records)
+
+    # Embed each target record's fields under prefixed names, prefixing the field names once per target record
+    prefixed = {}
+
+    for record in joined:
+      try:
+        related = index.get(record.get(field, None), None)
+      except TypeError:
+        related = None
+
+      if related == None:
+        continue
+
+      related_id = id(related)
+      if related_id not in prefixed:
+        prefixed[related_id] = [('%s.%s' % (field, key), value) for (key, value) in related.items()]
+
+      record.update(prefixed[related_id])
+
+  return joined
+
+
+def GetJoinIndex(name, field, signature, records):
+  """Returns dict, field value -> first record with that value, building it once per run for each target field."""
+  key = (name, field)
+
+  LOCK.acquire()
+  try:
+    if key in JOIN_INDEXES and JOIN_INDEXES[key][0] == signature:
+      return JOIN_INDEXES[key][1]
+
+    index = {}
+    for record in records:
+      try:
+        index.setdefault(record.get(field, None), record)
+      except TypeError:
+        pass
+
+    JOIN_INDEXES[key] = (signature, index)
+
+    return index
+
+  finally:
+    LOCK.release()
+
+
+def FileSignature(path):
+  """Returns (path, mtime, size) of a loaded file."""
+  return (path,) + FILES[path][:2]
+
+
+def Load(path, file_type):
+  """Returns list of dicts, the records in the data file, loading it if it is new or changed."""
+  try:
+    stat = os.stat(path)
+  except OSError, e:
+    raise FileDatasourceError('Data file not found: %s: %s' % (path, e))
+
+  LOCK.acquire()
+  try:
+    if path in FILES and FILES[path][:2] == (stat.st_mtime, stat.st_size):
+      return FILES[path][2]
+
+    try:
+      fp = open(path)
+      try:
+        if file_type == 'json':
+          records = json.load(fp)
+        else:
+          records = ParseYaml(fp.read())
+      finally:
+        fp.close()
+
+    except Exception, e:
+      raise FileDatasourceError('Data file is not a %s file or has a formatting error: %s: %s' % (file_type.upper(), path, e))
+
+    # An empty file is an empty data set
+    if records == None:
+      records = []
+
+    # Records keyed by name are also accepted, ordered by their keys
+    if type(records) == dict:
+      records = [records[key] for key in sorted(records)]
+
+    if type(records) != list:
+      raise FileDatasourceError('Data file is not formatted as a List at the top level: %s' % path)
+
+    for record in records:
+      if type(record) != dict:
+        raise FileDatasourceError('Data file record is not formatted as a Dictionary: %s: %s' % (path, str(record)[:100]))
+
+    FILES[path] = (stat.st_mtime, stat.st_size, records)
+
+    return records
+
+  finally:
+    LOCK.release()
+
+
+def GetIndex(key, signature, records, field):
+  """Returns dict, field value -> list of positions of the records with that value, building it if needed.
+
+  Records without the field are indexed under None.  Unhashable values (lists, dicts) are not indexed.
+  """
+  index_key = (key, field)
+
+  LOCK.acquire()
+  try:
+    if index_key in INDEXES and INDEXES[index_key][0] == signature:
+      return INDEXES[index_key][1]
+
+    index = {}
+    for (position, record) in enumerate(records):
+      value = record.get(field, None)
+
+      try:
+        index.setdefault(value, []).append(position)
+      except TypeError:
+        pass
+
+    INDEXES[index_key] = (signature, index)
+
+    return index
+
+  finally:
+    LOCK.release()
+
+
+def Filter(key, signature, records, filter):
+  """Returns list of dicts, the records matching the filter, in file order.
+
+  Args:
+    filter: dict of field: value, records must match all fields.  A list value matches any of its values.  An empty
+        filter matches all records.
+  """
+  if not filter:
+    return list(records)
+
+  if type(filter) != dict:
+    raise FileDatasourceError('Data file filters must be a Dictionary of field: value, not: %s' % str(filter)[:100])
+
+  # Find the positions matching each field from its index, and start from the fewest
+  candidates = None
+  for (field, value) in filter.items():
+    index = GetIndex(key, signature, records, field)
+
+    if type(value) == list:
+      positions = set()
+      for item in value:
+        positions.update(index.get(item, []))
+      positions = sorted(positions)
+
+    else:
+      positions = index.get(value, [])
+
+    if candidates == None or len(positions) < len(candidates):
+      candidates = positions
+
+    # Nothing can match all fields
+    if not candidates:
+      return []
+
+  # Check the remaining fields on the candidates directly, which is cheaper than intersecting more indexes
+  result = []
+  for position in candidates:
+    record = records[position]
+
+    for (field, value) in filter.items():
+      record_value = record.get(field, None)
+
+      if type(value) == list:
+        if record_value not in value:
+          break
+
+      elif record_value != value:
+        break
+
+    else:
+      result.append(record)
+
+  return result
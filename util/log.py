@@ -1,14 +1,258 @@
 """
 Logging
+
+Leveled log messages, to STDERR and optionally to a JSON lines file (--log-json).  Messages below LEVEL are dropped
+before they are formatted, so DEBUG (--verbose) messages cost almost nothing in a normal run.  Large values, such as
+query results, are wrapped in Brief(), and logged as a count and their first items.
+
+Lines are buffered, and written every FLUSH_LINES lines or FLUSH_SECONDS, on WARNING and ERROR messages, and at exit.
 """
 
+import atexit
+import json
+import os
+import threading
 import time
 import sys
 
 
-def log(text):
-  """Send log messages to STDERR, so we can template to STDOUT by default (no output path, easier testing)"""
-  timestamp = '[%d-%02d-%02d %02d:%02d:%02d] ' % time.localtime()[:6]
-  sys.stderr.write(timestamp + str(text) + '\n')
-  sys.stderr.flush()
+# Levels
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+
+# Messages below this level are dropped
+LEVEL = INFO
+
+# Buffered lines are written when there are this many, or the first was buffered this many seconds ago
+FLUSH_LINES = 200
+FLUSH_SECONDS = 1.0
+
+# Brief() values show this many items, and at most this many characters
+BRIEF_ITEMS = 5
+BRIEF_CHARS = 1000
+
+# Open JSON lines file, or None
+JSON_FILE = None
+
+# Lines waiting to be written to STDERR, and to the JSON lines file
+BUFFER = []
+JSON_BUFFER = []
+BUFFER_LOCK = threading.RLock()
+
+# Time the first buffered line was buffered, None if the buffer is empty
+BUFFER_STARTED = None
+
+# Process the buffers belong to.  A forked process drops the lines it inherited, they are its parent's to write.
+BUFFER_PID = os.getpid()
+
+# (second, timestamp text), so the time is only formatted once a second
+TIMESTAMP = (None, '')
+
+# Per thread list of captured log records, while capturing.  Parallel work captures its log records so they can be
+#   written in a deterministic order, instead of interleaving.
+CAPTURE = threading.local()
+
+
+class Brief(object):
+  """A large value in a log message, formatted only if the message is logged, as a count and its first BRIEF_ITEMS
+  items (lists, and query results), and at most BRIEF_CHARS characters.
+  """
+
+  def __init__(self, value, name='items'):
+    self.value = value
+    self.name = name
+
+
+  def __str__(self):
+    value = self.value
+
+    # Streamed results can only be iterated once, by their template
+    if hasattr(value, 'batches'):
+      return '(streamed %s)' % self.name
+
+    # Rows of tuples, see util/rows.py
+    if hasattr(value, 'tuples'):
+      items = list(value.__class__(value.columns, value.tuples[:BRIEF_ITEMS]))
+      text = self.Items(len(value), items)
+
+    elif isinstance(value, (list, tuple)):
+      text = self.Items(len(value), value[:BRIEF_ITEMS])
+
+    else:
+      text = str(value)
+
+    if len(text) > BRIEF_CHARS:
+      text = '%s... (%s characters)' % (text[:BRIEF_CHARS], len(text))
+
+    return text
+
+
+  def Items(self, count, items):
+    """Returns string, the count of items, and the first of them."""
+    if count > len(items):
+      return '%s %s, first %s: %s' % (count, self.name, len(items), list(items))
+    else:
+      return '%s %s: %s' % (count, self.name, list(items))
+
+
+def log(text, *args, **kwargs):
+  """Send log messages to STDERR, so we can template to STDOUT by default (no output path, easier testing)
+
+  Args:
+    args: values formatted into text with %, only if the message is logged
+    level: keyword, DEBUG, INFO (default), WARNING or ERROR
+  """
+  level = kwargs.get('level', INFO)
+  if level < LEVEL:
+    return
+
+  if args:
+    text = text % args
+
+  record = (time.time(), level, str(text))
+
+  captured = getattr(CAPTURE, 'lines', None)
+  if captured != None:
+    captured.append(record)
+    return
+
+  Emit([record])
+
+
+def LogEnabled(level):
+  """Returns boolean, True if messages at this level are logged.  For messages that need work to build."""
+  return level >= LEVEL
+
+
+def SetLogOptions(level, json_path=None):
+  """Set the level messages are logged at, and the JSON lines file they are also written to (appended), if any."""
+  global LEVEL, JSON_FILE
+
+  FlushLog()
+
+  LEVEL = level
+
+  BUFFER_LOCK.acquire()
+  try:
+    if JSON_FILE and JSON_FILE.name != json_path:
+      JSON_FILE.close()
+      JSON_FILE = None
+
+    if json_path and not JSON_FILE:
+      JSON_FILE = open(json_path, 'a')
+
+  finally:
+    BUFFER_LOCK.release()
+
+
+def Timestamp(created):
+  """Returns string, the log line prefix for a time.  Must hold BUFFER_LOCK."""
+  global TIMESTAMP
+
+  second = int(created)
+  if TIMESTAMP[0] != second:
+    TIMESTAMP = (second, '[%d-%02d-%02d %02d:%02d:%02d] ' % time.localtime(second)[:6])
+
+  return TIMESTAMP[1]
+
+
+def OwnBuffers():
+  """Drop the lines inherited from a parent process, if this is a forked process.  Must hold BUFFER_LOCK."""
+  global BUFFER_PID, BUFFER_STARTED
+
+  if BUFFER_PID != os.getpid():
+    del BUFFER[:]
+    del JSON_BUFFER[:]
+    BUFFER_STARTED = None
+    BUFFER_PID = os.getpid()
+
+
+def Emit(records):
+  """Buffer log records, (time, level, message), writing the buffers if they are due."""
+  global BUFFER_STARTED
+
+  BUFFER_LOCK.acquire()
+  try:
+    OwnBuffers()
+
+    if BUFFER_STARTED == None:
+      BUFFER_STARTED = time.time()
+
+    flush = False
+
+    for (created, level, message) in records:
+      BUFFER.append(Timestamp(created) + message + '\n')
+
+      if JSON_FILE:
+        JSON_BUFFER.append(json.dumps({'time': created, 'level': LEVEL_NAMES.get(level, level),
+                                       'message': message.decode('utf-8', 'replace')}) + '\n')
+
+      if level >= WARNING:
+        flush = True
+
+    if flush or len(BUFFER) >= FLUSH_LINES or time.time() - BUFFER_STARTED >= FLUSH_SECONDS:
+      FlushLog()
+
+  finally:
+    BUFFER_LOCK.release()
+
+
+def FlushLog():
+  """Write the buffered log lines."""
+  global BUFFER_STARTED
+
+  BUFFER_LOCK.acquire()
+  try:
+    OwnBuffers()
+
+    if BUFFER:
+      sys.stderr.write(''.join(BUFFER))
+      sys.stderr.flush()
+      del BUFFER[:]
+
+    if JSON_BUFFER:
+      if JSON_FILE:
+        JSON_FILE.write(''.join(JSON_BUFFER))
+        JSON_FILE.flush()
+      del JSON_BUFFER[:]
+
+    BUFFER_STARTED = None
+
+  finally:
+    BUFFER_LOCK.release()
+
+
+# Write whatever is still buffered when the process exits
+atexit.register(FlushLog)
+
+
+def StartLogCapture():
+  """Hold this thread's log messages, until StopLogCapture()."""
+  CAPTURE.lines = []
+
+
+def StopLogCapture():
+  """Stop holding this thread's log messages.
+
+  Returns: list of log records held since StartLogCapture()
+  """
+  lines = getattr(CAPTURE, 'lines', None) or []
+  CAPTURE.lines = None
+
+  return lines
+
+
+def WriteLog(lines):
+  """Write log records held by a capture, in the order they were logged."""
+  # Nested captures pass their records up to the enclosing one
+  captured = getattr(CAPTURE, 'lines', None)
+  if captured != None:
+    captured.extend(lines)
+    return
 
+  if lines:
+    Emit(lines)
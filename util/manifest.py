@@ -0,0 +1,94 @@
+"""
+Build Manifest
+
+Records a fingerprint of all the inputs to each output file, so an output whose inputs have not changed since the last
+run is not rendered or written again.  Manifests are JSON files of output path -> fingerprint.
+"""
+
+
+import json
+import os
+import tempfile
+import threading
+
+from log import log, WARNING
+
+
+# Manifest path of a manifest only kept in memory, never loaded or saved (--watch without --manifest)
+IN_MEMORY = ':memory:'
+
+# manifest path -> dict of absolute output path -> fingerprint, loaded on first use
+MANIFESTS = {}
+
+LOCK = threading.Lock()
+
+
+def Load(manifest_path):
+  """Returns dict, the manifest's entries, loading it on first use.  Must hold LOCK."""
+  if manifest_path not in MANIFESTS:
+    entries = {}
+
+    if manifest_path != IN_MEMORY and os.path.exists(manifest_path):
+      try:
+        fp = open(manifest_path)
+        try:
+          entries = json.load(fp)
+        finally:
+          fp.close()
+
+      # Rebuilding everything is always safe, so a bad manifest is not fatal
+      except ValueError, e:
+        log('WARNING: Manifest is not a JSON file, all outputs will be rebuilt: %s: %s' % (manifest_path, e), level=WARNING)
+
+    MANIFESTS[manifest_path] = entries
+
+  return MANIFESTS[manifest_path]
+
+
+def Get(manifest_path, output_path):
+  """Returns string, the fingerprint recorded for the output path, or None."""
+  LOCK.acquire()
+  try:
+    return Load(manifest_path).get(os.path.abspath(output_path), None)
+  finally:
+    LOCK.release()
+
+
+def Set(manifest_path, output_path, fingerprint):
+  """Record the fingerprint for the output path.  Written to disk by Save()."""
+  LOCK.acquire()
+  try:
+    Load(manifest_path)[os.path.abspath(output_path)] = fingerprint
+  finally:
+    LOCK.release()
+
+
+def Save(manifest_path):
+  """Write the manifest, replacing it in one rename."""
+  if manifest_path == IN_MEMORY:
+    return
+  
+  LOCK.acquire()
+  try:
+    entries = Load(manifest_path)
+
+    dir_path = os.path.dirname(manifest_path) or '.'
+    if not os.path.isdir(dir_path):
+      os.makedirs(dir_path)
+
+    (fd, temp_path) = tempfile.mkstemp(prefix='.%s.' % os.path.basename(manifest_path), suffix='.tmp', dir=dir_path)
+    try:
+      fp = os.fdopen(fd, 'w')
+      try:
+        json.dump(entries, fp, indent=2, sort_keys=True)
+      finally:
+        fp.close()
+
+      os.rename(temp_path, manifest_path)
+
+    except:
+      os.unlink(temp_path)
+      raise
+
+  finally:
+    LOCK.release()
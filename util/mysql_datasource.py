@@ -5,7 +5,12 @@ Wraps all the things we need to work with MySQL queries, for a data source.
 """
 
 
-from log import log
+import os
+import threading
+import time
+
+from log import log, WARNING, ERROR
+from rows import Rows
 
 
 # Import MySQLdb or mysql.connector.  We wil use either.
@@ -39,91 +44,460 @@ class MysqlQueryFailure(Exception):
   """Failure to query the DB properly"""
 
 
+# Default maximum connections kept open per (host, port, user, database), datasource "pool size" overrides it
+POOL_SIZE = 4
+
+# Default seconds a connection can sit idle in the pool before it is closed, datasource "pool idle timeout" overrides it
+POOL_IDLE_TIMEOUT = 300
+
+# Seconds to wait for a connection when all of a pool's connections are in use
+POOL_WAIT_TIMEOUT = 60
+
+# Connections idle longer than this many seconds are pinged before reuse.  Recently used ones go straight to the query,
+#   where a lost connection is still caught by the 2006 reconnect
+POOL_HEALTH_CHECK_INTERVAL = 30
+
+# Default rows fetched at a time from a streaming (server-side) cursor, datasource "stream batch size" overrides it
+STREAM_BATCH_SIZE = 1000
+
+# Connection pools, keyed by (host, port, user, database)
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+# Process that opened the pooled connections.  Forked workers must not share the parent's connections.
+POOLS_PID = os.getpid()
+
+# Pools inherited by a forked worker.  They are kept referenced, so they are never closed (or garbage collected) in
+#   the worker, which would close the parent's connections on the server.
+INHERITED_POOLS = []
+
+# Counters across all pools, to check how many connections are being saved
+STATS = {
+  'opened': 0,
+  'reused': 0,
+  'closed': 0,
+  'reconnects': 0,
+  'waits': 0,
+  'wait_time': 0.0,
+}
+STATS_LOCK = threading.Lock()
+
+
+class ConnectionPool:
+  """Reusable connections to one MySQL database."""
+  
+  def __init__(self, host, user, password, database, port, size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+    self.host = host
+    self.user = user
+    self.password = password
+    self.database = database
+    self.port = port
+    self.size = size
+    self.idle_timeout = idle_timeout
+    
+    # List of (conn, cursor, last_used_time), most recently used last
+    self.idle = []
+    self.in_use = 0
+    self.condition = threading.Condition()
+  
+  
+  def Acquire(self):
+    """Returns (conn, cursor), an idle connection that passed its health check, or a new one if under the size cap."""
+    self.condition.acquire()
+    try:
+      self.EvictIdle()
+      
+      started = None
+      while not self.idle and self.in_use >= self.size:
+        if started == None:
+          started = time.time()
+          Count('waits')
+        
+        remaining = POOL_WAIT_TIMEOUT - (time.time() - started)
+        if remaining <= 0:
+          raise MysqlQueryFailure('Timed out waiting for a connection: %s: %s' % (self.host, self.database))
+        
+        self.condition.wait(remaining)
+      
+      if started != None:
+        Count('wait_time', time.time() - started)
+      
+      if self.idle:
+        (conn, cursor, last_used) = self.idle.pop()
+      else:
+        (conn, cursor, last_used) = (None, None, None)
+      
+      self.in_use += 1
+    
+    finally:
+      self.condition.release()
+    
+    # Connect or health check outside the lock, these are network round trips
+    try:
+      if conn == None:
+        (conn, cursor) = self.Connect()
+      
+      elif time.time() - last_used > POOL_HEALTH_CHECK_INTERVAL and not HealthCheck(conn):
+        log('Pooled connection failed health check, reconnecting: %s: %s' % (self.host, self.database))
+        (conn, cursor) = self.Reconnect(conn)
+      
+      else:
+        Count('reused')
+    
+    except:
+      self.condition.acquire()
+      self.in_use -= 1
+      self.condition.notify()
+      self.condition.release()
+      raise
+    
+    return (conn, cursor)
+  
+  
+  def Release(self, conn, cursor):
+    """Return a connection from Acquire() to the pool."""
+    self.condition.acquire()
+    try:
+      self.in_use -= 1
+      self.idle.append((conn, cursor, time.time()))
+      self.EvictIdle()
+      self.condition.notify()
+    
+    finally:
+      self.condition.release()
+  
+  
+  def Discard(self, conn):
+    """Close a connection from Acquire() instead of returning it to the pool, when it can not be reused."""
+    Close(conn)
+    
+    self.condition.acquire()
+    try:
+      self.in_use -= 1
+      self.condition.notify()
+    
+    finally:
+      self.condition.release()
+  
+  
+  def Connect(self):
+    """Returns (conn, cursor), a new connection for this pool."""
+    result = Connect(self.host, self.user, self.password, self.database, self.port)
+    Count('opened')
+    
+    return result
+  
+  
+  def Reconnect(self, conn):
+    """Returns (conn, cursor), a new connection replacing a lost one."""
+    Close(conn)
+    Count('reconnects')
+    
+    return self.Connect()
+  
+  
+  def EvictIdle(self):
+    """Close connections idle longer than the idle timeout.  Must hold self.condition."""
+    now = time.time()
+    
+    while self.idle and now - self.idle[0][2] > self.idle_timeout:
+      (conn, cursor, last_used) = self.idle.pop(0)
+      Close(conn)
+  
+  
+  def CloseAll(self):
+    """Close all idle connections."""
+    self.condition.acquire()
+    try:
+      for (conn, cursor, last_used) in self.idle:
+        Close(conn)
+      
+      self.idle = []
+    
+    finally:
+      self.condition.release()
+
+
+def GetPool(host, user, password, database, port, size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+  """Returns ConnectionPool for this database, creating it on first use."""
+  global POOLS_PID
+  
+  key = (host, port, user, database)
+  
+  POOLS_LOCK.acquire()
+  try:
+    # In a forked worker, start new pools.  The parent's connections are left open for the parent to use.
+    if POOLS_PID != os.getpid():
+      INHERITED_POOLS.extend(POOLS.values())
+      POOLS.clear()
+      POOLS_PID = os.getpid()
+    
+    if key not in POOLS:
+      POOLS[key] = ConnectionPool(host, user, password, database, port, size=size, idle_timeout=idle_timeout)
+    
+    return POOLS[key]
+  
+  finally:
+    POOLS_LOCK.release()
+
+
+def CloseAll():
+  """Close all pooled connections.  Called when a run is finished."""
+  POOLS_LOCK.acquire()
+  try:
+    # Pools inherited from a parent process are the parent's to close
+    if POOLS_PID != os.getpid():
+      return
+    
+    for pool in POOLS.values():
+      pool.CloseAll()
+    
+    POOLS.clear()
+  
+  finally:
+    POOLS_LOCK.release()
+
+
+def Count(key, amount=1):
+  """Add to one of the connection counters."""
+  STATS_LOCK.acquire()
+  STATS[key] += amount
+  STATS_LOCK.release()
+
+
+def GetStats():
+  """Returns dict, copy of the connection counters."""
+  STATS_LOCK.acquire()
+  stats = dict(STATS)
+  STATS_LOCK.release()
+  
+  return stats
+
+
 def Query(datasource, filter):
   """Wrap MysqlQuery with datasource/filter interface."""
   result = MysqlQuery(filter, host=datasource['host'], user=datasource['user'], 
                       password=datasource['password'], database=datasource['database'], 
-                      port=datasource.get('port', 3306))
+                      port=datasource.get('port', 3306), tuple_rows=datasource.get('tuple rows', False),
+                      pool_size=datasource.get('pool size', POOL_SIZE),
+                      pool_idle_timeout=datasource.get('pool idle timeout', POOL_IDLE_TIMEOUT))
 
   return result
 
 
-def MysqlQuery(sql, host, user, password, database, port=3306):
-  """Execute and Fetch All results, or reutns last row ID inserted if INSERT."""
-  # Connect (will save connections)
-  (conn, cursor) = Connect(host, user, password, database, port)
+def StreamQuery(datasource, filter):
+  """Wrap MysqlStreamQuery with datasource/filter interface."""
+  return MysqlStreamQuery(filter, host=datasource['host'], user=datasource['user'], 
+                          password=datasource['password'], database=datasource['database'], 
+                          port=datasource.get('port', 3306),
+                          batch_size=datasource.get('stream batch size', STREAM_BATCH_SIZE),
+                          tuple_rows=datasource.get('tuple rows', False),
+                          pool_size=datasource.get('pool size', POOL_SIZE),
+                          pool_idle_timeout=datasource.get('pool idle timeout', POOL_IDLE_TIMEOUT))
 
+
+def MysqlStreamQuery(sql, host, user, password, database, port=3306, batch_size=STREAM_BATCH_SIZE, tuple_rows=False,
+                     pool_size=POOL_SIZE, pool_idle_timeout=POOL_IDLE_TIMEOUT):
+  """Yields lists of dicts (or Rows, if tuple_rows), the rows of a SELECT in batches of batch_size, read from an
+  unbuffered server-side cursor.
+  
+  The server sends rows as they are fetched, so memory use depends on the batch size and not the size of the result.
+  A pooled connection is held from the first batch until the last one is read, or the generator is closed.
+  """
   if not sql.upper().startswith('SELECT'):
     raise MysqlQueryFailure('Only SELECT statements are allowed.  We dont want to change any data.')
 
-  # Try to reconnect and stuff
-  success = False
-  tries = 0
-  last_error = None
-  while tries <= 3 and success == False:
-    tries += 1
-
-    try:
-      #log('Query: %s' % sql)
-      cursor.execute(sql)
-      
-      #log('Query complete, committing')
-      
-      # Command didnt throw an exception
-      success = True
-    
-    except MYSQL_EXCEPTION, e:
-      #print(e)
-      #print(dir(e))
+  pool = GetPool(host, user, password, database, port, size=pool_size, idle_timeout=pool_idle_timeout)
+  (conn, cursor) = pool.Acquire()
+  
+  stream_cursor = None
+  finished = False
+  
+  try:
+    # Try to reconnect and stuff
+    success = False
+    tries = 0
+    last_error = None
+    while tries <= 3 and success == False:
+      tries += 1
       
       try:
-        # MySQLdb
-        (error_code, error_text) = e
-      except ValueError:
-        # mysql.connector
-        (error_code, error_text) = (e.errno, e.msg)
+        stream_cursor = QueryCursor(conn, stream=True, tuple_rows=tuple_rows)
+        stream_cursor.execute(sql)
         
+        success = True
       
-      last_error = '%s: %s (Attempt: %s): %s: %s: %s' % (error_code, error_text, tries, host, database, sql)
+      except MYSQL_EXCEPTION, e:
+        (error_code, error_text) = GetErrorCode(e)
+        
+        last_error = '%s: %s (Attempt: %s): %s: %s: %s' % (error_code, error_text, tries, host, database, sql)
+        
+        # Connect lost, reconnect
+        if error_code in (2006, '2006'):
+          log('Lost connection: %s' % last_error, level=WARNING)
+          (conn, cursor) = pool.Reconnect(conn)
+        else:
+          log('Unhandled MySQL query error: %s' % last_error, level=ERROR)
+    
+    if not success:
+      raise MysqlQueryFailure(str(last_error))
+    
+    columns = [column[0] for column in stream_cursor.description]
+    
+    while True:
+      rows = stream_cursor.fetchmany(batch_size)
+      if not rows:
+        break
       
-      # Connect lost, reconnect
-      if error_code in (2006, '2006'):
-        log('Lost connection: %s' % last_error)
-        Connect(host, user, password, database, port, reset=True)
+      if tuple_rows:
+        yield Rows(columns, list(rows))
       else:
-        log('Unhandled MySQL query error: %s' % last_error)
+        yield list(rows)
+    
+    stream_cursor.close()
+    finished = True
+  
+  finally:
+    if finished:
+      pool.Release(conn, cursor)
+    
+    # Unread rows are still on the connection, so it can not be used for another query
+    else:
+      pool.Discard(conn)
 
-  # If we made the query, get the result
-  if success:
-    if sql.upper().startswith('INSERT'):
-      result = cursor.lastrowid
-      conn.commit()
-      
-    elif sql.upper().startswith('UPDATE') or sql.upper().startswith('DELETE'):
-      conn.commit()
-      result = None
-      
-    elif sql.upper().startswith('SELECT'):
-      result = cursor.fetchall()
+
+def MysqlQuery(sql, host, user, password, database, port=3306, tuple_rows=False, pool_size=POOL_SIZE,
+               pool_idle_timeout=POOL_IDLE_TIMEOUT):
+  """Execute and Fetch All results, or reutns last row ID inserted if INSERT.
+  
+  SELECT results are a list of dicts, or Rows of tuples if tuple_rows is set.
+  """
+  if not sql.upper().startswith('SELECT'):
+    raise MysqlQueryFailure('Only SELECT statements are allowed.  We dont want to change any data.')
+
+  # Connect (pooled, so connections are reused across queries)
+  pool = GetPool(host, user, password, database, port, size=pool_size, idle_timeout=pool_idle_timeout)
+  (conn, cursor) = pool.Acquire()
+  
+  # The pooled cursor returns dicts, tuple rows are read with their own cursor
+  query_cursor = cursor
+  finished = False
+  
+  try:
+    # Try to reconnect and stuff
+    success = False
+    tries = 0
+    last_error = None
+    while tries <= 3 and success == False:
+      tries += 1
+
+      try:
+        #log('Query: %s' % sql)
+        if tuple_rows:
+          query_cursor = QueryCursor(conn, tuple_rows=True)
+        else:
+          query_cursor = cursor
+        
+        query_cursor.execute(sql)
+        
+        #log('Query complete, committing')
+        
+        # Command didnt throw an exception
+        success = True
       
+      except MYSQL_EXCEPTION, e:
+        (error_code, error_text) = GetErrorCode(e)
+        
+        last_error = '%s: %s (Attempt: %s): %s: %s: %s' % (error_code, error_text, tries, host, database, sql)
+        
+        # Connect lost, reconnect
+        if error_code in (2006, '2006'):
+          log('Lost connection: %s' % last_error, level=WARNING)
+          (conn, cursor) = pool.Reconnect(conn)
+        else:
+          log('Unhandled MySQL query error: %s' % last_error, level=ERROR)
+
+    # If we made the query, get the result
+    if success:
+      if sql.upper().startswith('INSERT'):
+        result = query_cursor.lastrowid
+        conn.commit()
+        
+      elif sql.upper().startswith('UPDATE') or sql.upper().startswith('DELETE'):
+        conn.commit()
+        result = None
+        
+      elif sql.upper().startswith('SELECT'):
+        if tuple_rows:
+          result = Rows([column[0] for column in query_cursor.description], list(query_cursor.fetchall()))
+          query_cursor.close()
+        else:
+          result = cursor.fetchall()
+        
+      else:
+        result = None
+   
+    # We failed, no result for you
     else:
-      result = None
- 
-  # We failed, no result for you
-  else:
-    raise MysqlQueryFailure(str(last_error))
+      raise MysqlQueryFailure(str(last_error))
+    
+    finished = True
+  
+  finally:
+    if finished:
+      pool.Release(conn, cursor)
+    
+    # The connection may be lost or closed (a failed reconnect), or have unread rows, so it can not be reused
+    else:
+      pool.Discard(conn)
 
   return result
 
 
-def Connect(host, user, password, database, port, reset=False):
+def GetErrorCode(e):
+  """Returns (error_code, error_text) from a MySQLdb or mysql.connector exception."""
+  try:
+    # MySQLdb
+    (error_code, error_text) = e
+  except (ValueError, TypeError):
+    # mysql.connector
+    (error_code, error_text) = (e.errno, e.msg)
+  
+  return (error_code, error_text)
+
+
+def HealthCheck(conn):
+  """Returns boolean, True if the connection is still usable.  A lost connection (2006) fails the check."""
+  try:
+    conn.ping()
+    return True
+  
+  except MYSQL_EXCEPTION, e:
+    (error_code, error_text) = GetErrorCode(e)
+    if error_code not in (2006, '2006'):
+      log('Unhandled MySQL health check error: %s: %s' % (error_code, error_text), level=ERROR)
+    
+    return False
+
+
+def Close(conn):
+  """Close a connection, ignoring errors from connections that are already lost."""
+  try:
+    conn.close()
+  except MYSQL_EXCEPTION:
+    pass
+  
+  Count('closed')
+
+
+def Connect(host, user, password, database, port):
   """Connect to the specified MySQL DB.  Wrapped to add features if required."""
   if MYSQL_MODULE == 'MySQLdb':
     conn = MySQLdb.Connect(host, user, password, database, port=port, cursorclass=MySQLdb.cursors.DictCursor)
     cursor = conn.cursor()
   
   elif MYSQL_MODULE == 'mysql.connector':
-    conn = mysql.connector.connect(user=user, password=password, host=host, database=database)
+    conn = mysql.connector.connect(user=user, password=password, host=host, database=database, port=port)
     cursor = conn.cursor(cursor_class=MySQLCursorDict)
   
   else:
@@ -131,3 +505,30 @@ def Connect(host, user, password, database, port, reset=False):
 
   return (conn, cursor)
 
+
+def QueryCursor(conn, stream=False, tuple_rows=False):
+  """Returns a cursor on the connection, for results other than the pooled cursor's buffered dicts.
+  
+  Args:
+    stream: boolean, unbuffered (server-side) cursor, for StreamQuery()
+    tuple_rows: boolean, rows are tuples instead of dicts
+  """
+  if MYSQL_MODULE == 'MySQLdb':
+    if stream and tuple_rows:
+      return conn.cursor(MySQLdb.cursors.SSCursor)
+    elif stream:
+      return conn.cursor(MySQLdb.cursors.SSDictCursor)
+    elif tuple_rows:
+      return conn.cursor(MySQLdb.cursors.Cursor)
+    else:
+      return conn.cursor(MySQLdb.cursors.DictCursor)
+  
+  # mysql.connector cursors are unbuffered unless asked to be buffered
+  elif MYSQL_MODULE == 'mysql.connector':
+    if tuple_rows:
+      return conn.cursor()
+    else:
+      return conn.cursor(cursor_class=MySQLCursorDict)
+  
+  else:
+    raise Exception('Unknown MYSQL_MODULE: %s' % MYSQL_MODULE)
@@ -0,0 +1,124 @@
+"""
+Output Files
+
+Writes templated output to its target path.  Output is streamed to a temp file next to the target, and only renamed
+over it if the content is different, so unchanged files are left untouched and readers never see a partially written
+file.
+"""
+
+
+import hashlib
+import os
+import tempfile
+
+import timing
+
+
+# Mode for new output files, the same as open(path, 'w') would create with the current umask
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+NEW_FILE_MODE = 0666 & ~_UMASK
+
+# Bytes read at a time when hashing an existing file
+READ_SIZE = 1024 * 1024
+
+
+def WriteChunks(path, chunks):
+  """Write an iterable of strings to path, if it is different from what is already there.
+
+  The chunks are written to a temp file in the same directory while hashing them.  If the existing file has the same
+  size and hash the temp file is discarded, otherwise it is fsynced and renamed over path.
+
+  Returns: boolean, True if path was written, False if its content was already the same
+  """
+  dir_path = os.path.dirname(path) or '.'
+
+  # Only the writing is timed, the chunks are timed where they are produced
+  span = timing.Start('write', path)
+
+  (fd, temp_path) = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path), suffix='.tmp', dir=dir_path)
+
+  try:
+    size = 0
+    content_hash = hashlib.sha1()
+
+    fp = os.fdopen(fd, 'w')
+    try:
+      for chunk in chunks:
+        with span:
+          fp.write(chunk)
+          content_hash.update(chunk)
+          size += len(chunk)
+
+      span.Add('bytes', size)
+
+      with span:
+        fp.flush()
+
+        if IsSameContent(path, size, content_hash.digest()):
+          os.unlink(temp_path)
+          return False
+
+        os.fsync(fp.fileno())
+
+    finally:
+      fp.close()
+
+    # Keep the existing file's mode, temp files are created private
+    if os.path.exists(path):
+      mode = os.stat(path).st_mode & 07777
+    else:
+      mode = NEW_FILE_MODE
+
+    with span:
+      os.chmod(temp_path, mode)
+      os.rename(temp_path, path)
+
+  except:
+    if os.path.exists(temp_path):
+      os.unlink(temp_path)
+    raise
+
+  with span:
+    SyncDirectory(dir_path)
+
+  return True
+
+
+def IsSameContent(path, size, digest):
+  """Returns boolean, True if the file at path has this size and SHA-1 digest.  Size is checked first, as it is free."""
+  try:
+    if os.path.getsize(path) != size:
+      return False
+
+    file_hash = hashlib.sha1()
+
+    fp = open(path, 'rb')
+    try:
+      while True:
+        block = fp.read(READ_SIZE)
+        if not block:
+          break
+        file_hash.update(block)
+    finally:
+      fp.close()
+
+  except (IOError, OSError):
+    return False
+
+  return file_hash.digest() == digest
+
+
+def SyncDirectory(dir_path):
+  """fsync a directory, so a rename in it is durable.  Not all platforms can open directories, so this is best effort."""
+  try:
+    fd = os.open(dir_path, os.O_RDONLY)
+  except OSError:
+    return
+
+  try:
+    os.fsync(fd)
+  except OSError:
+    pass
+  finally:
+    os.close(fd)
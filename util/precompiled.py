@@ -0,0 +1,143 @@
+"""
+Precompiled File Cache
+
+Keeps the parsed form of spec, datasource and commands YAML files, and the commands found in template and include
+files, on disk between runs, so a run (such as from cron) with a warm cache does not parse them again.  A run that finds
+every YAML file here does not import PyYAML at all, which is most of its startup time.
+
+Entries are marshal files named by a hash of their inputs: the file's path, what it was parsed into, anything else the
+parse depends on (the commands, for template files), the cache FORMAT_VERSION and the Python version.  Each entry is
+valid while its file has the mtime and size it was parsed with.  If they changed, but the file's content hash has not
+(a checkout or a touch), the entry is still used, and updated with the new mtime and size.
+
+Values that marshal cannot store (YAML dates) are not cached, their files are parsed every run.
+"""
+
+
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+import threading
+
+from log import log, WARNING
+
+
+# Change when a parsed form changes, so entries written by older code are not used
+FORMAT_VERSION = 1
+
+STATS = {
+  'hits': 0,
+  'rehashed': 0,
+  'misses': 0,
+  'writes': 0,
+}
+STATS_LOCK = threading.Lock()
+
+
+def EntryPath(cache_dir, kind, file_key, salt=''):
+  """Returns string, path of the entry for a file parsed into kind, with salt, anything else the parse depends on."""
+  return os.path.join(cache_dir, '%s.%s' % (hashlib.sha1(EntryKey(kind, file_key, salt)).hexdigest(), kind))
+
+
+def EntryKey(kind, file_key, salt=''):
+  """Returns string, the inputs of an entry, stored in it to guard against hash collisions."""
+  return '%s:%s:%s:%s:%s' % (FORMAT_VERSION, sys.version, kind, file_key[0], salt)
+
+
+def Count(key):
+  """Add to one of the cache counters."""
+  STATS_LOCK.acquire()
+  STATS[key] += 1
+  STATS_LOCK.release()
+
+
+def Get(cache_dir, kind, file_key, salt=''):
+  """Returns (found, value), the parsed file from the cache.  found is False if it is not cached, or has changed.
+
+  Args:
+    file_key: tuple, (absolute path, mtime, size) of the file, from context.FileKey()
+  """
+  entry_path = EntryPath(cache_dir, kind, file_key, salt)
+
+  try:
+    fp = open(entry_path, 'rb')
+    try:
+      (entry_key, mtime, size, digest, value) = marshal.load(fp)
+    finally:
+      fp.close()
+
+  except (IOError, EOFError, ValueError, TypeError):
+    Count('misses')
+    return (False, None)
+
+  if entry_key != EntryKey(kind, file_key, salt):
+    Count('misses')
+    return (False, None)
+
+  if (mtime, size) == file_key[1:]:
+    Count('hits')
+    return (True, value)
+
+  # The file was touched or checked out again, the entry is good if the content is the same
+  try:
+    fp = open(file_key[0], 'rb')
+    try:
+      text = fp.read()
+    finally:
+      fp.close()
+
+  except IOError:
+    Count('misses')
+    return (False, None)
+
+  if hashlib.sha1(text).hexdigest() != digest:
+    Count('misses')
+    return (False, None)
+
+  Count('rehashed')
+  Set(cache_dir, kind, file_key, text, value, salt)
+
+  return (True, value)
+
+
+def Set(cache_dir, kind, file_key, text, value, salt=''):
+  """Write the parsed file to the cache.  Failures are logged, parsing still works without it.
+
+  Args:
+    text: string, the content value was parsed from, whose hash keeps the entry valid when only the mtime changes
+  """
+  entry = (EntryKey(kind, file_key, salt), file_key[1], file_key[2], hashlib.sha1(text).hexdigest(), value)
+
+  try:
+    data = marshal.dumps(entry)
+  except ValueError:
+    return
+
+  try:
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+
+    (fd, temp_path) = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+    fp = os.fdopen(fd, 'wb')
+    try:
+      fp.write(data)
+    finally:
+      fp.close()
+
+    os.rename(temp_path, EntryPath(cache_dir, kind, file_key, salt))
+
+    Count('writes')
+
+  except (IOError, OSError), e:
+    log('WARNING: Could not write precompiled cache entry: %s: %s' % (cache_dir, e), level=WARNING)
+
+
+def GetStats():
+  """Returns dict, copy of the cache counters."""
+  STATS_LOCK.acquire()
+  stats = dict(STATS)
+  STATS_LOCK.release()
+
+  return stats
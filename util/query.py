@@ -7,43 +7,410 @@ Hard coded pluggables.
 """
 
 
-from log import log
+import os
+import re
+import sys
+import unicodedata
+
+import cache
+import timing
+from log import log, Brief, LogEnabled, DEBUG
+from rows import Rows, RowBatches
 
 
 # If run from a command line, this will be set, and we will known whether ['verbose'] == True, etc
 OPTIONS = None
 
+# All datasources by name, set when they are loaded, so relationships can find their target datasources
+DATASOURCES = None
+
+
+# A filter value that is only a field, like "%(id)s"
+FIELD_REGEX = re.compile(r'^%\(([^()]*)\)s$')
+
+# Any field in a filter
+FIELDS_REGEX = re.compile(r'%\(([^()]*)\)s')
+
+# A SQL comparison of a column to a field, like: product.id = %(id)s  or  name = '%(name)s'
+BATCH_SQL_REGEX = re.compile(r'''([A-Za-z_][\w.]*)\s*=\s*(['"]?)%\(([^()]*)\)s\2''')
+
+# SQL whose result is not the rows of each value put together, so it can not be batched: a LIMIT or DISTINCT applies to
+#   every value at once, groups and aggregates combine the rows of different values, and an OR can match rows without
+#   the value.  Quoted strings are removed before searching.
+BATCH_UNSAFE_SQL_REGEX = re.compile(r'\b(?:LIMIT|GROUP\s+BY|HAVING|DISTINCT|UNION|OR)\b|\|\||'
+                                    r'\b(?:COUNT|SUM|AVG|MIN|MAX|GROUP_CONCAT)\s*\(', re.IGNORECASE)
+
+# Most values in one batched filter, so batched SQL stays a reasonable size
+BATCH_SIZE = 1000
+
+# Column that batched SQL adds to its results, the filtered column's value, to group the rows by.  A column name in the
+#   results can be ambiguous (SELECT * of a join has every table's "id"), the compared column itself is not.
+BATCH_KEY_COLUMN = '__batch_key'
+
+# Start of a SELECT, and the FROM that ends its select list, where batched SQL adds BATCH_KEY_COLUMN
+SELECT_REGEX = re.compile(r'^\s*SELECT\b', re.IGNORECASE)
+FROM_REGEX = re.compile(r'\bFROM\b', re.IGNORECASE)
+
 
 class UnknownDatasourceType(Exception):
   """When we dont have a handler for this type of data source."""
 
 
+class BatchFilterError(Exception):
+  """A filter that can not be batched into one query for many values."""
+
+
 def Query(datasource, spec_data, query_key='filter'):
+  """Query the datasource with the spec's filter (or query_key).  Results are cached, see util/cache.py.
+  
+  Datasources with "stream: true" are not cached, their rows are read from the datasource in batches as they are used.
+  
+  Returns: results of the query, shared with the cache so they must not be modified.  Streamed results are an
+      iterator, which can only be read once.
+  """
+  with timing.Start('query', datasource.get('name', datasource['type'])) as span:
+    result = CachedQuery(datasource, spec_data[query_key])
+    
+    # Streamed rows are not fetched yet
+    if hasattr(result, '__len__'):
+      span.Add('rows', len(result))
+    
+    return result
+
+
+def CachedQuery(datasource, query):
+  """Query the datasource, from the cache if the query's result is cached, for Query().
+  
+  Results of data files and SQLite files are also keyed by the files' signature (see FilesSignature()), so results kept
+  on disk (--cache-dir) are not used once a file changes.
+  """
+  # Streamed results are only held a batch at a time, so they can not be cached
+  if datasource.get('stream', False):
+    return QueryDatasource(datasource, query)
+  
+  # Caching can be turned off for a run (--no-cache), or per datasource with "cache ttl: 0"
+  if OPTIONS and OPTIONS.get('no_cache', False):
+    ttl = 0
+  else:
+    ttl = datasource.get('cache ttl', cache.DEFAULT_TTL)
+  
+  if ttl:
+    key = cache.MakeKey(datasource, query)
+    if datasource['type'] in ('yaml', 'json', 'sqlite'):
+      key = '%s:%s' % (key, FilesSignature(datasource))
+    
+    (found, result) = cache.Get(key)
+    
+    if LogEnabled(DEBUG):
+      stats = cache.GetStats()
+      if found:
+        status = 'Hit'
+      else:
+        status = 'Miss'
+      
+      log('Query: Cache: %s: %s (Hits: %s  Misses: %s)', status, datasource.get('name', datasource['type']),
+          stats['hits'] + stats['disk_hits'], stats['misses'], level=DEBUG)
+    
+    if found:
+      timing.Count('cache_hits')
+      return result
+    
+    timing.Count('cache_misses')
+  
+  result = QueryDatasource(datasource, query)
+  
+  if ttl:
+    cache.Set(key, result, ttl)
+  
+  return result
+
+
+def QueryDatasource(datasource, query):
+  """Query the datasource directly, by its type."""
   # MySQL database
   if datasource['type'] == 'mysql':
     # Dynamic import means that we dont need installed modules if this type isnt being used
     import mysql_datasource
     
-    sql = spec_data[query_key]
+    log('Query: MySQL: SQL: %s', Brief(query), level=DEBUG)
     
-    if OPTIONS and OPTIONS.get('verbose', False):
-      log('Query: MySQL: SQL: %s' % sql)
+    # Stream rows from a server-side cursor, fetched in batches as they are templated
+    if datasource.get('stream', False):
+      result = RowBatches(mysql_datasource.StreamQuery(datasource, query))
+      
+      log('Query: MySQL: Result: Streamed in batches of %s', datasource.get('stream batch size',
+                                                                         mysql_datasource.STREAM_BATCH_SIZE), level=DEBUG)
     
-    result = mysql_datasource.Query(datasource, sql)
-    
-    if OPTIONS and OPTIONS.get('verbose', False):
-      log('Query: MySQL: Result: %s' % result)
+    else:
+      result = mysql_datasource.Query(datasource, query)
+      
+      log('Query: MySQL: Result: %s', Brief(result, 'rows'), level=DEBUG)
 
-  # YAML data file
-  elif datasource['type'] == 'yaml':
-    pass
+  # SQLite file, such as a snapshot of a MySQL database
+  elif datasource['type'] == 'sqlite':
+    import sqlite_datasource
+    
+    log('Query: SQLite: SQL: %s: %s', datasource['path'], Brief(query), level=DEBUG)
+    
+    result = sqlite_datasource.Query(datasource, query)
+    
+    log('Query: SQLite: Result: %s', Brief(result, 'rows'), level=DEBUG)
 
-  # JSON data file
-  elif datasource['type'] == 'json':
-    pass
+  # YAML or JSON data file
+  elif datasource['type'] in ('yaml', 'json'):
+    import file_datasource
+    
+    log('Query: %s: Filter: %s: %s', datasource['type'].upper(), datasource['path'], Brief(query), level=DEBUG)
+    
+    result = file_datasource.Query(datasource, query, DATASOURCES)
+    
+    log('Query: %s: Result: %s', datasource['type'].upper(), Brief(result, 'rows'), level=DEBUG)
 
   else:
     raise UnknownDatasourceType('Unknown Data Source Type: %s' % datasource['type'])
 
   return result
 
+
+def FilesSignature(datasource, chain=()):
+  """Returns string, the path, mtime and size of a datasource's file, and of the files of its relationship targets, so
+  it changes whenever any file the results are read from changes.
+  
+  Args:
+    chain: tuple, names of the datasources whose relationships led here, to stop at cycles
+  """
+  try:
+    stat = os.stat(datasource['path'])
+    signature = [(datasource['path'], stat.st_mtime, stat.st_size)]
+  except OSError:
+    signature = [(datasource['path'], None, None)]
+  
+  # Relationship targets that are not known, or are a cycle, fail the query
+  for target in sorted((datasource.get('relationship', None) or {}).values()):
+    target_name = target.split('.', 1)[0]
+    
+    if DATASOURCES and target_name in DATASOURCES and target_name not in chain:
+      signature.append(FilesSignature(DATASOURCES[target_name], chain + (datasource.get('name', None),)))
+  
+  return repr(signature)
+
+
+def FormatFilter(filter, values):
+  """Returns the filter with its %(key)s fields templated from values, for "outer filter" specs.
+
+  SQL filters are string formatted.  File datasource filters (dicts) have each value formatted, and a value that is
+  only a field, like "%(id)s", takes that field's value as is, so it still matches typed (int, bool) file data.
+  """
+  if isinstance(filter, basestring):
+    match = FIELD_REGEX.match(filter)
+    if match and match.group(1) in values:
+      return values[match.group(1)]
+    
+    return filter % values
+  
+  elif isinstance(filter, dict):
+    return dict([(key, FormatFilter(value, values)) for (key, value) in filter.items()])
+  
+  elif isinstance(filter, list):
+    return [FormatFilter(value, values) for value in filter]
+  
+  else:
+    return filter
+
+
+def BatchField(filter):
+  """Returns (field, column) of a filter that can be batched: the one field it is formatted with, and the result
+  column whose value equals that field, to group the batched rows by.
+  
+  SQL filters must be a SELECT that compares one column to their only field, like "WHERE product.id = %(id)s", outside
+  any parentheses, and not use LIMIT, DISTINCT, GROUP BY, HAVING, UNION, OR or aggregate functions (see
+  BATCH_UNSAFE_SQL_REGEX).  Their column is BATCH_KEY_COLUMN, which BatchFilter() selects.  File datasource filters
+  must have one value that is only a field, like {'product': '%(id)s'}, and no other fields.
+  """
+  if isinstance(filter, basestring):
+    matches = list(BATCH_SQL_REGEX.finditer(filter))
+    
+    if len(FIELDS_REGEX.findall(filter)) != 1 or len(matches) != 1:
+      raise BatchFilterError('SQL filter must have one field, compared with "column = %%(field)s": %s' % filter)
+    
+    unsafe = BATCH_UNSAFE_SQL_REGEX.search(cache.QUOTED_REGEX.sub("''", filter))
+    if unsafe:
+      raise BatchFilterError('SQL filter with %s does not return the same rows for many values: %s' %
+                             (' '.join(unsafe.group(0).upper().rstrip('(').split()), filter))
+    
+    select_end = SelectListEnd(filter)
+    if select_end == None:
+      raise BatchFilterError('SQL filter must be a SELECT ... FROM, to select the filtered column: %s' % filter)
+    
+    # A comparison in a subquery, or in the select list, is not a column of the results
+    if matches[0].start() < select_end or SqlDepth(filter, matches[0].start()) != 0:
+      raise BatchFilterError('SQL filter must compare the column in its own WHERE or JOIN, not a subquery: %s' % filter)
+    
+    return (matches[0].group(3), BATCH_KEY_COLUMN)
+  
+  elif isinstance(filter, dict):
+    fields = [(key, FIELD_REGEX.match(value).group(1)) for (key, value) in filter.items()
+              if isinstance(value, basestring) and FIELD_REGEX.match(value)]
+    
+    if len(fields) != 1 or len(FIELDS_REGEX.findall(repr(filter))) != 1:
+      raise BatchFilterError('Data file filter must have one value that is only a field, like "%%(field)s": %s' % filter)
+    
+    return (fields[0][1], fields[0][0])
+  
+  else:
+    raise BatchFilterError('Filter must be SQL or a dict: %s' % filter)
+
+
+def SqlDepth(sql, position):
+  """Returns int, how many parentheses are open at the position in the SQL, not counting any in quoted strings."""
+  text = cache.QUOTED_REGEX.sub("''", sql[:position])
+  
+  return text.count('(') - text.count(')')
+
+
+def SelectListEnd(sql):
+  """Returns int, the position of the FROM that ends a SELECT's select list, or None if the SQL is not a SELECT."""
+  if not SELECT_REGEX.match(sql):
+    return None
+  
+  # Quoted strings are blanked to the same length, so positions are the same as in the SQL
+  text = cache.QUOTED_REGEX.sub(lambda match: ' ' * len(match.group(0)), sql)
+  
+  for match in FROM_REGEX.finditer(text):
+    if SqlDepth(text, match.start()) == 0:
+      return match.start()
+  
+  return None
+
+
+def BatchFilter(filter, values):
+  """Returns the filter (see BatchField()) matching any of the values, instead of one value.
+  
+  SQL has the column compared with "IN (...)", with each value quoted like the field was, and the column selected as
+  BATCH_KEY_COLUMN.  Data file filters have the field's value replaced by the list of values.
+  """
+  if isinstance(filter, dict):
+    (field, column) = BatchField(filter)
+    
+    batch_filter = dict(filter)
+    batch_filter[column] = list(values)
+    
+    return batch_filter
+  
+  match = BATCH_SQL_REGEX.search(filter)
+  quote = match.group(2)
+  
+  if quote:
+    items = [quote + ('%s' % value).replace('\\', '\\\\').replace(quote, '\\' + quote) + quote for value in values]
+  else:
+    items = ['%s' % value for value in values]
+  
+  select_end = SelectListEnd(filter)
+  
+  # The rest of the filter is formatted as usual, so "%%" is still "%"
+  return '%s, %s AS %s %s%s IN (%s)%s' % (filter[:select_end].rstrip() % {}, match.group(1), BATCH_KEY_COLUMN,
+                                         filter[select_end:match.start()] % {}, match.group(1), ', '.join(items),
+                                         filter[match.end():] % {})
+
+
+def GroupRows(result, column):
+  """Returns dict, GroupKey() of each column value -> the rows of result with that value, in order.  Groups of Rows
+  results are Rows.  The BATCH_KEY_COLUMN that BatchFilter() selects is removed from the rows.
+  """
+  groups = {}
+  
+  if isinstance(result, Rows):
+    index = result.ColumnIndexes().get(column, None)
+    if index == None:
+      raise BatchFilterError('Batched results must have the filtered column: %s' % column)
+    
+    for row in result.tuples:
+      groups.setdefault(GroupKey(row[index]), []).append(row)
+    
+    if column != BATCH_KEY_COLUMN:
+      return dict([(key, Rows(result.columns, tuples)) for (key, tuples) in groups.items()])
+    
+    columns = result.columns[:index] + result.columns[index + 1:]
+    
+    return dict([(key, Rows(columns, [row[:index] + row[index + 1:] for row in tuples]))
+                 for (key, tuples) in groups.items()])
+  
+  for row in result:
+    if column not in row:
+      raise BatchFilterError('Batched results must have the filtered column: %s' % column)
+    
+    key = GroupKey(row[column])
+    
+    if column == BATCH_KEY_COLUMN:
+      row = dict(row)
+      del row[column]
+    
+    groups.setdefault(key, []).append(row)
+  
+  return groups
+
+
+def GroupKey(value):
+  """Returns the value to group rows by, so a column value and a field value compare the same whatever their type
+  (int, long, string), and whatever the column's collation.  Strings are compared without case, accents or trailing
+  spaces, as MySQL's default collations compare them.  Values that are only different like this are not batched
+  (see BatchValues()), so a column with an exact collation is grouped the same.
+  """
+  if not isinstance(value, basestring):
+    return '%s' % value
+  
+  if isinstance(value, str):
+    value = value.decode('utf-8', 'replace')
+  
+  value = u''.join([char for char in unicodedata.normalize('NFKD', value) if not unicodedata.combining(char)])
+  
+  return value.lower().rstrip(u' ')
+
+
+def BatchValues(values):
+  """Returns list, the values each once, in order, for BatchFilter().
+  
+  Raises BatchFilterError if two different values have the same GroupKey(), as the column's collation decides whether
+  one value's rows are also the other's.
+  """
+  batch_values = []
+  exact_values = {}
+  
+  for value in values:
+    key = GroupKey(value)
+    exact_value = value if isinstance(value, basestring) else '%s' % value
+    
+    if key not in exact_values:
+      exact_values[key] = exact_value
+      batch_values.append(value)
+    
+    elif exact_values[key] != exact_value:
+      raise BatchFilterError('Values only differ in case, accents or trailing spaces: %r and %r' %
+                             (exact_values[key], exact_value))
+  
+  return batch_values
+
+
+def Shutdown():
+  """Release resources held across queries, such as pooled MySQL connections and cached results.  Called at the end of
+  a run.
+  """
+  if LogEnabled(DEBUG):
+    log('Query: Cache: %s', cache.GetStats(), level=DEBUG)
+  
+  # Results in memory are only for this run, a later run in this process must see changed data
+  cache.Clear()
+  
+  # Only handlers that were imported during the run have anything to release
+  mysql_datasource = sys.modules.get('util.mysql_datasource', None)
+  
+  if mysql_datasource:
+    if LogEnabled(DEBUG):
+      log('Query: MySQL: Connections: %s', mysql_datasource.GetStats(), level=DEBUG)
+    
+    mysql_datasource.CloseAll()
+  
+  sqlite_datasource = sys.modules.get('util.sqlite_datasource', None)
+  
+  if sqlite_datasource:
+    sqlite_datasource.CloseAll()
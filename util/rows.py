@@ -0,0 +1,69 @@
+"""
+Row Sets
+
+Compact query results: one shared tuple of column names, and a plain tuple of values per row, instead of a dict per
+row.  Compiled templates resolve their slots to column indexes once per result (see util/template.py), so rows are
+rendered without hashing their keys.
+
+Iterating a row set yields a dict per row, so code expecting dict rows keeps working.
+
+A column name used more than once (a SELECT of two tables with the same column) is the first of those columns, as in
+MySQLdb's dict rows, so a template renders the same from tuple or dict rows.  Dict rows also have the later columns as
+"table.column", which tuple rows can not, as the cursor description has no table names: alias them in the SQL instead.
+"""
+
+
+class Rows(object):
+  """Query result as column names and value tuples.
+
+  columns: tuple of strings, the column names, in the order of the values in each row
+  tuples: list of tuples, the rows
+  """
+
+  def __init__(self, columns, tuples):
+    self.columns = tuple(columns)
+    self.tuples = tuples
+
+
+  def ColumnIndexes(self):
+    """Returns dict, column name -> index of its value in each row.  A name used more than once is its first column."""
+    indexes = {}
+    for (index, column) in enumerate(self.columns):
+      indexes.setdefault(column, index)
+
+    return indexes
+
+
+  def __iter__(self):
+    columns = self.columns
+
+    if len(set(columns)) == len(columns):
+      for row in self.tuples:
+        yield dict(zip(columns, row))
+
+    # Names used more than once take their first column
+    else:
+      indexes = self.ColumnIndexes().items()
+      for row in self.tuples:
+        yield dict([(column, row[index]) for (column, index) in indexes])
+
+
+  def __len__(self):
+    return len(self.tuples)
+
+
+  def __repr__(self):
+    return repr(list(self))
+
+
+class RowBatches(object):
+  """Streamed query result, read a batch at a time.  Batches are lists of dicts or Rows.  Can only be iterated once."""
+
+  def __init__(self, batches):
+    self.batches = batches
+
+
+  def __iter__(self):
+    for batch in self.batches:
+      for item in batch:
+        yield item
@@ -0,0 +1,207 @@
+"""
+Database Snapshots
+
+Copies the tables that spec SQL selects from, out of a MySQL datasource and into a local SQLite file, which a "sqlite"
+datasource can query with the same SELECTs (see util/sqlite_datasource.py).  Columns joined on, or compared to an
+"outer filter" field, are indexed, so the SELECTs run at disk speed.
+
+Tables are found by parsing FROM and JOIN clauses, so tables only named in sub-queries or views are not copied.
+"""
+
+
+import os
+import re
+import tempfile
+
+import timing
+from log import log
+
+
+# Tables listed in a FROM clause, up to the next clause
+FROM_REGEX = re.compile(r'\bFROM\s+(.+?)(?=\bWHERE\b|\bGROUP\s+BY\b|\bORDER\s+BY\b|\bLIMIT\b|\bHAVING\b|\bUNION\b|'
+                        r'\b(?:INNER|LEFT|RIGHT|CROSS|OUTER|NATURAL|STRAIGHT_JOIN|JOIN)\b|\)|;|$)', re.I | re.S)
+
+# A table joined with JOIN, and its alias
+JOIN_REGEX = re.compile(r'\bJOIN\s+([`\w.]+)(?:\s+(?:AS\s+)?([`\w]+))?', re.I)
+
+# One table of a FROM list, and its alias
+TABLE_REGEX = re.compile(r'^([`\w.]+)(?:\s+(?:AS\s+)?([`\w]+))?$', re.I)
+
+# Columns compared to each other, like: product.database_group = dbg.id
+JOIN_COLUMNS_REGEX = re.compile(r'([`\w]+)\.([`\w]+)\s*=\s*([`\w]+)\.([`\w]+)')
+
+# A column compared to a field, like: product.id = %(id)s
+FIELD_COLUMN_REGEX = re.compile(r'''([`\w]+(?:\.[`\w]+)?)\s*(?:=|\bIN\b)\s*\(?\s*['"]?%\(''', re.I)
+
+# Words that follow a table, which are not its alias
+NOT_ALIASES = set(['ON', 'USING', 'WHERE', 'GROUP', 'ORDER', 'LIMIT', 'HAVING', 'UNION', 'INNER', 'LEFT', 'RIGHT',
+                   'CROSS', 'OUTER', 'NATURAL', 'JOIN', 'STRAIGHT_JOIN'])
+
+# Rows read from MySQL and inserted at a time
+COPY_BATCH_SIZE = 1000
+
+
+class SnapshotError(Exception):
+  """Failure to snapshot a database."""
+
+
+def Name(name):
+  """Returns string, a table or column name without backticks or a database name."""
+  return name.replace('`', '').split('.')[-1]
+
+
+def SqlTables(sql):
+  """Returns dict, alias (or table name) -> table name, of every table a SELECT reads from its FROM and JOIN clauses."""
+  tables = {}
+
+  for match in FROM_REGEX.finditer(sql):
+    for item in match.group(1).split(','):
+      table_match = TABLE_REGEX.match(item.strip())
+
+      # Sub-queries and other expressions are not tables
+      if not table_match:
+        continue
+
+      table = Name(table_match.group(1))
+      tables[table] = table
+
+      if table_match.group(2) and table_match.group(2).upper() not in NOT_ALIASES:
+        tables[Name(table_match.group(2))] = table
+
+  for match in JOIN_REGEX.finditer(sql):
+    table = Name(match.group(1))
+    tables[table] = table
+
+    if match.group(2) and match.group(2).upper() not in NOT_ALIASES:
+      tables[Name(match.group(2))] = table
+
+  return tables
+
+
+def IndexColumns(sql, tables):
+  """Returns set of (table, column), the columns a SELECT joins on or compares to a field.
+
+  Args:
+    tables: dict, SqlTables() of the SELECT, to find the tables of aliases.  Columns without a table are only found
+        if the SELECT reads one table.
+  """
+  columns = set()
+
+  for match in JOIN_COLUMNS_REGEX.finditer(sql):
+    for (table, column) in ((match.group(1), match.group(2)), (match.group(3), match.group(4))):
+      if Name(table) in tables:
+        columns.add((tables[Name(table)], Name(column)))
+
+  single_tables = set(tables.values())
+
+  for match in FIELD_COLUMN_REGEX.finditer(sql):
+    names = match.group(1).split('.')
+
+    if len(names) == 2 and Name(names[0]) in tables:
+      columns.add((tables[Name(names[0])], Name(names[1])))
+
+    elif len(names) == 1 and len(single_tables) == 1:
+      columns.add((list(single_tables)[0], Name(names[0])))
+
+  return columns
+
+
+def Snapshot(datasource, sql_list, path):
+  """Copy the tables read by the SELECTs in sql_list from a MySQL datasource into a new SQLite file at path.
+
+  The file is written to a temporary file first, and renamed over path when it is complete, so a failed snapshot does
+  not replace the last one.
+
+  Returns: dict, table name -> rows copied
+  """
+  # Imported when used, so runs that do not snapshot do not import them (sqlite_datasource registers the sqlite3
+  #   adapters for MySQL values)
+  import sqlite3
+  import sqlite_datasource
+
+  if datasource['type'] != 'mysql':
+    raise SnapshotError('Only MySQL datasources can be snapshot: %s: %s' % (datasource.get('name', None),
+                                                                           datasource['type']))
+
+  tables = set()
+  index_columns = set()
+  for sql in sql_list:
+    sql_tables = SqlTables(sql)
+    tables.update(sql_tables.values())
+    index_columns.update(IndexColumns(sql, sql_tables))
+
+  if not tables:
+    raise SnapshotError('No tables found in the SQL of the specs')
+
+  dir_path = os.path.dirname(os.path.abspath(path))
+  if not os.path.isdir(dir_path):
+    os.makedirs(dir_path)
+
+  (fd, temp_path) = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path), dir=dir_path)
+  os.close(fd)
+
+  try:
+    conn = sqlite3.connect(temp_path)
+    conn.text_factory = str
+
+    try:
+      copied = {}
+      for table in sorted(tables):
+        with timing.Start('snapshot', table):
+          columns = CopyTable(datasource, table, conn)
+          copied[table] = conn.execute('SELECT COUNT(*) FROM "%s"' % table).fetchone()[0]
+
+        for (index_table, column) in sorted(index_columns):
+          if index_table == table and column in columns:
+            conn.execute('CREATE INDEX "%s_%s" ON "%s" ("%s")' % (table, column, table, column))
+
+        log('Snapshot: %s: %s rows' % (table, copied[table]))
+
+      conn.commit()
+
+    finally:
+      conn.close()
+
+    os.rename(temp_path, path)
+
+  except:
+    if os.path.exists(temp_path):
+      os.remove(temp_path)
+    raise
+
+  return copied
+
+
+def CopyTable(datasource, table, conn):
+  """Copy every row of a MySQL table into a new table of the SQLite connection, streamed in batches.
+
+  Returns: list of strings, the table's column names
+  """
+  import mysql_datasource
+
+  # Rows are streamed as tuples, so large tables are not held in memory
+  stream_datasource = dict(datasource)
+  stream_datasource['tuple rows'] = True
+  stream_datasource['stream batch size'] = COPY_BATCH_SIZE
+
+  columns = None
+
+  for rows in mysql_datasource.StreamQuery(stream_datasource, 'SELECT * FROM `%s`' % table):
+    if columns == None:
+      columns = list(rows.columns)
+      CreateTable(conn, table, columns)
+
+    conn.executemany('INSERT INTO "%s" VALUES (%s)' % (table, ', '.join(['?'] * len(columns))), rows.tuples)
+
+  # An empty table still needs its columns, which MySQL returns without rows
+  if columns == None:
+    result = mysql_datasource.Query(stream_datasource, 'SELECT * FROM `%s` LIMIT 0' % table)
+    columns = list(result.columns)
+    CreateTable(conn, table, columns)
+
+  return columns
+
+
+def CreateTable(conn, table, columns):
+  """Create a table in the SQLite connection.  Columns are not typed, so values keep the types MySQL returned."""
+  conn.execute('CREATE TABLE "%s" (%s)' % (table, ', '.join(['"%s"' % column for column in columns])))
@@ -0,0 +1,154 @@
+"""
+SQLite Datasource Handler
+
+Runs spec SELECTs against a local SQLite file, such as a snapshot of a MySQL database (see util/snapshot.py), so specs
+written for MySQL render without the database.  Strings are returned as str, like MySQLdb, and NOW(), UNIX_TIMESTAMP(),
+CONCAT(), INET_ATON() and INET_NTOA() are defined, as they are common in spec SQL.  Other MySQL only SQL will fail.
+
+Connections are kept open for the run, one per thread and file, as SQLite connections must not be shared by threads.
+"""
+
+
+import datetime
+import decimal
+import os
+import sqlite3
+import threading
+import time
+
+from rows import Rows
+
+
+class SqliteQueryFailure(Exception):
+  """Failure to query the SQLite file properly"""
+
+
+# (process id, thread id, path) -> connection
+CONNECTIONS = {}
+CONNECTIONS_LOCK = threading.Lock()
+
+
+# MySQL values that sqlite3 can not store are stored as their text, which renders the same
+sqlite3.register_adapter(decimal.Decimal, str)
+sqlite3.register_adapter(datetime.timedelta, str)
+
+
+def Query(datasource, filter):
+  """Wrap SqliteQuery with datasource/filter interface."""
+  return SqliteQuery(filter, datasource['path'], tuple_rows=datasource.get('tuple rows', False))
+
+
+def SqliteQuery(sql, path, tuple_rows=False):
+  """Returns list of dicts, the rows of a SELECT, or Rows of tuples if tuple_rows is set."""
+  if not sql.strip().upper().startswith('SELECT'):
+    raise SqliteQueryFailure('Only SELECT statements are allowed.  We dont want to change any data.')
+
+  conn = GetConnection(path)
+
+  try:
+    cursor = conn.execute(sql)
+  except sqlite3.Error, e:
+    raise SqliteQueryFailure('%s: %s: %s' % (e, path, sql))
+
+  columns = [column[0] for column in cursor.description]
+  rows = cursor.fetchall()
+  cursor.close()
+
+  # Dict rows are made by Rows, so names used more than once take their first column, as for MySQL dict rows
+  if tuple_rows:
+    return Rows(columns, rows)
+  else:
+    return list(Rows(columns, rows))
+
+
+def GetConnection(path):
+  """Returns this thread's connection to the SQLite file, opening it on first use."""
+  key = (os.getpid(), threading.current_thread().ident, os.path.abspath(path))
+
+  CONNECTIONS_LOCK.acquire()
+  try:
+    if key in CONNECTIONS:
+      return CONNECTIONS[key]
+  finally:
+    CONNECTIONS_LOCK.release()
+
+  # Connecting would create a new empty database
+  if not os.path.isfile(path):
+    raise SqliteQueryFailure('SQLite file not found: %s' % path)
+
+  conn = Connect(path)
+
+  CONNECTIONS_LOCK.acquire()
+  CONNECTIONS[key] = conn
+  CONNECTIONS_LOCK.release()
+
+  return conn
+
+
+def Connect(path):
+  """Returns a connection to the SQLite file, with the MySQL functions defined."""
+  # Closed from the main thread at the end of the run, by CloseAll()
+  conn = sqlite3.connect(path, check_same_thread=False)
+  conn.text_factory = str
+
+  conn.create_function('NOW', 0, lambda: time.strftime('%Y-%m-%d %H:%M:%S'))
+  conn.create_function('UNIX_TIMESTAMP', 0, lambda: int(time.time()))
+  conn.create_function('UNIX_TIMESTAMP', 1, UnixTimestamp)
+  conn.create_function('CONCAT', -1, Concat)
+  conn.create_function('INET_ATON', 1, InetAton)
+  conn.create_function('INET_NTOA', 1, InetNtoa)
+
+  return conn
+
+
+def UnixTimestamp(value):
+  """Returns int, seconds since the epoch of a "YYYY-MM-DD HH:MM:SS" local time, like MySQL's UNIX_TIMESTAMP()."""
+  if value == None:
+    return None
+
+  return int(time.mktime(time.strptime(str(value)[:19], '%Y-%m-%d %H:%M:%S')))
+
+
+def Concat(*values):
+  """Returns string, the values joined, or None if any value is None, like MySQL's CONCAT()."""
+  if None in values:
+    return None
+
+  return ''.join([str(value) for value in values])
+
+
+def InetAton(address):
+  """Returns int, an IPv4 address as a number, or None if it is not one, like MySQL's INET_ATON()."""
+  try:
+    octets = [int(octet) for octet in str(address).split('.')]
+  except (TypeError, ValueError):
+    return None
+
+  if len(octets) != 4:
+    return None
+
+  return (octets[0] << 24) + (octets[1] << 16) + (octets[2] << 8) + octets[3]
+
+
+def InetNtoa(number):
+  """Returns string, a number as an IPv4 address, like MySQL's INET_NTOA()."""
+  if number == None:
+    return None
+
+  number = int(number)
+
+  return '%d.%d.%d.%d' % ((number >> 24) & 255, (number >> 16) & 255, (number >> 8) & 255, number & 255)
+
+
+def CloseAll():
+  """Close all connections opened by this process.  Called when a run is finished."""
+  CONNECTIONS_LOCK.acquire()
+  try:
+    for (key, conn) in CONNECTIONS.items():
+      # Connections inherited by a forked worker are the parent's to close
+      if key[0] == os.getpid():
+        conn.close()
+        del CONNECTIONS[key]
+
+  finally:
+    CONNECTIONS_LOCK.release()
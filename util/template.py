@@ -0,0 +1,139 @@
+"""
+Compiled Templates
+
+Parses a template once into literal segments and %(key)s slots, so each row is rendered by filling slots and joining,
+instead of copying the whole template and running a replace() per column.
+
+Rows can be dicts, or a Rows result of value tuples (see util/rows.py), which has its slots resolved to column indexes
+once for the whole result.
+"""
+
+
+import re
+
+from rows import Rows, RowBatches
+
+
+# Matches a %(key)s slot.  Keys cannot contain parens, so "%(a %(b)s" yields the "%(b)s" slot, the same as replace() would
+SLOT_REGEX = re.compile(r'%\(([^()]*)\)s')
+
+
+class CompiledTemplate(object):
+  """Template text split into literal parts and slots.
+
+  parts: list of strings.  Slot positions hold their original "%(key)s" text, so keys missing from a row stay literal.
+  slots: dict, key -> list of indexes into parts where that key is substituted
+  """
+
+  def __init__(self, text):
+    self.text = text
+    self.parts = []
+    self.slots = {}
+
+    position = 0
+    for match in SLOT_REGEX.finditer(text):
+      if match.start() > position:
+        self.parts.append(text[position:match.start()])
+
+      self.slots.setdefault(match.group(1), []).append(len(self.parts))
+      self.parts.append(match.group(0))
+
+      position = match.end()
+
+    if position < len(text):
+      self.parts.append(text[position:])
+
+    # Iterating a list of pairs is cheaper than dict.items() for every row
+    self.slot_items = self.slots.items()
+
+
+  def RenderParts(self, item):
+    """Returns list of strings, the template parts with this item's values in their slots."""
+    parts = self.parts[:]
+
+    for (key, indexes) in self.slot_items:
+      if key in item:
+        value = str(item[key])
+        for index in indexes:
+          parts[index] = value
+
+    return parts
+
+
+  def TupleSlots(self, rows):
+    """Returns list of (column index, part indexes), the slots filled from the columns of a Rows result."""
+    column_indexes = rows.ColumnIndexes()
+
+    return [(column_indexes[key], indexes) for (key, indexes) in self.slot_items if key in column_indexes]
+
+
+  def RenderTupleParts(self, row, tuple_slots):
+    """Returns list of strings, the template parts with a row tuple's values in their slots."""
+    parts = self.parts[:]
+
+    for (column, indexes) in tuple_slots:
+      value = str(row[column])
+      for index in indexes:
+        parts[index] = value
+
+    return parts
+
+
+  def IterRowParts(self, data):
+    """Yields list of strings, the template parts rendered for each row in data: dicts, Rows or RowBatches."""
+    if isinstance(data, Rows):
+      tuple_slots = self.TupleSlots(data)
+      for row in data.tuples:
+        yield self.RenderTupleParts(row, tuple_slots)
+
+    elif isinstance(data, RowBatches):
+      for batch in data.batches:
+        for parts in self.IterRowParts(batch):
+          yield parts
+
+    else:
+      for item in data:
+        yield self.RenderParts(item)
+
+
+  def Render(self, item):
+    """Returns string, the template rendered with a single item (row dict)."""
+    return ''.join(self.RenderParts(item))
+
+
+  def RenderRows(self, data):
+    """Returns string, the template rendered once per item in data, concatenated in order.
+
+    All row parts are collected in one list and joined once, so the build is linear in the output size.
+    """
+    pieces = []
+    for parts in self.IterRowParts(data):
+      pieces.extend(parts)
+
+    return ''.join(pieces)
+
+
+  def IterRenderRows(self, data, batch_size=1000):
+    """Yields strings, the template rendered once per item in data, joined in batches of batch_size rows.
+
+    Rows are pulled from data as they are needed, so data can be an iterator over a result set of any size.
+    """
+    pieces = []
+    count = 0
+
+    for parts in self.IterRowParts(data):
+      pieces.extend(parts)
+      count += 1
+
+      if count == batch_size:
+        yield ''.join(pieces)
+        pieces = []
+        count = 0
+
+    if pieces:
+      yield ''.join(pieces)
+
+
+def CompileTemplate(text):
+  """Returns CompiledTemplate for this template text."""
+  return CompiledTemplate(text)
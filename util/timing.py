@@ -0,0 +1,260 @@
+"""
+Timing Spans
+
+Nested timings of the stages of a run, for --profile.  Each span records its total seconds, how many times it was
+entered, and counters (rows, bytes, cache hits), and spans started inside another span are its children.  A span can
+be entered many times, so a generator is timed only while it is producing (see TimedIter()).
+
+When ENABLED is False, Start() returns a span that does nothing, so instrumented code costs almost nothing.
+"""
+
+
+import json
+import threading
+import time
+
+from log import log
+
+
+# Set for --profile runs
+ENABLED = False
+
+# Siblings with the same name and more labels than this are shown as one line in the report
+REPORT_MAX_LABELS = 10
+
+# Spans started outside any other span, in order
+ROOTS = []
+ROOTS_LOCK = threading.Lock()
+
+# Per thread stack of entered spans
+STACK = threading.local()
+
+
+class Span(object):
+  """Timing of one stage, and the stages inside it."""
+
+  def __init__(self, name, label=None):
+    self.name = name
+    self.label = label
+    self.seconds = 0.0
+    self.calls = 0
+    self.counts = {}
+    self.children = []
+
+    self.started = None
+
+
+  def Add(self, key, amount=1):
+    """Add to one of the span's counters."""
+    self.counts[key] = self.counts.get(key, 0) + amount
+
+
+  def __enter__(self):
+    GetStack().append(self)
+    self.calls += 1
+    self.started = time.time()
+
+    return self
+
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.seconds += time.time() - self.started
+    GetStack().pop()
+
+
+  def ToDict(self):
+    """Returns dict of the span and its children, for JSON."""
+    return {'name': self.name, 'label': self.label, 'seconds': self.seconds, 'calls': self.calls,
+            'counts': self.counts, 'children': [child.ToDict() for child in self.children]}
+
+
+class NullSpan(object):
+  """Span returned when timing is not enabled.  Does nothing."""
+
+  def Add(self, key, amount=1):
+    pass
+
+
+  def __enter__(self):
+    return self
+
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    pass
+
+
+NULL_SPAN = NullSpan()
+
+
+def GetStack():
+  """Returns list, this thread's stack of entered spans."""
+  stack = getattr(STACK, 'spans', None)
+  if stack == None:
+    stack = []
+    STACK.spans = stack
+
+  return stack
+
+
+def Current():
+  """Returns the innermost entered span on this thread, or None."""
+  stack = getattr(STACK, 'spans', None)
+  if stack:
+    return stack[-1]
+
+  return None
+
+
+def Start(name, label=None):
+  """Returns Span, a new span inside the current span, to be entered with "with".  NULL_SPAN if not ENABLED."""
+  if not ENABLED:
+    return NULL_SPAN
+
+  span = Span(name, label)
+
+  parent = Current()
+  if parent != None:
+    parent.children.append(span)
+  else:
+    ROOTS_LOCK.acquire()
+    ROOTS.append(span)
+    ROOTS_LOCK.release()
+
+  return span
+
+
+def Count(key, amount=1):
+  """Add to a counter of the current span, if there is one."""
+  span = Current()
+  if span != None:
+    span.Add(key, amount)
+
+
+def Attach(parent):
+  """Start spans on this thread inside parent, for work handed to another thread or process.  None detaches."""
+  if parent != None:
+    STACK.spans = [parent]
+  else:
+    STACK.spans = []
+
+
+def Adopt(spans):
+  """Add spans recorded elsewhere (a worker process) inside the current span."""
+  parent = Current()
+  if parent != None:
+    parent.children.extend(spans)
+  else:
+    ROOTS_LOCK.acquire()
+    ROOTS.extend(spans)
+    ROOTS_LOCK.release()
+
+
+def TimedIter(span, iterator):
+  """Returns iterator over the items of iterator, timing each one's production in span, and counting the bytes of
+  string items.  Returns iterator itself for NULL_SPAN.
+  """
+  if span is NULL_SPAN:
+    return iterator
+
+  return IterTimed(span, iter(iterator))
+
+
+def IterTimed(span, iterator):
+  """Yields the items of iterator, for TimedIter()."""
+  while True:
+    with span:
+      try:
+        item = iterator.next()
+      except StopIteration:
+        return
+
+      if isinstance(item, basestring):
+        span.Add('bytes', len(item))
+
+    yield item
+
+
+def TakeRoots():
+  """Returns list of Span, the root spans recorded so far, and starts a new list."""
+  global ROOTS
+
+  ROOTS_LOCK.acquire()
+  try:
+    roots = ROOTS
+    ROOTS = []
+  finally:
+    ROOTS_LOCK.release()
+
+  return roots
+
+
+def Merge(spans):
+  """Returns list of Span, combining spans with the same name and label, and with the same name if it has more than
+  REPORT_MAX_LABELS labels, with their children merged the same way.
+  """
+  labels = {}
+  for span in spans:
+    labels.setdefault(span.name, set()).add(span.label)
+
+  merged = []
+  by_key = {}
+
+  for span in spans:
+    if len(labels[span.name]) > REPORT_MAX_LABELS:
+      key = (span.name, None)
+      label = '(%s labels)' % len(labels[span.name])
+    else:
+      key = (span.name, span.label)
+      label = span.label
+
+    if key not in by_key:
+      by_key[key] = Span(span.name, label)
+      merged.append(by_key[key])
+
+    total = by_key[key]
+    total.seconds += span.seconds
+    total.calls += span.calls
+    for (count_key, amount) in span.counts.items():
+      total.Add(count_key, amount)
+    total.children.extend(span.children)
+
+  for total in merged:
+    total.children = Merge(total.children)
+
+  return merged
+
+
+def Report(roots):
+  """Log a tree of the spans, with siblings merged, each with its total and own (excluding children) seconds."""
+  for root in Merge(roots):
+    for line in ReportLines(root, 0):
+      log('Profile: %s' % line)
+
+
+def ReportLines(span, depth):
+  """Returns list of strings, the report lines of a span and its children."""
+  own_seconds = span.seconds - sum([child.seconds for child in span.children])
+
+  line = '%s%s' % ('  ' * depth, span.name)
+  if span.label != None:
+    line += ' %s' % span.label
+
+  line += ': %.3fs (own %.3fs, calls %s)' % (span.seconds, max(own_seconds, 0.0), span.calls)
+
+  for (key, amount) in sorted(span.counts.items()):
+    line += ' %s=%s' % (key, amount)
+
+  lines = [line]
+  for child in span.children:
+    lines += ReportLines(child, depth + 1)
+
+  return lines
+
+
+def WriteJson(path, roots):
+  """Write the spans, unmerged, to a JSON file."""
+  fp = open(path, 'w')
+  try:
+    json.dump([root.ToDict() for root in roots], fp, indent=2, sort_keys=True)
+  finally:
+    fp.close()
@@ -0,0 +1,69 @@
+"""
+Watching Files
+
+Polls files for changes by their mtime and size, for --watch mode.  Polling needs no extra modules (inotify), works on
+every platform and filesystem, and one stat per file a poll is cheap for the number of files a run reads.
+"""
+
+
+import os
+import time
+
+
+# Seconds between polls of the watched files
+POLL_INTERVAL = 1.0
+
+# Seconds files must be unchanged after a change, before it is reported, so a burst of edits is one change
+DEBOUNCE = 0.5
+
+
+def FileState(path):
+  """Returns (mtime, size) of the file, or None if it does not exist."""
+  try:
+    stat = os.stat(path)
+  except OSError:
+    return None
+
+  return (stat.st_mtime, stat.st_size)
+
+
+def Snapshot(paths):
+  """Returns dict, path -> FileState() of each path."""
+  return dict([(path, FileState(path)) for path in paths])
+
+
+def ChangedPaths(snapshot):
+  """Returns list of strings, the paths whose state is different from the snapshot, in order."""
+  return sorted([path for (path, state) in snapshot.items() if FileState(path) != state])
+
+
+def WaitForChanges(snapshot, timeout=None, poll_interval=POLL_INTERVAL, debounce=DEBOUNCE):
+  """Wait for any of the files in the snapshot to change, and then for them to stop changing for debounce seconds.
+
+  Returns: list of strings, the changed paths, or an empty list if timeout seconds passed without a change
+  """
+  started = time.time()
+
+  while not ChangedPaths(snapshot):
+    if timeout != None:
+      remaining = timeout - (time.time() - started)
+      if remaining <= 0:
+        return []
+
+      time.sleep(min(poll_interval, remaining))
+
+    else:
+      time.sleep(poll_interval)
+
+  # Wait for the burst of edits to finish
+  settled = Snapshot(snapshot.keys())
+  while True:
+    time.sleep(debounce)
+
+    current = Snapshot(snapshot.keys())
+    if current == settled:
+      break
+
+    settled = current
+
+  return ChangedPaths(snapshot)